@@ -0,0 +1,6 @@
+"""
+ts_soup的性能测试：
+    synthetic: 在sqlite中生成指定规模(天数×表数×每天行数)的数据源表、目标表、to_update_tables、updated_state
+    suite: 分别测试updated_state初始化、各类Source、TargetTable各写入方式以及run_sync整体耗时，结果保存为json，可在版本间对比
+    bench_vectorize / bench_startup: 单项的微基准
+"""
@@ -0,0 +1,81 @@
+"""
+run_sync启动阶段加载方法的耗时对比：
+    legacy: 导入funcs下所有模块，对每个表遍历所有模块的dir()
+    registry: 根据清单只导入本次需要同步的表所在的模块，从FUNC_REGISTRY取方法
+每种方式在独立进程中执行，避免模块缓存影响结果
+运行：python benchmarks/bench_startup.py --modules 200 --funcs 10 --due 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+MODULE_TEMPLATE = '''from ts_soup import db_operator, Source, TargetTable
+'''
+
+FUNC_TEMPLATE = '''
+
+@db_operator(sources=[Source(tb='src_{name}')], targets=[TargetTable(tb='{name}')])
+def {name}(executor):
+    df = executor.source_data[0]
+    df['value'] = df['value'] * 2
+    executor.value.append(df)
+'''
+
+LEGACY = '''
+import importlib, os, sys, time
+start = time.perf_counter()
+funcs_dir, tables = sys.argv[1], sys.argv[2].split(',')
+sys.path.append(funcs_dir)
+modules = [importlib.import_module(file.split('.')[0]) for file in os.listdir(funcs_dir) if file.endswith('.py')]
+funcs = [getattr(module, table) for table in tables for module in modules if table in dir(module)]
+print(time.perf_counter() - start)
+'''
+
+REGISTRY = '''
+import sys, time
+start = time.perf_counter()
+from ts_soup.registry import load_funcs
+funcs = load_funcs(sys.argv[1], sys.argv[2].split(','))
+print(time.perf_counter() - start)
+'''
+
+
+def make_funcs_dir(modules, funcs):
+    funcs_dir = tempfile.mkdtemp(prefix='ts_soup_bench_funcs_')
+    for i in range(modules):
+        with open(os.path.join(funcs_dir, f'module_{i}.py'), 'w', encoding='utf8') as f:
+            f.write(MODULE_TEMPLATE)
+            for j in range(funcs):
+                f.write(FUNC_TEMPLATE.format(name=f'table_{i}_{j}'))
+    return funcs_dir
+
+
+def run(code, funcs_dir, tables):
+    # 两种方式都预先导入ts_soup，只比较加载方法的耗时
+    output = subprocess.check_output([sys.executable, '-c', 'import ts_soup\n' + code, funcs_dir, ','.join(tables)])
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=int, default=200)
+    parser.add_argument('--funcs', type=int, default=10)
+    parser.add_argument('--due', type=int, default=20, help='本次需要同步的表数')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    funcs_dir = make_funcs_dir(args.modules, args.funcs)
+    tables = [f'table_{i % args.modules}_{i % args.funcs}' for i in range(args.due)]
+    # 第一次运行生成清单，不计入结果
+    run(REGISTRY, funcs_dir, tables)
+
+    legacy = min(run(LEGACY, funcs_dir, tables) for _ in range(args.repeat))
+    registry = min(run(REGISTRY, funcs_dir, tables) for _ in range(args.repeat))
+    print(f'modules={args.modules} funcs/module={args.funcs} due={args.due}: '
+          f'legacy {legacy:.3f}s, registry {registry:.3f}s, {legacy / registry:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+TargetTable.split_complete_date 与 Executor 更新日期取交集的向量化实现，与原逐日期分组实现的耗时对比
+运行：python benchmarks/bench_vectorize.py --rows 1000000 --dates 3000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from ts_soup.workers import TargetTable
+
+
+def legacy_split_complete_date(cur_result, index_field, params):
+    updated_date = []
+    not_updated_date = []
+    for index, group in cur_result.groupby(by=index_field, dropna=False):
+        if group.shape[0] == group.dropna(**params).shape[0]:
+            updated_date.append(index)
+        else:
+            not_updated_date.append(index)
+    return updated_date, not_updated_date
+
+
+def legacy_intersect(updated_dates):
+    update_state_date = None
+    for updated_date in updated_dates:
+        updated_date = pd.DataFrame(pd.to_datetime(updated_date), columns=['update_date']).drop_duplicates().applymap(
+            lambda x: x.strftime('%Y-%m-%d'))
+        if update_state_date is not None:
+            update_state_date = update_state_date.merge(updated_date, on='update_date', how='inner')[['update_date']]
+        else:
+            update_state_date = updated_date
+    return update_state_date
+
+
+def vectorized_intersect(updated_dates):
+    update_state_date = None
+    for updated_date in updated_dates:
+        updated_date = pd.Index(pd.to_datetime(updated_date).strftime('%Y-%m-%d')).unique()
+        update_state_date = updated_date if update_state_date is None else update_state_date.intersection(updated_date)
+    return update_state_date
+
+
+def make_frame(rows, dates, na_ratio, seed=0):
+    rng = np.random.default_rng(seed)
+    date_range = pd.date_range('2015-01-01', periods=dates).strftime('%Y-%m-%d')
+    df = pd.DataFrame({
+        'date': rng.choice(date_range, rows),
+        'period': rng.integers(0, 24, rows),
+        'value1': rng.random(rows),
+        'value2': rng.random(rows),
+    })
+    df.loc[rng.random(rows) < na_ratio, 'value2'] = np.nan
+    return df
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--dates', type=int, default=3000)
+    parser.add_argument('--na-ratio', type=float, default=0.00001)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows, args.dates, args.na_ratio)
+    target = TargetTable('bench', drop_na_subset=['value1', 'value2'])
+    legacy, legacy_time = timeit(legacy_split_complete_date, df, 'date', {'axis': 0, 'subset': ['value1', 'value2']})
+    vectorized, vectorized_time = timeit(target.split_complete_date, df)
+    assert legacy == vectorized, '结果不一致'
+    print(f'split_complete_date rows={args.rows} dates={args.dates}: '
+          f'legacy {legacy_time:.3f}s, vectorized {vectorized_time:.3f}s, {legacy_time / vectorized_time:.1f}x')
+
+    updated_dates = [vectorized[0], vectorized[0][::2], vectorized[0][::3]]
+    legacy, legacy_time = timeit(legacy_intersect, updated_dates)
+    vectorized, vectorized_time = timeit(vectorized_intersect, updated_dates)
+    assert sorted(legacy['update_date']) == sorted(vectorized), '结果不一致'
+    print(f'update_state intersection dates={args.dates}: '
+          f'legacy {legacy_time:.3f}s, vectorized {vectorized_time:.3f}s, {legacy_time / vectorized_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
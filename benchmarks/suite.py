@@ -0,0 +1,233 @@
+"""
+ts_soup性能测试套件，在sqlite中生成合成数据后分别测试：
+    state_init: updated_state初始化(__init)
+    sources: Source、分块Source、MultiSource、RawSqlSource 读取
+    write_modes: TargetTable各写入方式
+    run_sync: 顺序、多线程、asyncio流水线、多实例(多个进程通过sync_lease领取任务)执行整个同步
+运行：python -m benchmarks.suite run --days 90 --tables 10 --rows-per-day 1000
+对比：python -m benchmarks.suite compare benchmark_results/a.json benchmark_results/b.json
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from benchmarks.synthetic import build_database, db_infos, write_funcs
+
+WRITE_MODES = [None, 'multi_insert', 'upsert', 'staging']
+RUN_SYNC_MODES = {
+    'sequential': {},
+    'threads': {'max_workers': 4},
+    'threads_buffered_state': {'max_workers': 4, 'state_durable': False},
+    'threads_lpt': {'max_workers': 4, 'lpt_order': True},
+    'async': {'use_async': True, 'pipeline_depth': 2},
+    'lease': {'lease_sync': True, 'lease_days': 15, 'lease_seconds': 60},
+}
+# 多实例同步时同时启动的进程数
+LEASE_INSTANCES = 2
+
+
+def version_info():
+    try:
+        from importlib.metadata import version
+        package_version = version('ts-soup')
+    except Exception:
+        package_version = 'dev'
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        revision = None
+    return {'version': package_version, 'revision': revision}
+
+
+def result(suite, case, seconds, rows=None):
+    item = {'suite': suite, 'case': case, 'seconds': round(seconds, 6)}
+    if rows is not None:
+        item['rows'] = int(rows)
+        item['rows_per_sec'] = round(rows / seconds, 1) if seconds > 0 else None
+    return item
+
+
+def bench_state_init(path, dates, tables, repeat):
+    from ts_soup.common import __init
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        __init([], [], dates[0], dates[-1], db_infos(path))
+        seconds.append(time.perf_counter() - start)
+    return [result('state_init', f'tables={tables},days={len(dates)}', min(seconds))]
+
+
+def bench_sources(dates):
+    from ts_soup import Source, MultiSource, RawSqlSource
+    from ts_soup.common import SYNC_CONFIG
+    to_update_date = pd.Series(dates, dtype=object)
+    sources = {
+        'Source': Source(tb='src_0', query_field='date,item_id,value1,value2'),
+        'Source(downcast)': Source(tb='src_0', query_field='date,item_id,value1,value2', downcast=True),
+        'Source(arrow)': Source(tb='src_0', query_field='date,item_id,value1,value2'),
+        'Source(read_shards=4)': Source(tb='src_0', query_field='date,item_id,value1,value2', read_shards=4),
+        'Source(chunksize=10000)': Source(tb='src_0', query_field='date,item_id,value1,value2', chunksize=10000),
+        'MultiSource': MultiSource(relations=[{'left': 'src_0', 'right': 'dim_item', 'l_on': 'item_id', 'r_on': 'item_id',
+                                               'how': 'left', 'lquery_field': 'date,item_id,value1',
+                                               'rquery_field': 'category', 'l_cons': '', 'r_cons': ''}],
+                                   index_field='src_0.date'),
+        'RawSqlSource': RawSqlSource(index_field='date',
+                                     sql='select date,item_id,value1,value2 from src_0 where {date_filter}'),
+    }
+    results = []
+    for case, source in sources.items():
+        SYNC_CONFIG['fetch_backend'] = 'arrow' if case == 'Source(arrow)' else 'pandas'
+        start = time.perf_counter()
+        data = source.build_source(to_update_date)
+        if not isinstance(data, pd.DataFrame):
+            rows = sum(chunk.shape[0] for chunk in data)
+        else:
+            rows = data.shape[0]
+        results.append(result('sources', case, time.perf_counter() - start, rows))
+    SYNC_CONFIG['fetch_backend'] = 'pandas'
+    return results
+
+
+def bench_write_modes(path):
+    from sqlalchemy import text
+    from ts_soup import TargetTable
+    from benchmarks.synthetic import sqlite_engine
+    engine = sqlite_engine(path)
+    data = pd.read_sql('select date,item_id,value1,value2 from src_0', con=engine)
+    results = []
+    for write_mode in WRITE_MODES:
+        with engine.begin() as conn:
+            conn.execute(text('delete from tb_0'))
+        target = TargetTable(tb='tb_0', write_mode=write_mode, has_unique_idx=write_mode == 'upsert')
+        start = time.perf_counter()
+        target.build_output(data.copy())
+        results.append(result('write_modes', write_mode or 'default', time.perf_counter() - start, data.shape[0]))
+    engine.dispose()
+    return results
+
+
+def bench_run_sync(template, workdir, tables, dates):
+    results = []
+    funcs_dir = write_funcs(os.path.join(workdir, 'funcs'), tables)
+    for mode in RUN_SYNC_MODES:
+        path = os.path.join(workdir, f'run_sync_{mode}.db')
+        shutil.copy(template, path)
+        command = [sys.executable, '-m', 'benchmarks.suite', '_run_sync', '--db', path, '--funcs', funcs_dir,
+                   '--mode', mode, '--start', dates[0], '--end', dates[-1]]
+        processes = [subprocess.Popen(command, stdout=subprocess.PIPE)
+                     for _ in range(LEASE_INSTANCES if mode == 'lease' else 1)]
+        seconds = []
+        for process in processes:
+            output, _ = process.communicate()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+            seconds.append(json.loads(output.decode().strip().splitlines()[-1])['seconds'])
+        results.append(result('run_sync', mode, max(seconds)))
+    return results
+
+
+def _run_sync(args):
+    # 在独立进程中执行，避免方法模块和全局状态在多次执行之间共享
+    from ts_soup import run_sync
+    sys.argv = sys.argv[:1]
+    end = datetime.datetime.strptime(args.end, '%Y-%m-%d')
+    days = (end - datetime.datetime.strptime(args.start, '%Y-%m-%d')).days
+    start = time.perf_counter()
+    run_sync(db_infos(args.db), sync_start_from={'days': days}, sync_end=end, funcs_file=args.funcs,
+             **RUN_SYNC_MODES[args.mode])
+    print(json.dumps({'seconds': time.perf_counter() - start}))
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='ts_soup_bench_')
+    template = os.path.join(workdir, 'template.db')
+    dates = build_database(template, days=args.days, tables=args.tables, rows_per_day=args.rows_per_day,
+                           synced_ratio=args.synced_ratio)
+    path = os.path.join(workdir, 'bench.db')
+    shutil.copy(template, path)
+
+    suites = args.suites or ['state_init', 'sources', 'write_modes', 'run_sync']
+    results = []
+    try:
+        if 'state_init' in suites or 'sources' in suites or 'write_modes' in suites:
+            results += bench_state_init(path, dates, args.tables, args.repeat)
+        if 'sources' in suites:
+            results += bench_sources(dates)
+        if 'write_modes' in suites:
+            results += bench_write_modes(path)
+        if 'run_sync' in suites:
+            results += bench_run_sync(template, workdir, args.tables, dates)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta': dict(version_info(),
+                           time=datetime.datetime.now().isoformat(timespec='seconds'),
+                           days=args.days, tables=args.tables, rows_per_day=args.rows_per_day,
+                           synced_ratio=args.synced_ratio),
+              'results': results}
+    os.makedirs(args.output, exist_ok=True)
+    name = f"{report['meta']['version']}-{report['meta']['revision'] or 'local'}-{time.strftime('%Y%m%d%H%M%S')}.json"
+    with open(os.path.join(args.output, name), 'w', encoding='utf8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    for item in results:
+        print(f"{item['suite']:<12} {item['case']:<28} {item['seconds']:>10.3f}s"
+              + (f"  {item['rows_per_sec']:>12} 行/秒" if item.get('rows_per_sec') else ''))
+    print(f'结果已保存：{os.path.join(args.output, name)}')
+
+
+def compare(args):
+    with open(args.base, 'r', encoding='utf8') as f:
+        base = json.load(f)
+    with open(args.other, 'r', encoding='utf8') as f:
+        other = json.load(f)
+    base_results = {(i['suite'], i['case']): i for i in base['results']}
+    print(f"{'suite':<12} {'case':<28} {'base':>10} {'other':>10} {'ratio':>8}")
+    for item in other['results']:
+        key = (item['suite'], item['case'])
+        if key not in base_results:
+            continue
+        base_seconds = base_results[key]['seconds']
+        ratio = item['seconds'] / base_seconds if base_seconds else float('nan')
+        print(f"{key[0]:<12} {key[1]:<28} {base_seconds:>9.3f}s {item['seconds']:>9.3f}s {ratio:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--days', type=int, default=90)
+    run_parser.add_argument('--tables', type=int, default=10)
+    run_parser.add_argument('--rows-per-day', type=int, default=1000)
+    run_parser.add_argument('--synced-ratio', type=float, default=0.5)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--suites', nargs='+', choices=['state_init', 'sources', 'write_modes', 'run_sync'])
+    run_parser.add_argument('--output', default='benchmark_results')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('other')
+    compare_parser.set_defaults(handler=compare)
+
+    run_sync_parser = subparsers.add_parser('_run_sync')
+    run_sync_parser.add_argument('--db', required=True)
+    run_sync_parser.add_argument('--funcs', required=True)
+    run_sync_parser.add_argument('--mode', choices=list(RUN_SYNC_MODES), required=True)
+    run_sync_parser.add_argument('--start', required=True)
+    run_sync_parser.add_argument('--end', required=True)
+    run_sync_parser.set_defaults(handler=_run_sync)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+生成用于性能测试的sqlite数据库和funcs模块
+"""
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+FUNC_TEMPLATE = '''
+
+@db_operator(sources=[Source(tb='src_{index}', query_field='date,item_id,value1,value2', watermark_field='updated_at')],
+             targets=[TargetTable(tb='tb_{index}', write_mode={write_mode!r}, has_unique_idx={has_unique_idx})])
+def tb_{index}(executor):
+    df = executor.source_data[0]
+    df['value1'] = df['value1'] * 2
+    executor.value.append(df)
+'''
+
+
+def sqlite_engine(path):
+    return create_engine(f'sqlite:///{path}')
+
+
+def db_infos(path):
+    """
+    run_sync使用的数据库配置，数据源和目标表在同一个sqlite文件中
+    """
+    engine = sqlite_engine(path)
+    return {
+        'sources': [{'alias': 'bench_source', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [engine]}],
+        'targets': [{'alias': 'bench_target', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [engine]}],
+    }
+
+
+def build_database(path, days=90, tables=10, rows_per_day=1000, synced_ratio=0.5, end_date='2024-06-30', seed=0):
+    """
+    :param path: sqlite文件路径，已存在时覆盖
+    :param days: 每个数据源表的天数
+    :param tables: 数据源表(及对应目标表、方法)的个数
+    :param rows_per_day: 每个数据源表每天的行数
+    :param synced_ratio: updated_state中已同步的日期比例(按日期从早到晚)
+    :return: 日期列表
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    engine = sqlite_engine(path)
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=end_date, periods=days).strftime('%Y-%m-%d')
+    rows = days * rows_per_day
+    synced = dates[:int(days * synced_ratio)]
+
+    with engine.begin() as conn:
+        pd.DataFrame({'item_id': np.arange(rows_per_day),
+                      'category': rng.choice(['a', 'b', 'c', 'd'], rows_per_day)}).to_sql('dim_item', conn, index=False)
+        for index in range(tables):
+            pd.DataFrame({'date': np.repeat(dates, rows_per_day),
+                          'item_id': np.tile(np.arange(rows_per_day), days),
+                          'value1': rng.random(rows),
+                          'value2': rng.random(rows),
+                          'updated_at': '2024-01-01 00:00:00'}).to_sql(f'src_{index}', conn, index=False)
+            conn.execute(text(f'create index idx_src_{index}_date on src_{index} (date)'))
+            conn.execute(text(f'create table tb_{index} (date text, item_id integer, value1 real, value2 real, '
+                              f'unique (date, item_id))'))
+        pd.DataFrame({'table_name': [f'tb_{i}' for i in range(tables)]}).to_sql('to_update_tables', conn, index=False)
+        conn.execute(text('create table updated_state (update_date date, table_name varchar(50) not null, '
+                          'unique (update_date, table_name))'))
+        pd.DataFrame({'update_date': np.tile(synced, tables),
+                      'table_name': np.repeat([f'tb_{i}' for i in range(tables)], len(synced))}) \
+            .to_sql('updated_state', conn, index=False, if_exists='append')
+    engine.dispose()
+    return list(dates)
+
+
+def write_funcs(funcs_dir, tables, write_mode=None):
+    """
+    生成funcs模块，每个目标表对应一个db_operator方法
+    """
+    os.makedirs(funcs_dir, exist_ok=True)
+    with open(os.path.join(funcs_dir, 'bench_funcs.py'), 'w', encoding='utf8') as f:
+        f.write('from ts_soup import db_operator, Source, TargetTable\n')
+        for index in range(tables):
+            f.write(FUNC_TEMPLATE.format(index=index, write_mode=write_mode, has_unique_idx=write_mode == 'upsert'))
+    return funcs_dir
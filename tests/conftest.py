@@ -0,0 +1,24 @@
+import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from ts_soup import common
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """
+    sqlite数据库，注册为sources_default和targets_default，src表为2024-06-01起30天、每天3行的数据
+    """
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    dates = [(datetime.date(2024, 6, 1) + datetime.timedelta(days=i)).strftime('%Y-%m-%d') for i in range(30)]
+    data = pd.DataFrame({'date': [d for d in dates for _ in range(3)],
+                         'item_id': [i for _ in dates for i in range(3)],
+                         'value': range(len(dates) * 3)})
+    data.to_sql('src', con=engine, index=False)
+    saved = dict(common.USABLE_DBS)
+    common.USABLE_DBS.update({'sources_default': engine, 'targets_default': engine})
+    yield engine
+    common.USABLE_DBS.clear()
+    common.USABLE_DBS.update(saved)
+    engine.dispose()
@@ -0,0 +1,12 @@
+import pytest
+from ts_soup import run_sync
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'lease_sync': True, 'use_async': True},
+    {'daemon': True, 'max_workers': 4},
+    {'use_async': True, 'max_workers': 2},
+])
+def test_execution_modes_are_exclusive(kwargs):
+    with pytest.raises(ValueError, match='执行方式只能选择一种'):
+        run_sync({}, **kwargs)
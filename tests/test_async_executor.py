@@ -0,0 +1,34 @@
+import asyncio
+import threading
+import pandas as pd
+from ts_soup.async_executor import AsyncPipeline
+
+
+class _Source:
+    db_str = 'sources_default'
+
+
+class _Executor:
+    def __init__(self):
+        self.threads = []
+
+    def read_source(self, source):
+        def chunks():
+            # 分块数据源在接收时才开始查询
+            self.threads.append(threading.current_thread())
+            yield pd.DataFrame({'a': [1]})
+        return chunks()
+
+    def accept_source_data(self, datas):
+        for data in datas:
+            list(data)
+
+
+def test_chunked_sources_not_read_on_event_loop_thread():
+    func = lambda: None
+    func.sources = [_Source(), _Source()]
+    executor = _Executor()
+    pipeline = AsyncPipeline([], db_inflight={'sources_default': 1})
+    asyncio.run(pipeline._AsyncPipeline__read(func, executor))
+    assert len(executor.threads) == 2
+    assert threading.main_thread() not in executor.threads
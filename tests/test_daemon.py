@@ -0,0 +1,42 @@
+from ts_soup import common
+from ts_soup.common import StateWriter, UpdatedState
+from ts_soup.daemon import SyncDaemon
+
+DATES = ['2024-06-01', '2024-06-02', '2024-06-03']
+
+
+def _func(name, calls):
+    def func(to_update_date=None):
+        calls.append((name, list(to_update_date)))
+        common.DATA_UPDATED_STATE.mark_synced(name, to_update_date)
+        return True
+    func.__name__ = name
+    return func
+
+
+def _daemon(sqlite_db, monkeypatch, calls):
+    monkeypatch.setattr(common, 'STATE_WRITER', StateWriter(sqlite_db))
+    monkeypatch.setattr(common, 'DATA_UPDATED_STATE', UpdatedState(DATES))
+    daemon = SyncDaemon(None, {'days': 2})
+    daemon.funcs = [_func('up', calls), _func('down', calls)]
+    daemon.dependencies = {'up': set(), 'down': {'up'}}
+    return daemon
+
+
+def test_full_sync_without_pending_dates_does_not_propagate(sqlite_db, monkeypatch):
+    calls = []
+    daemon = _daemon(sqlite_db, monkeypatch, calls)
+    common.DATA_UPDATED_STATE.mark_synced('up', DATES)
+    common.DATA_UPDATED_STATE.mark_synced('down', DATES)
+    daemon._SyncDaemon__sync({'up': None})
+    assert calls == []
+    assert 'up' in daemon.full_synced_at
+
+
+def test_full_sync_propagates_only_pending_dates(sqlite_db, monkeypatch):
+    calls = []
+    daemon = _daemon(sqlite_db, monkeypatch, calls)
+    common.DATA_UPDATED_STATE.mark_synced('up', DATES[:2])
+    common.DATA_UPDATED_STATE.mark_synced('down', DATES)
+    daemon._SyncDaemon__sync({'up': None})
+    assert calls == [('up', ['2024-06-03']), ('down', ['2024-06-03'])]
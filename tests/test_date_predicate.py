@@ -0,0 +1,48 @@
+import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from ts_soup.common import date_predicate, query_in_sql
+
+CASES = {
+    'contiguous': [f'2024-06-{i:02d}' for i in range(3, 20)],
+    'scattered': ['2024-06-02', '2024-06-09', '2024-06-15', '2024-06-28'],
+    'mixed': ['2024-06-01', '2024-06-02', '2024-06-03', '2024-06-10', '2024-06-20', '2024-06-21'],
+    'single': ['2024-06-17'],
+    'month_boundary': ['2024-05-30', '2024-05-31', '2024-06-01', '2024-06-02'],
+}
+
+
+def _select(engine, where, params=None):
+    return pd.read_sql(text(f'select * from src where {where} order by date, item_id'), con=engine, params=params)
+
+
+@pytest.mark.parametrize('name', list(CASES))
+def test_same_rows_as_in_list(sqlite_db, name):
+    dates = CASES[name]
+    expected = _select(sqlite_db, f'date in ({query_in_sql(dates)})')
+    predicate, params = date_predicate('date', dates)
+    pd.testing.assert_frame_equal(_select(sqlite_db, predicate, params), expected)
+
+
+def test_contiguous_uses_between():
+    predicate, params = date_predicate('date', CASES['contiguous'])
+    assert predicate == '(date between :d_s0 and :d_e0)'
+    assert params == {'d_s0': '2024-06-03', 'd_e0': '2024-06-19'}
+
+
+def test_single_and_empty():
+    assert date_predicate('date', ['2024-06-17']) == ('(date in (:d_0))', {'d_0': '2024-06-17'})
+    assert date_predicate('date', []) == ('1=0', {})
+
+
+@pytest.mark.parametrize('dates', [
+    [datetime.date(2024, 6, 2), datetime.date(2024, 6, 3), datetime.date(2024, 6, 9)],
+    list(pd.to_datetime(['2024-06-02', '2024-06-03', '2024-06-09'])),
+    pd.to_datetime(pd.Series(['2024-06-02', '2024-06-03', '2024-06-09'])).values,
+])
+def test_date_types_normalised(sqlite_db, dates):
+    predicate, params = date_predicate('date', dates)
+    assert sorted(params.values()) == ['2024-06-02', '2024-06-03', '2024-06-09']
+    expected = _select(sqlite_db, f'date in ({query_in_sql(["2024-06-02", "2024-06-03", "2024-06-09"])})')
+    pd.testing.assert_frame_equal(_select(sqlite_db, predicate, params), expected)
@@ -0,0 +1,44 @@
+import pytest
+from ts_soup import common
+from ts_soup.common import __init
+
+
+@pytest.fixture
+def db_infos(sqlite_db):
+    return {'sources': [{'alias': 'src', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [sqlite_db]}],
+            'targets': [{'alias': 'tgt', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [sqlite_db]}]}
+
+
+@pytest.fixture(autouse=True)
+def restore_config():
+    saved = dict(common.SYNC_CONFIG)
+    yield
+    common.SYNC_CONFIG.clear()
+    common.SYNC_CONFIG.update(saved)
+    common.CHECKPOINT_STORE = None
+    common.SOURCE_CACHE = None
+    common.STATE_WRITER = None
+    common.DATA_UPDATED_STATE = None
+
+
+def _init(db_infos, customized_time=(), **config):
+    __init(['tb_0'], list(customized_time), '2024-06-01', '2024-06-30', db_infos, sync_config=config)
+
+
+def test_checkpoint_store_reset_between_runs(db_infos, tmp_path):
+    _init(db_infos, checkpoint_dir=str(tmp_path / 'checkpoints'))
+    assert common.CHECKPOINT_STORE is not None
+    _init(db_infos, checkpoint_dir=None)
+    assert common.CHECKPOINT_STORE is None
+
+
+def test_checkpoint_store_bypassed_for_customized_time(db_infos, tmp_path):
+    _init(db_infos, customized_time=['2024-06-03'], checkpoint_dir=str(tmp_path / 'checkpoints'))
+    assert common.CHECKPOINT_STORE is None
+
+
+def test_source_cache_reset_between_runs(db_infos):
+    _init(db_infos, source_cache_mb=1)
+    assert common.SOURCE_CACHE is not None
+    _init(db_infos, source_cache_mb=None)
+    assert common.SOURCE_CACHE is None
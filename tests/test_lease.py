@@ -0,0 +1,99 @@
+import threading
+import time
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from ts_soup import common
+from ts_soup.common import StateWriter, UpdatedState, create_state_table
+from ts_soup.lease import LEASE_TABLE, LeaseWorker, create_lease_table
+
+DATES = [f'2024-06-{i:02d}' for i in range(1, 7)]
+
+
+@pytest.fixture
+def lease_env(sqlite_db, monkeypatch):
+    create_state_table(sqlite_db)
+    create_lease_table(sqlite_db)
+    monkeypatch.setattr(common, 'STATE_WRITER', StateWriter(sqlite_db))
+    monkeypatch.setattr(common, 'DATA_UPDATED_STATE', UpdatedState(DATES))
+    monkeypatch.setattr(common, 'EXECUTE_STATE', True)
+    return sqlite_db
+
+
+def _func(name, calls, depends_on=(), seconds=0.0):
+    lock = threading.Lock()
+
+    def func(to_update_date=None):
+        time.sleep(seconds)
+        with lock:
+            calls.append((name, threading.current_thread().name, tuple(to_update_date)))
+        common.STATE_WRITER.add(name, to_update_date)
+        common.DATA_UPDATED_STATE.mark_synced(name, to_update_date)
+        return True
+    func.__name__ = name
+    func.sources, func.targets, func.depends_on = [], [], list(depends_on)
+    return func
+
+
+def _worker(funcs, **kwargs):
+    return LeaseWorker(funcs, 'run', lease_days=2, lease_seconds=60, poll_seconds=0.05, **kwargs)
+
+
+def _units(engine):
+    return pd.read_sql(text(f'select table_name, window_start, status, owner, attempts from {LEASE_TABLE} '
+                            f'order by table_name, window_start'), con=engine)
+
+
+def test_two_workers_split_units(lease_env):
+    calls = []
+    funcs = [_func('a', calls, seconds=0.05), _func('b', calls, depends_on=['a'], seconds=0.05)]
+    workers = [_worker(funcs, worker_id=f'w{i}') for i in range(2)]
+    threads = [threading.Thread(target=w.run, name=f'w{i}') for i, w in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    units = _units(lease_env)
+    assert len(units) == 6 and set(units['status']) == {'done'} and set(units['attempts']) == {1}
+    # 每个任务只执行一次，两个实例都领取了任务
+    assert sorted((name, dates) for name, _, dates in calls) == sorted(
+        (name, tuple(DATES[i:i + 2])) for name in 'ab' for i in range(0, 6, 2))
+    assert {thread for _, thread, _ in calls} == {'w0', 'w1'}
+    state = pd.read_sql('select * from updated_state', con=lease_env)
+    assert len(state) == 12 and common.EXECUTE_STATE is True
+
+
+def _expire(engine, attempts):
+    with engine.begin() as conn:
+        conn.execute(text(f"update {LEASE_TABLE} set status = 'running', owner = 'crashed', "
+                          f"expires_at = :expired, attempts = :attempts where table_name = 'a' and window_start = '2024-06-01'"),
+                     {'expired': time.time() - 1, 'attempts': attempts})
+
+
+def test_expired_lease_reclaimed(lease_env):
+    calls = []
+    funcs = [_func('a', calls)]
+    _worker(funcs, worker_id='setup')._LeaseWorker__register()
+    _expire(lease_env, attempts=1)
+    assert _worker(funcs, worker_id='w1').run() == {'a': True}
+    units = _units(lease_env)
+    assert set(units['status']) == {'done'}
+    assert units.set_index('window_start').loc['2024-06-01', 'attempts'] == 2
+    assert len(calls) == 3
+
+
+def test_expired_lease_exhausted_attempts_is_dead(lease_env):
+    calls = []
+    funcs = [_func('a', calls), _func('b', calls, depends_on=['a'])]
+    _worker(funcs, worker_id='setup')._LeaseWorker__register()
+    _expire(lease_env, attempts=3)
+    results = _worker(funcs, worker_id='w1', max_attempts=3).run()
+    assert results == {'a': False, 'b': False}
+    assert common.EXECUTE_STATE is False
+    units = _units(lease_env).set_index(['table_name', 'window_start'])
+    assert units.loc[('a', '2024-06-01'), 'status'] == 'running'
+    assert units.loc[('a', '2024-06-01'), 'attempts'] == 3
+    assert units.loc[('b', '2024-06-01'), 'status'] == 'pending'
+    assert ('a', ('2024-06-01', '2024-06-02')) not in [(n, d) for n, _, d in calls]
+    assert len(calls) == 4
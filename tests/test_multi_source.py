@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from ts_soup import common
+from ts_soup.workers import MultiSource
+
+DATES = pd.Series([f'2024-06-{i:02d}' for i in range(1, 11)])
+DIM = pd.DataFrame({'item_id': [0, 1], 'name': ['a', None], 'flag': [1, 0]})
+
+
+@pytest.fixture
+def dim_dbs(sqlite_db, tmp_path):
+    """
+    dim表同时写入sources_default与另一个库other，item_id为2的行在dim中不存在
+    """
+    other = create_engine(f'sqlite:///{tmp_path / "other.db"}')
+    for engine in (sqlite_db, other):
+        DIM.to_sql('dim', con=engine, index=False)
+    common.USABLE_DBS['other'] = other
+    yield
+    other.dispose()
+
+
+def _relation(how, r_cons, r_db=None):
+    rel = {'left': 'src', 'right': 'dim', 'l_on': 'item_id', 'r_on': 'item_id', 'how': how,
+           'lquery_field': 'date,item_id,value', 'rquery_field': 'name', 'l_cons': '', 'r_cons': r_cons}
+    if r_db:
+        rel['r_db'] = r_db
+    return rel
+
+
+@pytest.mark.parametrize('how', ['left', 'inner'])
+@pytest.mark.parametrize('r_cons', ['', 'flag = 1', 'name is null'])
+def test_cross_db_join_matches_same_db(dim_dbs, how, r_cons):
+    same_db = MultiSource([_relation(how, r_cons)], index_field='src.date')
+    cross_db = MultiSource([_relation(how, r_cons, r_db='other')], index_field='src.date')
+    assert not same_db.is_cross_db() and cross_db.is_cross_db()
+
+    def normalise(data):
+        data = data.sort_values(['date', 'item_id']).reset_index(drop=True)[['date', 'item_id', 'value', 'name']]
+        data['name'] = data['name'].astype(object).where(data['name'].notna(), None)
+        return data
+
+    pd.testing.assert_frame_equal(normalise(cross_db.build_source(DATES)), normalise(same_db.build_source(DATES)))
@@ -0,0 +1,47 @@
+import datetime
+import os
+import sys
+import pytest
+from sqlalchemy import inspect, text
+from benchmarks.synthetic import build_database, db_infos, sqlite_engine, write_funcs
+from ts_soup import common, run_sync
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'plan.db')
+    build_database(path, days=10, tables=3, rows_per_day=5, synced_ratio=0.5)
+    write_funcs(str(tmp_path / 'funcs'), 3)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', sys.argv[:1])
+    saved_dbs, saved_config = dict(common.USABLE_DBS), dict(common.SYNC_CONFIG)
+    yield path
+    common.USABLE_DBS.clear()
+    common.USABLE_DBS.update(saved_dbs)
+    common.SYNC_CONFIG.clear()
+    common.SYNC_CONFIG.update(saved_config)
+
+
+def _dry_run(path, **kwargs):
+    return run_sync(db_infos(path), sync_start_from={'days': 9}, sync_end=datetime.datetime(2024, 6, 30),
+                    funcs_file='funcs', dry_run=True, **kwargs)
+
+
+def test_dry_run_has_no_side_effects(workdir, tmp_path):
+    engine = sqlite_engine(workdir)
+    with engine.begin() as conn:
+        conn.execute(text('drop table updated_state'))
+    plan = _dry_run(workdir, change_detection=True, source_cache_mb=1, checkpoint_dir=str(tmp_path / 'checkpoints'))
+    assert [item['pending_days'] for item in plan] == [10, 10, 10]
+    tables = inspect(engine).get_table_names()
+    assert 'updated_state' not in tables and 'updated_fingerprint' not in tables
+    assert not os.path.exists(tmp_path / 'checkpoints')
+    assert common.SOURCE_CACHE is None
+
+
+def test_dry_run_counts_rows_only_when_enabled(workdir):
+    plan = _dry_run(workdir)
+    assert all(item['rows'] is None for item in plan)
+    plan = _dry_run(workdir, plan_count_rows=True)
+    assert [item['rows_from'] for item in plan] == ['count'] * 3
+    assert all(item['rows'] == item['pending_days'] * 5 for item in plan)
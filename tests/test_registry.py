@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+import uuid
+import pytest
+from ts_soup import registry
+from ts_soup.common import FUNC_REGISTRY
+
+FUNC_TEMPLATE = '''
+
+@db_operator(sources=[Source(tb='src_{name}')], targets=[TargetTable(tb='{name}')])
+def {name}(executor):
+    executor.value.append(executor.source_data[0])
+'''
+
+DYNAMIC_TEMPLATE = '''
+
+def _build(name):
+    def func(executor):
+        executor.value.append(executor.source_data[0])
+    func.__name__ = name
+    return db_operator(sources=[Source(tb='src_' + name)], targets=[TargetTable(tb=name)])(func)
+
+
+{name} = _build('{name}')
+'''
+
+PLAIN_TEMPLATE = '''
+
+def {name}():
+    return True
+'''
+
+
+@pytest.fixture
+def funcs_dir(tmp_path):
+    """
+    每个用例使用不同的模块名，结束后清理导入的模块及注册的方法
+    """
+    prefix = f'm_{uuid.uuid4().hex[:8]}'
+    before = set(FUNC_REGISTRY)
+
+    def write(module, *parts):
+        with open(tmp_path / f'{prefix}_{module}.py', 'w', encoding='utf8') as f:
+            f.write('from ts_soup import db_operator, Source, TargetTable\n')
+            for template, name in parts:
+                f.write(template.format(name=name))
+        return f'{prefix}_{module}'
+
+    yield str(tmp_path), write
+    for name in [i for i in sys.modules if i.startswith(prefix)]:
+        del sys.modules[name]
+    for name in set(FUNC_REGISTRY) - before:
+        del FUNC_REGISTRY[name]
+    if str(tmp_path) in sys.path:
+        sys.path.remove(str(tmp_path))
+
+
+def test_manifest_reparses_only_changed_files(funcs_dir, monkeypatch):
+    path, write = funcs_dir
+    first = write('first', (FUNC_TEMPLATE, 'reg_first'))
+    second = write('second', (FUNC_TEMPLATE, 'reg_second'))
+    parsed = []
+    original = registry._decorated_funcs
+    monkeypatch.setattr(registry, '_decorated_funcs', lambda file: parsed.append(os.path.basename(file)) or original(file))
+
+    manifest = registry.build_manifest(path)
+    assert manifest[f'{first}.py']['funcs'] == ['reg_first']
+    assert manifest[f'{second}.py']['funcs'] == ['reg_second']
+    with open(os.path.join(path, registry.MANIFEST_FILE), encoding='utf8') as f:
+        assert json.load(f) == manifest
+
+    # 未修改的文件使用缓存
+    parsed.clear()
+    assert registry.build_manifest(path) == manifest
+    assert parsed == []
+
+    # 文件大小变化时重新解析
+    write('first', (FUNC_TEMPLATE, 'reg_first'), (FUNC_TEMPLATE, 'reg_first_b'))
+    assert registry.build_manifest(path)[f'{first}.py']['funcs'] == ['reg_first', 'reg_first_b']
+    assert parsed == [f'{first}.py']
+
+    # 大小不变、只有修改时间变化时也重新解析
+    parsed.clear()
+    write('second', (FUNC_TEMPLATE, 'reg_other'))
+    stat = os.stat(os.path.join(path, f'{second}.py'))
+    os.utime(os.path.join(path, f'{second}.py'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert registry.build_manifest(path)[f'{second}.py']['funcs'] == ['reg_other']
+    assert parsed == [f'{second}.py']
+
+
+def test_load_funcs_imports_only_due_modules(funcs_dir):
+    path, write = funcs_dir
+    due = write('due', (FUNC_TEMPLATE, 'reg_due'))
+    other = write('other', (FUNC_TEMPLATE, 'reg_other'))
+
+    funcs = registry.load_funcs(path, ['reg_due'])
+
+    assert [i.__name__ for i in funcs] == ['reg_due']
+    assert due in sys.modules
+    assert other not in sys.modules
+
+
+def test_load_funcs_fallback_imports_uncovered_modules(funcs_dir, capsys):
+    path, write = funcs_dir
+    static = write('static', (FUNC_TEMPLATE, 'reg_static'))
+    mixed = write('mixed', (FUNC_TEMPLATE, 'reg_mixed'), (DYNAMIC_TEMPLATE, 'reg_dynamic'))
+    plain = write('plain', (PLAIN_TEMPLATE, 'reg_plain'))
+
+    manifest = registry.build_manifest(path)
+    assert manifest[f'{mixed}.py'] == {**manifest[f'{mixed}.py'], 'funcs': ['reg_mixed'], 'dynamic': True}
+    assert manifest[f'{plain}.py']['funcs'] == []
+
+    funcs = registry.load_funcs(path, ['reg_dynamic', 'reg_plain', 'reg_missing'])
+
+    # 动态生成的方法从FUNC_REGISTRY取出，未使用db_operator的方法与原有方式一致按模块属性取出
+    assert [i.__name__ for i in funcs] == ['reg_dynamic', 'reg_plain']
+    assert funcs[0] is FUNC_REGISTRY['reg_dynamic']
+    assert funcs[1]() is True
+    # 清单中已覆盖且没有动态方法的模块不导入
+    assert static not in sys.modules
+    output = capsys.readouterr().out
+    assert output.count("清单中未找到 ['reg_dynamic', 'reg_plain', 'reg_missing']") == 1
+    assert 'reg_missing 未找到对应的方法' in output
+    assert 'reg_plain 未找到对应的方法' not in output
@@ -0,0 +1,102 @@
+import threading
+import time
+import pytest
+from ts_soup import common
+from ts_soup.scheduler import DagScheduler, build_dependencies, topological_order
+
+
+class _Engine:
+    def __init__(self, url):
+        self.url = url
+
+
+class _Source:
+    def __init__(self, tb, db_str='sources_default', url='sqlite:///source'):
+        self.tb, self.db_str, self.db = tb, db_str, _Engine(url)
+
+    def read_tables(self):
+        return [self.tb]
+
+
+class _Target:
+    def __init__(self, tb, db_str='targets_default', url='sqlite:///source'):
+        self.tb, self.db_str, self.db = tb, db_str, _Engine(url)
+
+
+def _func(name, calls, sources=(), targets=(), depends_on=(), result=True, seconds=0.0, running=None):
+    def func():
+        if running is not None:
+            with running['lock']:
+                running['now'] += 1
+                running['peak'] = max(running['peak'], running['now'])
+        time.sleep(seconds)
+        calls.append(name)
+        if running is not None:
+            with running['lock']:
+                running['now'] -= 1
+        return result
+    func.__name__ = name
+    func.sources = list(sources)
+    func.targets = list(targets)
+    func.depends_on = list(depends_on)
+    return func
+
+
+@pytest.fixture(autouse=True)
+def execute_state(monkeypatch):
+    monkeypatch.setattr(common, 'EXECUTE_STATE', True)
+
+
+def test_target_to_source_dependency_inferred():
+    calls = []
+    funcs = [_func('down', calls, sources=[_Source('tb_up')]),
+             _func('up', calls, targets=[_Target('tb_up')]),
+             _func('other', calls, sources=[_Source('tb_up', url='sqlite:///elsewhere')])]
+    assert build_dependencies(funcs) == {'down': {'up'}, 'up': set(), 'other': set()}
+    ordered, _ = topological_order(funcs)
+    assert [i.__name__ for i in ordered] == ['up', 'down', 'other']
+
+
+def test_dependencies_run_first():
+    calls = []
+    funcs = [_func('c', calls, depends_on=['b']),
+             _func('b', calls, depends_on=['a'], seconds=0.02),
+             _func('a', calls, seconds=0.02)]
+    results = DagScheduler(funcs, max_workers=4).run()
+    assert results == {'a': True, 'b': True, 'c': True}
+    assert calls == ['a', 'b', 'c']
+
+
+def test_dependents_of_failed_func_are_skipped():
+    calls = []
+    funcs = [_func('a', calls, result=False), _func('b', calls, depends_on=['a']),
+             _func('c', calls, depends_on=['b']), _func('d', calls)]
+    results = DagScheduler(funcs, max_workers=2).run()
+    assert results == {'a': False, 'b': False, 'c': False, 'd': True}
+    assert sorted(calls) == ['a', 'd']
+    assert common.EXECUTE_STATE is False
+
+
+def test_db_concurrency_cap():
+    calls, running = [], {'lock': threading.Lock(), 'now': 0, 'peak': 0}
+    funcs = [_func(f'f{i}', calls, targets=[_Target(f'tb_{i}')], seconds=0.02, running=running) for i in range(6)]
+    results = DagScheduler(funcs, max_workers=6, db_concurrency={'targets_default': 2}).run()
+    assert all(results.values())
+    assert running['peak'] == 2
+
+
+@pytest.mark.parametrize('limit', [0, -1, None])
+def test_db_concurrency_below_one_rejected(limit):
+    with pytest.raises(ValueError, match='db_concurrency'):
+        DagScheduler([_func('a', [])], db_concurrency={'targets_default': limit})
+
+
+def test_unschedulable_funcs_fail_the_run(capsys):
+    calls = []
+    scheduler = DagScheduler([_func('a', calls, targets=[_Target('tb_a')]), _func('b', calls, depends_on=['a'])])
+    scheduler.db_concurrency = {'targets_default': 0}
+    assert scheduler.run() == {'a': False, 'b': False}
+    assert calls == []
+    assert common.EXECUTE_STATE is False
+    output = capsys.readouterr().out
+    assert 'a 无法调度' in output and 'b 依赖的方法未执行' in output
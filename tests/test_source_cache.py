@@ -0,0 +1,16 @@
+import os
+import pandas as pd
+from ts_soup.common import SourceCache
+
+
+def test_spill_after_clear(tmp_path):
+    cache = SourceCache(0, spill_dir=str(tmp_path))
+    data = pd.DataFrame({'a': range(100)})
+    cache.put('k1', data)
+    cache.put('k2', data)
+    assert cache.stats['spills'] == 1
+    cache.clear()
+    assert not os.path.exists(cache.spill_dir)
+    cache.put('k3', data)
+    cache.put('k4', data)
+    pd.testing.assert_frame_equal(cache.get('k3'), data)
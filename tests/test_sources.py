@@ -0,0 +1,43 @@
+import pandas as pd
+from ts_soup.workers import RawSqlSource, Source
+
+DATES = pd.Series([f'2024-06-{i:02d}' for i in range(11, 31)])
+
+
+def _read(source):
+    return source.build_source(DATES).reset_index(drop=True)
+
+
+def test_source_read_shards_same_rows_and_order(sqlite_db):
+    for kwargs in [{}, {'order_desc': True}, {'order_index': ['item_id', 'date']},
+                   {'order_index': ['item_id', 'date'], 'order_desc': True}]:
+        expected = _read(Source(tb='src', **kwargs))
+        sharded = _read(Source(tb='src', read_shards=3, **kwargs))
+        pd.testing.assert_frame_equal(sharded, expected)
+
+
+def test_raw_sql_read_shards_keeps_order_by(sqlite_db):
+    for order_by in ['date desc', 'date', 'date desc, item_id desc', 'item_id, date desc', 'value desc']:
+        sql = f'select * from src where date in ({{}}) order by {order_by}'
+        expected = _read(RawSqlSource(index_field='date', sql=sql))
+        sharded = _read(RawSqlSource(index_field='date', sql=sql, read_shards=3))
+        pd.testing.assert_frame_equal(sharded, expected)
+
+
+def test_raw_sql_read_shards_date_filter(sqlite_db):
+    sql = 'select * from src where {date_filter} order by date desc, item_id'
+    expected = _read(RawSqlSource(index_field='date', sql=sql))
+    sharded = _read(RawSqlSource(index_field='date', sql=sql, read_shards=4))
+    assert len(expected) == 60
+    pd.testing.assert_frame_equal(sharded, expected)
+
+
+def test_raw_sql_template_keeps_format_escapes(sqlite_db):
+    # str.format的转义：{{ }} 是字面的大括号
+    expected = pd.read_sql("select date, '{x}' as brace from src where date in ('2024-06-11','2024-06-12') "
+                           "order by date, item_id", con=sqlite_db)
+    for sql in ["select date, '{{x}}' as brace from src where date in ({}) order by date, item_id",
+                "select date, '{{x}}' as brace from src where {date_filter} order by date, item_id"]:
+        source = RawSqlSource(index_field='date', sql=sql)
+        data = source.build_source(pd.Series(['2024-06-11', '2024-06-12']))
+        pd.testing.assert_frame_equal(data, expected)
@@ -0,0 +1,151 @@
+import datetime
+import sys
+import uuid
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from ts_soup import common, run_sync
+from ts_soup.common import StateWriter, UpdatedState, create_state_table
+
+FUNCS = '''from sqlalchemy import text
+from ts_soup import common, db_operator, Source, TargetTable
+
+
+def _state_rows():
+    with common.USABLE_DBS['targets_default'].connect() as conn:
+        return conn.execute(text('select count(*) from updated_state')).scalar()
+
+
+def _sync(executor):
+    # 记录方法执行时updated_state中已写入的行数
+    STATE_ROWS.append(_state_rows())
+    executor.value.append(executor.source_data[0])
+
+
+STATE_ROWS = []
+'''
+
+FUNC = '''
+
+@db_operator(sources=[Source(tb='src')], targets=[TargetTable(tb='{name}')])
+def {name}(executor):
+    _sync(executor)
+'''
+
+TABLES = ['st_a', 'st_b', 'st_c']
+
+
+@pytest.fixture(autouse=True)
+def restore_state():
+    saved = dict(common.SYNC_CONFIG)
+    before = set(common.FUNC_REGISTRY)
+    yield
+    common.SYNC_CONFIG.clear()
+    common.SYNC_CONFIG.update(saved)
+    common.STATE_WRITER = None
+    common.DATA_UPDATED_STATE = None
+    common.EXECUTE_STATE = True
+    for name in set(common.FUNC_REGISTRY) - before:
+        del common.FUNC_REGISTRY[name]
+
+
+def _state(engine):
+    return pd.read_sql('select table_name, update_date from updated_state order by table_name, update_date', engine)
+
+
+def test_flush_at_row_threshold_and_on_demand(sqlite_db):
+    create_state_table(sqlite_db)
+    writer = StateWriter(sqlite_db, durable=False, flush_rows=5, flush_seconds=3600)
+
+    writer.add('a', ['2024-06-01', '2024-06-02', '2024-06-03'])
+    # 缓存中重复的 (表, 日期) 只计一行
+    writer.add('a', ['2024-06-03'])
+    assert _state(sqlite_db).empty and writer.flushes == 0
+
+    writer.add('b', ['2024-06-01', '2024-06-02'])
+    assert len(_state(sqlite_db)) == 5 and writer.flushes == 1
+
+    writer.add('b', ['2024-06-03'])
+    assert len(_state(sqlite_db)) == 5
+    writer.flush()
+    assert len(_state(sqlite_db)) == 6
+    assert writer.report() == 'updated_state 共写入 2 次，6 行'
+
+    # 缓存为空时不写入
+    writer.flush()
+    assert writer.flushes == 2
+
+
+def test_rewriting_dates_upserts(sqlite_db):
+    create_state_table(sqlite_db)
+    writer = StateWriter(sqlite_db, durable=True)
+    writer.add('a', ['2024-06-01', '2024-06-02'])
+    writer.add('a', ['2024-06-02', '2024-06-03'])
+    writer.add('b', ['2024-06-02'])
+
+    assert _state(sqlite_db).values.tolist() == [['a', '2024-06-01'], ['a', '2024-06-02'],
+                                                 ['a', '2024-06-03'], ['b', '2024-06-02']]
+    assert writer.flushes == 3
+
+
+def test_bitset_matches_table_after_flush(sqlite_db):
+    create_state_table(sqlite_db)
+    writer = StateWriter(sqlite_db, durable=False, flush_rows=1000, flush_seconds=3600)
+    dates = pd.date_range('2024-06-01', '2024-06-10').strftime('%Y-%m-%d').tolist()
+    state = UpdatedState(dates)
+    # 不连续的日期，以及同步期间外的日期
+    synced = {'a': dates[:3] + dates[5:7] + dates[9:], 'b': dates[4:5] + ['2024-06-11']}
+    for name, values in synced.items():
+        writer.add(name, values)
+        state.mark_synced(name, values)
+    writer.flush()
+
+    stored = UpdatedState.from_database(sqlite_db, list(synced), dates[0], dates[-1])
+    assert stored.bits == state.bits
+    assert stored.pending_dates('a') == [dates[3], dates[4], dates[7], dates[8]]
+    assert stored.pending_dates('b') == dates[:4] + dates[5:]
+
+
+@pytest.fixture
+def funcs_dir(tmp_path):
+    module = f'state_funcs_{uuid.uuid4().hex[:8]}'
+    path = tmp_path / 'funcs'
+    path.mkdir()
+    with open(path / f'{module}.py', 'w', encoding='utf8') as f:
+        f.write(FUNCS + ''.join(FUNC.format(name=name) for name in TABLES))
+    yield str(path), module
+    sys.modules.pop(module, None)
+    if str(path) in sys.path:
+        sys.path.remove(str(path))
+
+
+def test_run_sync_buffers_state_until_threshold_and_end(sqlite_db, funcs_dir, monkeypatch):
+    path, module = funcs_dir
+    db_infos = {'sources': [{'alias': 'src', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [sqlite_db]}],
+                'targets': [{'alias': 'tgt', 'default': True, 'engine_type': ['sqlalchemy'], 'engine': [sqlite_db]}]}
+
+    with sqlite_db.begin() as conn:
+        for name in TABLES:
+            conn.execute(text(f'create table {name} as select * from src where 1=0'))
+
+    def sync(*args):
+        monkeypatch.setattr(sys, 'argv', ['sync', '--table', *TABLES, *args])
+        run_sync(db_infos, sync_start_from={'days': 9}, sync_end=datetime.datetime(2024, 6, 10), sync_delay=0,
+                 funcs_file=path, state_durable=False, state_flush_rows=15, state_flush_seconds=3600)
+
+    sync()
+    # 每个方法同步10天：st_a的10行在缓存中，st_b后达到15行一次写入，st_c的10行在同步结束时写入
+    assert sys.modules[module].STATE_ROWS == [0, 0, 20]
+    state = _state(sqlite_db)
+    assert len(state) == 30 and not state.duplicated().any()
+    assert common.STATE_WRITER.flushes == 2
+
+    # 内存中的位图与updated_state一致
+    dates = pd.date_range('2024-06-01', '2024-06-10').strftime('%Y-%m-%d')
+    stored = UpdatedState.from_database(sqlite_db, TABLES, '2024-06-01', '2024-06-10')
+    assert stored.bits == common.DATA_UPDATED_STATE.bits == {name: (1 << len(dates)) - 1 for name in TABLES}
+
+    # 重新同步指定日期，updated_state按唯一索引更新，不产生重复行
+    sync('--time', '2024-06-03', '2024-06-04')
+    assert common.STATE_WRITER.flushes == 1
+    pd.testing.assert_frame_equal(_state(sqlite_db), state)
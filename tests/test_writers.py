@@ -0,0 +1,132 @@
+import pandas as pd
+import pytest
+from sqlalchemy import inspect, text
+from ts_soup import TargetTable
+from ts_soup.workers import targets, writers
+
+DATES = ['2024-06-01', '2024-06-02', '2024-06-03']
+
+
+def _frame(dates, items, offset=0):
+    return pd.DataFrame({'date': [d for d in dates for _ in range(items)],
+                         'item_id': [i for _ in dates for i in range(items)],
+                         'value': [offset + n for n in range(len(dates) * items)]})
+
+
+def _create_table(engine, tb):
+    with engine.begin() as conn:
+        conn.execute(text(f'create table {tb} (date TEXT, item_id INTEGER, value INTEGER)'))
+        conn.execute(text(f'create unique index uk_{tb} on {tb} (date, item_id)'))
+        # 不在本次同步日期中的数据，写入后应保持不变
+        conn.execute(text(f"insert into {tb} values ('2024-05-31', 0, -1)"))
+
+
+def _rows(engine, tb):
+    return pd.read_sql(f'select date, item_id, value from {tb} order by date, item_id', engine)
+
+
+@pytest.mark.parametrize('batch_size', [1, 6, 7, 21, 22])
+def test_write_modes_match_default(sqlite_db, batch_size):
+    """
+    每个日期7行，共21行，batch_size覆盖 小于、等于、整除、等于总行数、大于总行数 的情况
+    """
+    targets = {'default': TargetTable(tb='tb_default'),
+               'multi_insert': TargetTable(tb='tb_multi_insert', write_mode='multi_insert', batch_size=batch_size),
+               'upsert': TargetTable(tb='tb_upsert', write_mode='upsert', has_unique_idx=True, batch_size=batch_size)}
+    for target in targets.values():
+        _create_table(sqlite_db, target.tb)
+
+    # 第一次写入，以及对相同日期的重新同步(值变化)
+    for offset in (0, 100):
+        updated = {mode: target.build_output(_frame(DATES, 7, offset)) for mode, target in targets.items()}
+        assert updated['multi_insert'] == updated['upsert'] == updated['default'] == DATES
+        expected = _rows(sqlite_db, 'tb_default')
+        assert len(expected) == 1 + len(DATES) * 7
+        assert expected['value'].iloc[1:].tolist() == list(range(offset, offset + len(DATES) * 7))
+        for mode in ('multi_insert', 'upsert'):
+            pd.testing.assert_frame_equal(_rows(sqlite_db, targets[mode].tb), expected)
+        assert {target.last_write_stats['rows'] for target in targets.values()} == {len(DATES) * 7}
+
+
+def _tables(engine):
+    return sorted(inspect(engine).get_table_names())
+
+
+def test_staging_swap_replaces_only_synced_dates(sqlite_db):
+    _create_table(sqlite_db, 'tb_staging')
+    target = TargetTable(tb='tb_staging', write_mode='staging', batch_size=5)
+    target.build_output(_frame(DATES, 3))
+
+    # 重新同步后两天，2024-06-02 由3行变为2行
+    assert target.build_output(_frame(DATES[1:], 2, offset=100)) == DATES[1:]
+
+    rows = _rows(sqlite_db, 'tb_staging')
+    assert rows[rows['date'] <= '2024-06-01'].values.tolist() == [['2024-05-31', 0, -1],
+                                                                  ['2024-06-01', 0, 0],
+                                                                  ['2024-06-01', 1, 1],
+                                                                  ['2024-06-01', 2, 2]]
+    assert rows[rows['date'] > '2024-06-01'].values.tolist() == [['2024-06-02', 0, 100],
+                                                                 ['2024-06-02', 1, 101],
+                                                                 ['2024-06-03', 0, 102],
+                                                                 ['2024-06-03', 1, 103]]
+    assert not [i for i in _tables(sqlite_db) if '__stg_' in i]
+
+
+def test_staging_swap_drops_staging_when_load_fails(sqlite_db, monkeypatch):
+    _create_table(sqlite_db, 'tb_staging')
+    target = TargetTable(tb='tb_staging', write_mode='staging')
+    target.build_output(_frame(DATES, 3))
+    before = _rows(sqlite_db, 'tb_staging')
+
+    def fail(conn, cur_result, tb, batch_size):
+        assert '__stg_' in tb and tb in _tables(sqlite_db)
+        raise RuntimeError('load failed')
+
+    monkeypatch.setattr(writers, 'insert_multi', fail)
+    with pytest.raises(RuntimeError, match='load failed'):
+        target.build_output(_frame(DATES, 2, offset=100))
+
+    pd.testing.assert_frame_equal(_rows(sqlite_db, 'tb_staging'), before)
+    assert not [i for i in _tables(sqlite_db) if '__stg_' in i]
+
+
+def test_month_shards_and_union_view(sqlite_db, monkeypatch):
+    # 每个用例使用新的数据库文件，不沿用本进程内已确认存在的分表
+    monkeypatch.setattr(targets, '_CREATED_SHARDS', set())
+    _create_table(sqlite_db, 'tb_shard')
+    target = TargetTable(tb='tb_shard', shard_by='month', union_view=True)
+
+    dates = ['2024-06-29', '2024-06-30', '2024-07-01']
+    assert target.build_output(_frame(dates, 2)) == dates
+    assert [i for i in _tables(sqlite_db) if i.startswith('tb_shard_')] == ['tb_shard_202406', 'tb_shard_202407']
+    assert _rows(sqlite_db, 'tb_shard_202406')['date'].tolist() == ['2024-06-29'] * 2 + ['2024-06-30'] * 2
+    assert _rows(sqlite_db, 'tb_shard_202407')['date'].tolist() == ['2024-07-01'] * 2
+    # 模板表中的数据不写入分表，数据也不写入模板表
+    assert _rows(sqlite_db, 'tb_shard').values.tolist() == [['2024-05-31', 0, -1]]
+
+    # 分表复制了模板表的唯一索引
+    for shard in ('tb_shard_202406', 'tb_shard_202407'):
+        with sqlite_db.connect() as conn:
+            ddl = conn.execute(text("select name, sql from sqlite_master where type = 'index' and tbl_name = :tb"),
+                               {'tb': shard}).fetchall()
+        assert [(name, ' '.join(sql.split())) for name, sql in ddl] == \
+               [(f'uk_tb_shard__{shard}', f'CREATE UNIQUE INDEX uk_tb_shard__{shard} ON {shard} (date, item_id)')]
+    with pytest.raises(Exception):
+        with sqlite_db.begin() as conn:
+            conn.execute(text("insert into tb_shard_202407 values ('2024-07-01', 0, 0)"))
+
+    pd.testing.assert_frame_equal(_rows(sqlite_db, 'tb_shard_all'),
+                                  pd.concat([_rows(sqlite_db, 'tb_shard_202406'), _rows(sqlite_db, 'tb_shard_202407')],
+                                            ignore_index=True))
+
+    # 重新同步跨月的日期只替换对应分表中的数据，没有新分表
+    target.build_output(_frame(['2024-06-30', '2024-07-01'], 1, offset=100))
+    assert _rows(sqlite_db, 'tb_shard_all').values.tolist() == [['2024-06-29', 0, 0], ['2024-06-29', 1, 1],
+                                                                ['2024-06-30', 0, 100], ['2024-07-01', 0, 101]]
+
+    # 出现新的分表时重建视图
+    target.build_output(_frame(['2024-08-01'], 1, offset=200))
+    assert [i for i in _tables(sqlite_db) if i.startswith('tb_shard_')] == \
+           ['tb_shard_202406', 'tb_shard_202407', 'tb_shard_202408']
+    assert _rows(sqlite_db, 'tb_shard_all')['date'].tolist() == ['2024-06-29', '2024-06-29', '2024-06-30',
+                                                                 '2024-07-01', '2024-08-01']
@@ -1,5 +1,5 @@
 from ts_soup.app import run_sync
-from ts_soup.common import db_operator,BaseSource,BaseTarget,query_in_sql
+from ts_soup.common import db_operator,BaseSource,BaseTarget,query_in_sql,date_predicate
 from ts_soup.workers import Source,RawSqlSource,MultiSource,TargetTable
 
 
@@ -12,5 +12,6 @@ __all__ = [
     'MultiSource',
     'BaseSource',
     'BaseTarget',
-    'query_in_sql'
+    'query_in_sql',
+    'date_predicate'
 ]
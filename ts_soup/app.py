@@ -1,44 +1,218 @@
 import argparse
 import datetime
-import importlib
+import hashlib
 import os
-import sys
 from typing import Optional
 from dateutil.relativedelta import relativedelta
+from ts_soup.async_executor import AsyncPipeline
+from ts_soup.common import __init
+from ts_soup.daemon import SyncDaemon
+from ts_soup.instrument import RECORDER
+from ts_soup.lease import LeaseWorker
+from ts_soup.planner import SyncPlanner
+from ts_soup.registry import load_funcs
+from ts_soup.scheduler import DagScheduler
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--table', default=[], nargs='+')
 parser.add_argument('--time', default=[], nargs='+')
-args = parser.parse_args()
+# 对指定的方法开启cProfile和tracemalloc
+parser.add_argument('--profile', default=[], nargs='+')
+parser.add_argument('--profile-dir', default=None)
+# 只输出同步计划，不执行同步
+parser.add_argument('--plan', action='store_true')
 
-from ts_soup.common import __init
+
+def parse_args():
+    # 只解析ts_soup的参数，在其他程序中调用run_sync时忽略其余参数
+    args, _ = parser.parse_known_args()
+    return args
 
 
 def run_sync(db_infos: dict,
              sync_start_from: Optional[dict] = None,
              sync_end:Optional[datetime.datetime] = None,
              sync_delay: int = 1,
-             funcs_file: str = 'funcs'
+             funcs_file: str = 'funcs',
+             max_workers: int = 1,
+             db_concurrency: Optional[dict] = None,
+             change_detection: bool = False,
+             source_cache_mb: Optional[int] = None,
+             cache_spill_dir: Optional[str] = None,
+             batch_days: Optional[int] = None,
+             batch_rows: Optional[int] = None,
+             use_async: bool = False,
+             pipeline_depth: int = 2,
+             db_inflight: Optional[dict] = None,
+             metrics_jsonl: Optional[str] = None,
+             metrics_prom: Optional[str] = None,
+             lease_sync: bool = False,
+             lease_run_id: Optional[str] = None,
+             lease_days: int = 7,
+             lease_seconds: int = 600,
+             fetch_backend: str = 'pandas',
+             checkpoint_dir: Optional[str] = None,
+             checkpoint_ttl_hours: float = 24,
+             shard_concurrency: Optional[dict] = None,
+             probe_dates: bool = False,
+             daemon: bool = False,
+             poll_seconds: float = 60,
+             full_sync_minutes: float = 60,
+             state_durable: bool = True,
+             state_flush_rows: int = 1000,
+             state_flush_seconds: float = 30,
+             dry_run: bool = False,
+             lpt_order: bool = False,
+             plan_history: Optional[str] = None,
+             plan_count_rows: bool = False
              ):
+    """
+    同步程序入口
+    :param db_infos: 数据库配置，每个数据库可以传入已创建的engine，或传入url由ts_soup创建并管理连接池：
+            {'alias': ..., 'default': ..., 'engine_type': ['sqlalchemy', 'pymysql'], 'url': 'mysql+pymysql://...',
+             'pool': {'pool_size': 5, 'max_overflow': 10, 'pre_ping': True, 'prewarm': 1, ...}}，见pool.DEFAULT_POOL，
+            同步结束时输出各连接池取连接的次数与等待时间
+    :param sync_start_from: 同步开始时间距离同步结束时间的间隔，relativedelta参数，默认 {'months': 3}
+    :param sync_end: 同步结束时间，默认为当前时间加 sync_delay 天
+    :param sync_delay: 未指定sync_end时，同步结束时间距离当前时间的天数
+    :param funcs_file: funcs模块所在文件夹
+    :param max_workers: 同时执行的方法数，大于1时按依赖关系并发执行，默认顺序执行；
+            执行方式 daemon、lease_sync、use_async、max_workers>1 只能选择一种
+    :param db_concurrency: 并发执行时每个数据库别名上同时执行的方法数上限，如 {'targets_default': 4}
+    :param change_detection: 变更检测，数据源指纹(见Source的watermark_field)未变化的日期不再读取，
+            目标表内容指纹未变化的日期不再写入，指纹记录在updated_fingerprint表
+    :param source_cache_mb: 开启数据源查询结果缓存，多个方法查询相同的数据源时只读取一次，值为缓存的内存上限(MB)
+    :param cache_spill_dir: 缓存超出内存上限时落盘的目录，默认使用临时目录
+    :param batch_days: 分批同步，每批最多的天数，每批单独提交并写入updated_state，中断后从未完成的批次继续，
+            适用于sync_start_from较大的补数
+    :param batch_rows: 分批同步，每批最多的预估行数(根据empty_check数据源的count估算)
+    :param use_async: 使用asyncio流水线执行，同一方法的数据源并发读取，并在写入当前方法时提前读取后续方法的数据源
+    :param pipeline_depth: 流水线执行时最多提前读取的批次数
+    :param db_inflight: 流水线执行时每个数据库别名上同时执行的查询/写入数上限，如 {'sources_default': 4}
+    :param metrics_jsonl: 记录各方法每个阶段(读取数据源、方法执行、写入目标表、updated_state)耗时、行数、内存的JSON lines文件
+    :param metrics_prom: 各阶段汇总指标写入的Prometheus textfile
+    :param lease_sync: 多实例同步，多个run_sync进程(可在不同机器)通过目标库的sync_lease表领取 (方法, 日期窗口) 任务，
+            实例崩溃后其领取的任务由其他实例重新执行，见LeaseWorker
+    :param lease_run_id: 多实例同步的标识，所有实例必须相同，默认根据同步期间(或--time的日期)生成
+    :param lease_days: 多实例同步时每个任务的日期窗口天数
+    :param lease_seconds: 多实例同步时租约的有效时间，实例超过该时间未续期视为已崩溃
+    :param fetch_backend: 数据源的读取方式，pandas：pd.read_sql逐行读取；arrow：使用connectorx读入arrow列式内存后转换，
+            日期列为datetime64，decimal列为float64，未安装connectorx时使用pandas，见fetch.FETCH_BACKENDS；
+            各数据源的dtypes、downcast参数可以进一步指定列类型以降低内存
+    :param checkpoint_dir: 开启数据源检查点，各方法的数据源读取结果写入该目录，方法执行失败后重新同步时直接读取，
+            不再查询数据源，写入成功后删除；--time指定日期的同步不使用检查点
+    :param checkpoint_ttl_hours: 检查点的有效期(小时)
+    :param shard_concurrency: 数据源分段并发读取(见Source的read_shards)时，每个数据库别名上同时执行的查询数上限，
+            如 {'sources_default': 8}，多个数据源、多个方法同时分段读取时共用该上限
+    :param probe_dates: 读取数据源前先按日期探测empty_check数据源是否有数据(select distinct 日期字段)，
+            只读取所有数据源都有数据的日期，其余日期保持未同步，适用于上游数据经常延迟到达的情况；
+            注意开启后，只有部分数据源有数据的日期也不会同步
+    :param daemon: 常驻同步，进程内保持数据库连接、方法和同步状态，每 poll_seconds 秒轮询数据源水位，只同步有变化的表和日期，
+            收到SIGTERM/SIGINT后退出，见SyncDaemon；不能与sync_end、--time同时使用
+    :param poll_seconds: 常驻同步时轮询数据源水位的间隔(秒)
+    :param full_sync_minutes: 常驻同步时，数据源不支持水位查询的方法按未同步日期同步的间隔(分钟)
+    :param state_durable: 每个方法写入目标表后立即写入updated_state；为False时缓存已同步的日期，
+            达到state_flush_rows行或超过state_flush_seconds秒时以一条多行upsert写入，同步结束时写入剩余部分，
+            减少大量方法同时写入updated_state的事务数，进程崩溃时未写入的日期下次重新同步，见StateWriter
+    :param state_flush_rows: state_durable为False时，updated_state缓存的最大行数
+    :param state_flush_seconds: state_durable为False时，updated_state缓存的最长时间(秒)
+    :param dry_run: 只输出同步计划(每个方法未同步的天数、预估数据源行数和耗时)，不执行同步，返回计划，见SyncPlanner；
+            也可以使用命令行参数 --plan
+    :param lpt_order: 按同步计划的预估耗时排序，在满足依赖关系的前提下最耗时的方法(及其后续方法)先执行，并输出同步计划
+    :param plan_history: 估算耗时使用的历史记录，默认为metrics_jsonl
+    :param plan_count_rows: 同步计划中，数据库不支持EXPLAIN估算行数时，使用count(*)统计数据源行数(需要扫描数据源)
+    命令行参数 --profile 方法名 可对指定方法开启cProfile和tracemalloc，结果写入 --profile-dir
+    """
+    modes = [name for name, enabled in (('daemon', daemon), ('lease_sync', lease_sync), ('use_async', use_async),
+                                         ('max_workers>1', max_workers > 1)) if enabled]
+    if len(modes) > 1:
+        raise ValueError(f'执行方式只能选择一种，同时设置了：{",".join(modes)}')
     sync_start_from = sync_start_from or {'months': 3}
+    if daemon and sync_end is not None:
+        raise ValueError('常驻同步的同步期间随当前时间移动，不能指定sync_end')
     sync_end = sync_end or (datetime.datetime.now() + relativedelta(days=sync_delay))
     sync_start = (sync_end - relativedelta(**sync_start_from)).strftime('%Y-%m-%d')
     sync_end = sync_end.strftime('%Y-%m-%d')
-    to_update_tables = __init(args.table, args.time, sync_start, sync_end, db_infos)
+    args = parse_args()
+    dry_run = dry_run or args.plan
+    if daemon and dry_run:
+        raise ValueError('常驻同步不支持dry_run')
+    # dry_run不记录指标
+    RECORDER.configure(jsonl_path=None if dry_run else metrics_jsonl, prom_path=None if dry_run else metrics_prom,
+                       profile_tables=args.profile, profile_dir=args.profile_dir)
+    to_update_tables = __init(args.table, args.time, sync_start, sync_end, db_infos,
+                              sync_config={'change_detection': change_detection,
+                                           'source_cache_mb': source_cache_mb,
+                                           'cache_spill_dir': cache_spill_dir,
+                                           'batch_days': batch_days,
+                                           'batch_rows': batch_rows,
+                                           'fetch_backend': fetch_backend,
+                                           'checkpoint_dir': checkpoint_dir,
+                                           'checkpoint_ttl_hours': checkpoint_ttl_hours,
+                                           'shard_concurrency': shard_concurrency or {},
+                                           'probe_dates': probe_dates,
+                                           'state_durable': state_durable,
+                                           'state_flush_rows': state_flush_rows,
+                                           'state_flush_seconds': state_flush_seconds},
+                              dry_run=dry_run)
+
+    funcs_dir = os.path.join(os.getcwd(), funcs_file)
+    if daemon:
+        if args.time:
+            raise ValueError('常驻同步不支持--time')
+        SyncDaemon(funcs_dir, sync_start_from, sync_delay, args.table,
+                   poll_seconds=poll_seconds, full_sync_minutes=full_sync_minutes).run()
+    else:
+        # 只导入本次需要同步的表所在的模块
+        funcs = load_funcs(funcs_dir, list(to_update_tables))
+        if dry_run or lpt_order:
+            planner = SyncPlanner(funcs, history_jsonl=plan_history or metrics_jsonl, count_rows=plan_count_rows)
+            print(planner.report())
+            funcs = planner.lpt_order()
+
+        if dry_run:
+            plan = planner.items
+        elif lease_sync:
+            if not lease_run_id:
+                lease_run_id = f'{sync_start}~{sync_end}' if not args.time else \
+                    'time-' + hashlib.md5(','.join(sorted(args.time)).encode()).hexdigest()[:16]
+            LeaseWorker(funcs, lease_run_id, lease_days=lease_days, lease_seconds=lease_seconds,
+                        forced=len(args.time) > 0).run()
+        elif use_async:
+            AsyncPipeline(funcs, pipeline_depth=pipeline_depth, db_inflight=db_inflight).run()
+        elif max_workers > 1:
+            DagScheduler(funcs, max_workers=max_workers, db_concurrency=db_concurrency).run()
+        else:
+            for func in funcs:
+                func()
+
+    from ts_soup import common
+    try:
+        common.STATE_WRITER.flush()
+    except Exception:
+        import traceback
+        print('updated_state 写入失败')
+        print(traceback.format_exc())
+        common.EXECUTE_STATE = False
+    if not state_durable and not dry_run:
+        print(common.STATE_WRITER.report())
+
+    if common.SOURCE_CACHE is not None:
+        print(common.SOURCE_CACHE.report())
+        common.SOURCE_CACHE.clear()
+        common.SOURCE_CACHE = None
 
-    cwd = os.getcwd()  # 手动导包
-    sys.path.append(os.path.join(cwd, funcs_file))
-    modules = []
-    for file in os.listdir(os.path.join(cwd, funcs_file)):
-        modules.append(importlib.import_module(file.split('.')[0]))
+    from ts_soup.pool import pool_report
+    report = pool_report()
+    if report:
+        print(report)
 
-    for table in to_update_tables:  # 执行funcs_name下模块的方法
-        for module in modules:
-            if table in dir(module):
-                getattr(module, table)()
+    RECORDER.close()
+    if dry_run:
+        return plan
 
     from ts_soup.common import EXECUTE_STATE  # 检测是否异常
-    if not EXECUTE_STATE:
+    if not EXECUTE_STATE and not daemon:
         raise Exception("同步异常")
 
 
@@ -0,0 +1,136 @@
+import asyncio
+import traceback
+from ts_soup import common
+from ts_soup.common import Executor
+from ts_soup.instrument import RECORDER
+from ts_soup.scheduler import topological_order
+
+
+class AsyncPipeline:
+    """
+    基于asyncio的流水线执行器，每个方法的处理结果与顺序执行相同：
+        1、一个方法的所有数据源并发读取
+        2、当前方法执行并写入目标表时，提前读取后续方法的数据源，最多提前 pipeline_depth 个批次
+        3、db_inflight 限制每个数据库别名上同时执行的查询/写入数，如 {'sources_default': 4}
+        4、方法依赖的方法(见db_operator的depends_on)写入完成后，才开始读取该方法的数据源
+    数据库驱动为同步接口，查询和写入通过 asyncio.to_thread 在线程中执行
+    """
+
+    def __init__(self, funcs, pipeline_depth: int = 2, db_inflight: dict = None):
+        self.funcs, self.dependencies = topological_order(funcs)
+        self.pipeline_depth = pipeline_depth
+        self.db_inflight = db_inflight or {}
+        self.semaphores = {}
+        self.results = {}
+
+    def run(self):
+        """
+        :return: {方法名: 是否同步成功}
+        """
+        asyncio.run(self.__run())
+        return self.results
+
+    async def __run(self):
+        queue = asyncio.Queue(maxsize=self.pipeline_depth)
+        done = {func.__name__: asyncio.Event() for func in self.funcs}
+        await asyncio.gather(self.__produce(queue, done), self.__consume(queue, done))
+
+    async def __with_db(self, db_strs, func, *args):
+        # 按别名顺序获取信号量，避免多个任务互相等待
+        semaphores = []
+        for db_str in sorted(set(db_strs)):
+            if db_str in self.db_inflight:
+                semaphores.append(self.semaphores.setdefault(db_str, asyncio.Semaphore(self.db_inflight[db_str])))
+        for semaphore in semaphores:
+            await semaphore.acquire()
+        try:
+            return await asyncio.to_thread(func, *args)
+        finally:
+            for semaphore in semaphores:
+                semaphore.release()
+
+    @staticmethod
+    def __prepare(func):
+        executor = Executor(targets=func.targets,
+                            sources=func.sources,
+                            executed_table=func.__name__,
+                            chunk_safe=func.chunk_safe)
+        executor.trim_unchanged_date()
+        executor.trim_empty_date()
+        if len(executor.to_update_date) == 0:
+            print(f'{func.__name__} 方法已同步至最新\n\n')
+            return []
+        return executor.split_batches()
+
+    async def __read(self, func, executor):
+        # 设置了chunksize的数据源返回生成器，在执行阶段按块读取
+        datas = await asyncio.gather(*[self.__with_db([source.db_str], executor.read_source, source)
+                                       for source in func.sources])
+        # 分块数据源在接收时开始查询(判空读取第一块，非chunk_safe时读取全部)，不能在事件循环的线程中执行
+        await self.__with_db([source.db_str for source in func.sources], executor.accept_source_data, datas)
+
+    async def __produce(self, queue, done):
+        for func in self.funcs:
+            name = func.__name__
+            deps = self.dependencies[name]
+            for dep in deps:
+                await done[dep].wait()
+            if not all(self.results.get(dep) for dep in deps):
+                print(f'{name} 依赖的方法同步失败，未执行')
+                self.results[name] = False
+                done[name].set()
+                continue
+
+            try:
+                batches = await asyncio.to_thread(self.__prepare, func)
+            except Exception:
+                self.__fail(name)
+                self.results[name] = False
+                done[name].set()
+                continue
+            if not batches:
+                self.results[name] = True
+                done[name].set()
+                continue
+
+            for index, batch in enumerate(batches):
+                try:
+                    await self.__read(func, batch)
+                except Exception as e:
+                    await queue.put((func, e, True))
+                    break
+                await queue.put((func, batch, index == len(batches) - 1))
+        await queue.put(None)
+
+    async def __consume(self, queue, done):
+        failed = set()
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            func, batch, is_last = item
+            name = func.__name__
+            if name not in failed:
+                try:
+                    if isinstance(batch, Exception):
+                        raise batch
+                    print(f'{name} 开始写入：{batch.to_update_date.iloc[0]} ~ {batch.to_update_date.iloc[-1]}')
+                    await self.__with_db([target.db_str for target in func.targets], self.__execute, func, batch)
+                except Exception:
+                    failed.add(name)
+                    self.__fail(name)
+            if is_last:
+                self.results[name] = name not in failed
+                done[name].set()
+
+    @staticmethod
+    def __execute(func, executor):
+        with RECORDER.profile(func.__name__):
+            executor.execute(func.func)
+
+    @staticmethod
+    def __fail(name):
+        # 与db_operator的异常处理一致
+        common.EXECUTE_STATE = False
+        print(name + '同步失败')
+        print(traceback.format_exc())
@@ -1,9 +1,21 @@
+import datetime
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
 import warnings
 from abc import abstractmethod, ABC
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from functools import wraps
 import traceback
-from sqlalchemy import text
+from sqlalchemy import inspect, text
+from ts_soup.instrument import RECORDER
 
 warnings.filterwarnings('ignore')
 
@@ -13,14 +25,172 @@ USABLE_DBS = {}
 # 同步程序执行情况
 EXECUTE_STATE = True
 
-# 记录每个表的更新状况的矩阵，全局对象
+# 记录每个表的更新状况的位图，全局对象，见UpdatedState
 DATA_UPDATED_STATE = None
 
+# 本次同步的配置，由run_sync传入
+#   change_detection: 是否根据数据指纹跳过未变化的日期
+#   source_cache_mb: 数据源查询结果缓存的内存上限(MB)，None表示不缓存
+#   cache_spill_dir: 缓存超出内存上限时落盘的目录，默认使用临时目录
+#   batch_days: 分批同步时每批最多的天数，None表示不分批
+#   batch_rows: 分批同步时每批最多的预估行数(根据empty_check数据源的count估算)，None表示不按行数分批
+#   fetch_backend: 数据源的读取方式，见fetch.FETCH_BACKENDS
+#   checkpoint_dir: 数据源读取结果检查点的目录，None表示不使用检查点
+#   checkpoint_ttl_hours: 检查点的有效期(小时)
+#   shard_concurrency: 数据源分段并发读取时每个数据库别名上同时执行的查询数上限，如 {'sources_default': 8}
+#   probe_dates: 读取数据源前，先探测empty_check数据源每个日期是否有数据，只读取所有数据源都有数据的日期
+#   state_durable: 每个方法写入目标表后立即写入updated_state，为False时由STATE_WRITER缓存后合并写入
+#   state_flush_rows: updated_state缓存达到该行数时写入
+#   state_flush_seconds: updated_state缓存距离上次写入超过该秒数时写入
+SYNC_CONFIG = {
+    'change_detection': False,
+    'source_cache_mb': None,
+    'cache_spill_dir': None,
+    'batch_days': None,
+    'batch_rows': None,
+    'fetch_backend': 'pandas',
+    'checkpoint_dir': None,
+    'checkpoint_ttl_hours': 24,
+    'shard_concurrency': {},
+    'probe_dates': False,
+    'state_durable': True,
+    'state_flush_rows': 1000,
+    'state_flush_seconds': 30,
+}
+
+# 本次同步内共享的数据源查询结果缓存，见SourceCache
+SOURCE_CACHE = None
+
+# 数据源读取结果的检查点，见CheckpointStore
+CHECKPOINT_STORE = None
+
+# updated_state的写入，见StateWriter
+STATE_WRITER = None
+
+# db_operator装饰的方法，方法名 -> 方法
+FUNC_REGISTRY = {}
+
+# pymysql的连接不是线程安全的，并发执行时同一连接上的操作需要串行
+_PYM_LOCKS = {}
+_PYM_LOCKS_GUARD = threading.Lock()
+
+# 数据源分段并发读取时，每个数据库别名的并发数限制，见SYNC_CONFIG的shard_concurrency
+_SHARD_SEMAPHORES = {}
+_SHARD_SEMAPHORES_GUARD = threading.Lock()
+
 
 def query_in_sql(list_):
     return ','.join(list(map(lambda x: '"' + x + '"', list_)))
 
 
+def _format_date(value):
+    """
+    date、datetime、Timestamp、datetime64转为 yyyy-mm-dd，其余值转为字符串
+    str(Timestamp)带有时间部分，与date类型或 yyyy-mm-dd 字符串的字段按文本比较时不相等
+    """
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+    return str(value)
+
+
+def _to_day(value):
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def date_predicate(field, dates, prefix='d'):
+    """
+    生成日期筛选条件，代替 in ({query_in_sql(...)}) 的写法：
+        连续的日期合并为 field between :start and :end，零散的日期使用 field in (...)，日期均以绑定参数传入
+    日期字段需要是date类型或 yyyy-mm-dd 格式的字符串，与 in 列表筛选的结果相同；无法解析为日期的值全部使用 in
+    :param field: 日期字段
+    :param dates: 日期列表(或Series)，date、Timestamp等日期类型的值按 yyyy-mm-dd 传入
+    :param prefix: 绑定参数名前缀，同一语句中使用多个条件时需要不同
+    :return: (条件语句, 绑定参数字典)，语句需要配合 sqlalchemy.text 使用
+    """
+    values = sorted(set(_format_date(i) for i in dates))
+    if not values:
+        return '1=0', {}
+
+    days = [_to_day(i) for i in values]
+    ranges, scattered = [], []
+    if all(days):
+        start = end = 0
+        for index in range(1, len(days) + 1):
+            if index < len(days) and (days[index] - days[end]).days == 1:
+                end = index
+                continue
+            if end > start:
+                ranges.append((values[start], values[end]))
+            else:
+                scattered.append(values[start])
+            start = end = index
+    else:
+        scattered = values
+
+    clauses, params = [], {}
+    for index, (start, end) in enumerate(ranges):
+        params[f'{prefix}_s{index}'] = start
+        params[f'{prefix}_e{index}'] = end
+        clauses.append(f'{field} between :{prefix}_s{index} and :{prefix}_e{index}')
+    if scattered:
+        names = []
+        for index, value in enumerate(scattered):
+            params[f'{prefix}_{index}'] = value
+            names.append(f':{prefix}_{index}')
+        clauses.append(f'{field} in ({",".join(names)})')
+    return '(' + ' or '.join(clauses) + ')', params
+
+
+def pym_lock(conn):
+    """
+    获取pymysql连接对应的锁，多个target共用同一个连接时在并发模式下保证操作串行
+    :param conn: pymysql连接
+    :return: threading.Lock
+    """
+    with _PYM_LOCKS_GUARD:
+        return _PYM_LOCKS.setdefault(id(conn), threading.Lock())
+
+
+@contextmanager
+def pym_connection(db_pym):
+    """
+    取得执行replace into等语句的pymysql连接：
+        由ts_soup管理的连接池(db_infos中配置了url)，每次从池中取出一个连接，用完归还，取出时检测连接是否可用
+        用户传入的单个pymysql连接，加锁后串行使用
+    """
+    if hasattr(db_pym, 'raw_connection'):
+        conn = db_pym.raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+    else:
+        with pym_lock(db_pym):
+            yield db_pym
+
+
+def db_key(engine):
+    """
+    数据库连接的标识，同一个库注册为不同别名(如同时作为sources和targets)时也能识别为同一个库
+    """
+    url = getattr(engine, 'url', None)
+    return str(url) if url is not None else id(engine)
+
+
+def shard_semaphore(db_str):
+    """
+    获取数据库别名对应的分段读取信号量，未限制并发数时返回None
+    """
+    limit = SYNC_CONFIG['shard_concurrency'].get(db_str)
+    if not limit:
+        return None
+    with _SHARD_SEMAPHORES_GUARD:
+        return _SHARD_SEMAPHORES.setdefault((db_str, limit), threading.BoundedSemaphore(limit))
+
+
 def get_sqlalchemy_engine(db_info, db_type,engine_index):
     global USABLE_DBS
     engine = db_info['engine'][engine_index]
@@ -37,7 +207,351 @@ def get_pymsql_engine(db_info, db_type,engine_index):
         USABLE_DBS[f'{db_type}_default_pym'] = engine
 
 
-def __init(customized_table, customized_time, sync_start, sync_end, db_infos):
+def write_frame(data, path):
+    """
+    DataFrame落盘，安装了pyarrow时使用feather格式(可内存映射读取)，否则使用pickle
+    :return: 实际写入的文件路径
+    """
+    try:
+        import pyarrow.feather as feather
+        import pyarrow as pa
+    except ImportError:
+        data.to_pickle(path + '.pkl')
+        return path + '.pkl'
+    table = pa.Table.from_pandas(data.reset_index(drop=True), preserve_index=False)
+    feather.write_feather(table, path + '.feather')
+    return path + '.feather'
+
+
+def read_frame(path):
+    """
+    读取write_frame写入的文件，feather格式使用内存映射读取
+    """
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    import pyarrow.feather as feather
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+class SourceCache:
+    """
+    一次同步内多个方法共享的数据源查询结果缓存：
+        1、以 数据库别名 + 规范化后的查询语句 + 绑定参数(包含日期) 为key
+        2、超出内存上限时按LRU淘汰，淘汰的结果写入磁盘，再次命中时从磁盘读取
+        3、存入和取出时都复制DataFrame，方法中修改数据源不会影响缓存
+    """
+
+    def __init__(self, memory_mb, spill_dir=None):
+        self.budget = memory_mb * 1024 * 1024
+        self.spill_dir = tempfile.mkdtemp(prefix='ts_soup_cache_', dir=spill_dir)
+        self.frames = OrderedDict()
+        self.sizes = {}
+        self.spilled = {}
+        self.memory = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'spills': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(db_str, sql, params=None):
+        sql = ' '.join(str(sql).split())
+        params = sorted((str(k), str(v)) for k, v in (params or {}).items())
+        return hashlib.md5(repr((db_str, sql, params)).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.frames[key].copy()
+            path = self.spilled.get(key)
+            if path is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+        return read_frame(path)
+
+    def put(self, key, data):
+        data = data.copy()
+        size = int(data.memory_usage(deep=True).sum())
+        with self.lock:
+            if key in self.frames:
+                return
+            self.frames[key] = data
+            self.sizes[key] = size
+            self.memory += size
+            while self.memory > self.budget and len(self.frames) > 1:
+                self.__spill_oldest()
+
+    def __spill_oldest(self):
+        key, data = self.frames.popitem(last=False)
+        self.memory -= self.sizes.pop(key)
+        if key not in self.spilled:
+            # clear后(如常驻同步每次轮询结束)落盘目录已删除
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spilled[key] = write_frame(data, os.path.join(self.spill_dir, key))
+            self.stats['spills'] += 1
+
+    def report(self):
+        total = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        hit_rate = (self.stats['hits'] + self.stats['disk_hits']) / total if total else 0
+        return (f'数据源缓存：命中 {self.stats["hits"]} 次，磁盘命中 {self.stats["disk_hits"]} 次，'
+                f'未命中 {self.stats["misses"]} 次，落盘 {self.stats["spills"]} 次，命中率 {hit_rate:.1%}，'
+                f'内存占用 {self.memory / 1024 / 1024:.1f}MB')
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.sizes.clear()
+            self.spilled.clear()
+            self.memory = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class CheckpointStore:
+    """
+    数据源读取结果的检查点：
+        1、每个方法的数据源读取结果以 方法名 + 数据源配置 + 日期 为key写入本地文件(见write_frame)
+        2、方法执行失败时保留，重新执行(下次同步、--table重跑)时在有效期内直接内存映射读取，不再查询数据库
+        3、方法执行并写入成功后删除；超过有效期的文件在初始化时清理
+    分块读取(chunksize)的数据源不写检查点，--time指定日期的同步不使用检查点
+    """
+
+    def __init__(self, directory, ttl_hours=24):
+        self.directory = directory
+        self.ttl = ttl_hours * 3600
+        os.makedirs(directory, exist_ok=True)
+        self.__clear_expired()
+
+    @staticmethod
+    def make_key(table, source, dates):
+        # 数据源配置中的简单类型参数(表名、字段、条件、sql等)，不包含连接对象
+        config = sorted((k, repr(v)) for k, v in vars(source).items()
+                        if isinstance(v, (str, int, float, bool, list, dict, tuple, type(None))))
+        dates = sorted(set(str(i) for i in dates))
+        return hashlib.md5(repr((table, type(source).__name__, config, dates)).encode('utf8')).hexdigest()
+
+    def __path(self, key):
+        for suffix in ('.feather', '.pkl'):
+            path = os.path.join(self.directory, key + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def load(self, key):
+        """
+        :return: 有效期内的检查点DataFrame，没有时返回None
+        """
+        path = self.__path(key)
+        if path is None:
+            return None
+        if datetime.datetime.now().timestamp() - os.path.getmtime(path) > self.ttl:
+            os.remove(path)
+            return None
+        return read_frame(path)
+
+    def save(self, key, data):
+        try:
+            write_frame(data, os.path.join(self.directory, key))
+        except Exception as e:
+            # 无法序列化的列(如混合类型的object列)不写检查点，不影响同步
+            print(f'数据源检查点写入失败：{type(e).__name__}: {e}')
+
+    def remove(self, key):
+        path = self.__path(key)
+        if path is not None:
+            os.remove(path)
+
+    def __clear_expired(self):
+        now = datetime.datetime.now().timestamp()
+        for file in os.listdir(self.directory):
+            path = os.path.join(self.directory, file)
+            if file.endswith(('.feather', '.pkl')) and now - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+
+
+def create_state_table(engine):
+    """
+    创建数据表 updated_state，非mysql数据库(如用于测试的sqlite)使用通用的建表语句；
+    表已存在时不再执行建表语句(mysql的DDL即使if not exists也需要获取元数据锁)
+    """
+    if inspect(engine).has_table('updated_state'):
+        return
+    with engine.begin() as conn:
+        if engine.dialect.name == 'mysql':
+            conn.execute(text("""
+            CREATE TABLE if not exists `updated_state`  (
+                          `update_date` date DEFAULT NULL,
+                          `table_name` varchar(50) COLLATE utf8mb4_general_ci NOT NULL,
+                          UNIQUE KEY `index` (`update_date`,`table_name`) USING BTREE COMMENT '唯一索引'
+                        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+            """))
+        else:
+            conn.execute(text("""
+            CREATE TABLE if not exists updated_state  (
+                          update_date date DEFAULT NULL,
+                          table_name varchar(50) NOT NULL,
+                          UNIQUE (update_date, table_name)
+                        )
+            """))
+
+
+class StateWriter:
+    """
+    updated_state的写入：方法写入目标表成功后，把 (table_name, update_date) 加入缓存，
+    按唯一索引(update_date, table_name)以一条多行upsert写入，代替每个方法一个 delete + insert 的事务
+        1、durable为True时每次加入后立即写入，进程崩溃时已写入目标表的日期都已记录，与逐个方法写入一致
+        2、durable为False时缓存达到flush_rows行或距离上次写入超过flush_seconds秒时写入，同步结束时写入剩余部分；
+           进程崩溃时缓存中的日期未记录，下次同步时重新同步这些日期
+    数据源指纹(change_detection)与updated_state一同写入
+    """
+
+    def __init__(self, engine, durable=True, flush_rows=1000, flush_seconds=30):
+        self.engine = engine
+        self.durable = durable
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        # (table_name, update_date) -> None，按加入顺序去重
+        self.rows = OrderedDict()
+        # table_name -> {update_date: fingerprint}
+        self.fingerprints = {}
+        self.flushed_at = time.perf_counter()
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.lock = threading.RLock()
+
+    def add(self, table_name, dates, fingerprints=None):
+        """
+        :param table_name: 方法名
+        :param dates: 已同步的日期(yyyy-mm-dd)
+        :param fingerprints: 已同步日期的数据源指纹 {yyyy-mm-dd: fingerprint}
+        """
+        with self.lock:
+            for date in dates:
+                self.rows[(table_name, date)] = None
+            if fingerprints:
+                self.fingerprints.setdefault(table_name, {}).update(fingerprints)
+            if self.durable or len(self.rows) >= self.flush_rows or \
+                    time.perf_counter() - self.flushed_at >= self.flush_seconds:
+                self.flush()
+
+    def flush(self):
+        """
+        写入缓存的updated_state与数据源指纹，写入失败时保留缓存，下次写入时重试
+        """
+        with self.lock:
+            self.flushed_at = time.perf_counter()
+            if not self.rows and not self.fingerprints:
+                return
+            rows, fingerprints = self.rows, self.fingerprints
+            self.rows, self.fingerprints = OrderedDict(), {}
+            try:
+                self.__write(rows, fingerprints)
+            except Exception:
+                rows.update(self.rows)
+                self.rows = rows
+                for table_name, values in self.fingerprints.items():
+                    fingerprints.setdefault(table_name, {}).update(values)
+                self.fingerprints = fingerprints
+                raise
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+
+    def __write(self, rows, fingerprints):
+        from ts_soup.workers.writers import upsert
+        if rows:
+            data = pd.DataFrame(list(rows), columns=['table_name', 'update_date'])
+            with self.engine.begin() as conn:
+                upsert(conn, data, 'updated_state', 1000)
+        if fingerprints:
+            # 记录已同步日期的数据源指纹，下次数据源未变化时跳过
+            from ts_soup.fingerprint import save_fingerprints
+            for table_name, values in fingerprints.items():
+                save_fingerprints(self.engine, 'source', table_name, values)
+
+    def report(self):
+        return f'updated_state 共写入 {self.flushes} 次，{self.flushed_rows} 行'
+
+
+class UpdatedState:
+    """
+    同步期间内每个表已同步日期的位图，代替 日期×表 的updated_state透视表：
+        每个表对应一个整数，第i位为1表示同步期间内第i个日期已同步，内存与查询耗时与 表数×天数 无关
+    """
+
+    def __init__(self, dates):
+        """
+        :param dates: 同步期间的日期列表，yyyy-mm-dd
+        """
+        self.dates = list(dict.fromkeys(str(i) for i in dates))
+        self.position = {date: index for index, date in enumerate(self.dates)}
+        self.bits = {}
+
+    @classmethod
+    def from_database(cls, engine, tables, sync_start, sync_end):
+        """
+        读取updated_state，数据库中把每个表连续的已同步日期聚合为区间(gaps and islands)，只返回区间的起止日期
+        数据库不支持窗口函数时逐行读取
+        """
+        state = cls(pd.date_range(sync_start, sync_end).strftime('%Y-%m-%d'))
+        if not tables:
+            return state
+        names = {f't_{index}': table for index, table in enumerate(tables)}
+        params = dict(names, sync_start=sync_start, sync_end=sync_end)
+        where = f"update_date >= :sync_start and update_date <= :sync_end and table_name in ({','.join(':' + i for i in names)})"
+        day_number = 'julianday(update_date)' if engine.dialect.name == 'sqlite' else 'to_days(update_date)'
+        try:
+            intervals = pd.read_sql(text(f"""
+                select table_name, min(update_date) as start_date, max(update_date) as end_date from (
+                    select table_name, update_date,
+                           {day_number} - row_number() over (partition by table_name order by update_date) as grp
+                    from updated_state where {where}
+                ) t group by table_name, grp"""), con=engine, params=params)
+        except Exception:
+            intervals = pd.read_sql(text(f'select table_name, update_date as start_date, update_date as end_date '
+                                         f'from updated_state where {where}'), con=engine, params=params)
+        intervals['start_date'] = pd.to_datetime(intervals['start_date']).dt.strftime('%Y-%m-%d')
+        intervals['end_date'] = pd.to_datetime(intervals['end_date']).dt.strftime('%Y-%m-%d')
+        for table, start_date, end_date in zip(intervals['table_name'], intervals['start_date'], intervals['end_date']):
+            state.mark_range(table, start_date, end_date)
+        return state
+
+    def mark_range(self, table, start_date, end_date):
+        """
+        把连续日期区间标记为已同步，只适用于同步期间为连续日期的情况
+        """
+        start = self.position.get(start_date, 0 if start_date < self.dates[0] else None)
+        end = self.position.get(end_date, len(self.dates) - 1 if end_date > self.dates[-1] else None)
+        if start is None or end is None or start > end:
+            return
+        self.bits[table] = self.bits.get(table, 0) | (((1 << (end - start + 1)) - 1) << start)
+
+    def mark_synced(self, table, dates):
+        """
+        把日期标记为已同步，同步期间外的日期忽略
+        """
+        mask = 0
+        for date in dates:
+            index = self.position.get(str(date))
+            if index is not None:
+                mask |= 1 << index
+        self.bits[table] = self.bits.get(table, 0) | mask
+
+    def is_synced(self, table, date):
+        index = self.position.get(str(date))
+        return index is not None and bool(self.bits.get(table, 0) >> index & 1)
+
+    def pending_dates(self, table):
+        """
+        :return: 同步期间内未同步的日期列表
+        """
+        bits = self.bits.get(table, 0)
+        if bits == 0:
+            return list(self.dates)
+        flags = bin(bits)[2:].zfill(len(self.dates))[::-1]
+        return [date for date, flag in zip(self.dates, flags) if flag == '0']
+
+
+def __init(customized_table, customized_time, sync_start, sync_end, db_infos, sync_config=None, dry_run=False):
     """
     整个同步程序的初始化程序，并处理命令行参数 1、读取之前更新状态，形成updated_state矩阵。
                                         2、确定需要更新的table，并返回
@@ -54,15 +568,39 @@ def __init(customized_table, customized_time, sync_start, sync_end, db_infos):
     :param sync_start: 同步开始日期
     :param customized_table: 手动指定的表
     :param customized_time: 手动指定的时间
+    :param sync_config: 本次同步的配置，见SYNC_CONFIG
+    :param dry_run: 只生成同步计划，不建表、不预建连接、不创建缓存与检查点目录，updated_state不存在时视为都未同步
     :return:
     """
-    global DATA_UPDATED_STATE, USABLE_DBS
+    global DATA_UPDATED_STATE, USABLE_DBS, SOURCE_CACHE, CHECKPOINT_STORE, STATE_WRITER
+    SYNC_CONFIG.update(sync_config or {})
+    from ts_soup.fetch import FETCH_BACKENDS
+    if SYNC_CONFIG['fetch_backend'] not in FETCH_BACKENDS:
+        raise ValueError(f'fetch_backend 不支持：{SYNC_CONFIG["fetch_backend"]}，可选：{",".join(FETCH_BACKENDS)}')
+    # 同一进程中多次同步时，未开启缓存的同步不使用之前的缓存
+    SOURCE_CACHE = None
+    if SYNC_CONFIG['source_cache_mb'] and not dry_run:
+        SOURCE_CACHE = SourceCache(SYNC_CONFIG['source_cache_mb'], SYNC_CONFIG['cache_spill_dir'])
+    # 同一进程中多次同步时，未开启检查点的同步不使用之前的检查点；
+    # --time指定日期的同步需要重新读取数据源，不使用检查点，避免写入之前读取的数据
+    CHECKPOINT_STORE = None
+    if SYNC_CONFIG['checkpoint_dir'] and not dry_run:
+        if len(customized_time) > 0:
+            print('指定日期同步，不使用数据源检查点')
+        else:
+            CHECKPOINT_STORE = CheckpointStore(SYNC_CONFIG['checkpoint_dir'], SYNC_CONFIG['checkpoint_ttl_hours'])
     # 加载数据源配置 设置数据库连接
     for db_type in ['sources', 'targets']:
         for db_info in db_infos[db_type]:
             engine_types = db_info.get('engine_type')
 
             if engine_types:
+                if db_info.get('url'):
+                    # 由ts_soup创建并管理连接池，sqlalchemy与pymysql方式共用同一个连接池
+                    from ts_soup.pool import create_pooled_engine
+                    pool = dict(db_info.get('pool') or {}, prewarm=0) if dry_run else db_info.get('pool')
+                    engine = create_pooled_engine(db_info['alias'], db_info['url'], pool, db_info.get('engine_kwargs'))
+                    db_info = dict(db_info, engine=[engine] * len(engine_types))
                 for engine_index,engine_type in enumerate(engine_types):
                     if engine_type == 'sqlalchemy':
                         get_sqlalchemy_engine(db_info, db_type,engine_index)
@@ -73,50 +611,31 @@ def __init(customized_table, customized_time, sync_start, sync_end, db_infos):
                 raise ValueError('未配置engine类型')
 
     # 创建数据表 updated_state
-    with USABLE_DBS['targets_default'].begin() as conn:
-        conn.execute(text("""
-        CREATE TABLE if not exists `updated_state`  (
-                      `update_date` date DEFAULT NULL,
-                      `table_name` varchar(50) COLLATE utf8mb4_general_ci NOT NULL,
-                      UNIQUE KEY `index` (`update_date`,`table_name`) USING BTREE COMMENT '唯一索引'
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
-        """))
+    state_exists = True
+    if not dry_run:
+        create_state_table(USABLE_DBS['targets_default'])
+    else:
+        state_exists = inspect(USABLE_DBS['targets_default']).has_table('updated_state')
+    STATE_WRITER = StateWriter(USABLE_DBS['targets_default'], durable=SYNC_CONFIG['state_durable'],
+                               flush_rows=SYNC_CONFIG['state_flush_rows'],
+                               flush_seconds=SYNC_CONFIG['state_flush_seconds'])
+    if SYNC_CONFIG['change_detection'] and not dry_run:
+        from ts_soup.fingerprint import create_fingerprint_table
+        create_fingerprint_table(USABLE_DBS['targets_default'])
 
     # 需要同步的表，根据数据库中to_update_tables确定，如果传入--table，则为传入的表
     to_update_tables = customized_table if len(customized_table) > 0 else pd.read_sql('select * from to_update_tables', con=USABLE_DBS['targets_default'])['table_name']
     # 如果传入--time，则将传入日期的，需要更新的表的状态全部设置为0，全部进行同步
     if len(customized_time) > 0:
-        DATA_UPDATED_STATE = pd.DataFrame(index=customized_time,columns=to_update_tables)
-        DATA_UPDATED_STATE = DATA_UPDATED_STATE.reset_index().rename({'index':'update_date'},axis=1).fillna(0)
+        DATA_UPDATED_STATE = UpdatedState(customized_time)
         return to_update_tables
 
-    # 以下按照updated_state记录情况进行同步
-    data_updated_state = pd.read_sql('select * from updated_state where update_date >= "{}" and update_date <= "{}"'.format(sync_start,sync_end),
-                                     con=USABLE_DBS['targets_default'])
-    # 统一时间类型
-    data_updated_state['update_date'] = pd.to_datetime(data_updated_state['update_date'])
-    sync_date_range = pd.date_range(sync_start, sync_end)
-    fill_date_range = pd.DataFrame(sync_date_range, columns=['update_date'])
-    fill_date_range['table_name'] = 'fill_date_range'
-    # 利用fill_date_range把data_updated_state的日期补全为整个需要同步的期间的所有日期
-    # 透视的时候如果某table_name没有对应同步日期记录，则该日期table_name的值为NA
-    data_updated_state = pd.concat([data_updated_state, fill_date_range])
-    data_updated_state['state'] = 1
-    pivot_table = data_updated_state.pivot_table(index='update_date', columns='table_name', values='state')
-    # 原来记录里有且现在仍需要的表
-    both_columns = [i for i in to_update_tables if i in pivot_table.columns.values.tolist()]
-    # 原来记录没有现在新增的表，新增的表需要扩展data_updated_state
-    non_columns = [i for i in to_update_tables if i not in pivot_table.columns.values.tolist()]
-
-    # DATA_UPDATED_STATE是data_updated_state的二维表形式，以日期为行索引，表名为列索引，
-    # 且经过non_columns的扩展，是最终同步时判断状态所依赖的表
-
-    # 把原来有的表data_updated_state的记录，未同步的日期置为0
-    DATA_UPDATED_STATE = pivot_table[both_columns].fillna(0)
-    # 扩展新增表，扩展DATA_UPDATED_STATE
-    DATA_UPDATED_STATE[non_columns] = 0
-    DATA_UPDATED_STATE = DATA_UPDATED_STATE.reset_index()
-    DATA_UPDATED_STATE['update_date'] = DATA_UPDATED_STATE['update_date'].apply(lambda x: x.strftime('%Y-%m-%d'))
+    # 以下按照updated_state记录情况进行同步，DATA_UPDATED_STATE记录每个表在同步期间内已同步的日期
+    if not state_exists:
+        DATA_UPDATED_STATE = UpdatedState(pd.date_range(sync_start, sync_end).strftime('%Y-%m-%d'))
+        return to_update_tables
+    with RECORDER.phase('state_init'):
+        DATA_UPDATED_STATE = UpdatedState.from_database(USABLE_DBS['targets_default'], list(to_update_tables), sync_start, sync_end)
     return to_update_tables
 
 
@@ -128,17 +647,29 @@ class BaseSource(ABC):
     def __init__(self,
                  db: str = None,
                  index_field: str = 'date',
-                 empty_check: bool = True):
+                 empty_check: bool = True,
+                 chunksize: int = None,
+                 dtypes: dict = None,
+                 downcast=None):
         """
         :param db: 数据库名
         :param index_field: 数据源筛选日期的字段，如果不提供则默认"date",如果需要查询全表，则index_field需要设置为 None。
         :param empty_check: 是否为当前方法主要数据源（除了配置信息的数据源），判空时使用，若不想使当前数据源参与判空，可设为 False
+        :param chunksize: 流式读取时每块的行数，设置后通过服务端游标分块读取，方法需要在db_operator中声明chunk_safe=True
+                才会按块执行，否则各块会合并为一个DataFrame
+        :param dtypes: 读取后各列的类型，如 {'value': 'float32', 'category': 'category', 'date': 'date'}，见fetch.apply_dtypes
+        :param downcast: 读取后降低内存的转换规则，True 或 fetch.DOWNCAST_RULES 中的规则列表
         """
         self.empty_check = empty_check
+        self.chunksize = chunksize
+        self.dtypes = dtypes
+        self.downcast = downcast
         if db:
             self.db = USABLE_DBS.get(db)
+            self.db_str = db
         else:
             self.db = USABLE_DBS.get('sources_default')
+            self.db_str = 'sources_default'
         self.index_field = index_field
 
     @abstractmethod
@@ -149,6 +680,155 @@ class BaseSource(ABC):
         """
         pass
 
+    def read_sql(self, sql, params=None, db_str=None, chunksize=None):
+        """
+        执行查询，设置了chunksize时返回DataFrame的迭代器
+        :param sql: 查询语句
+        :param params: 绑定参数
+        :param db_str: 在其他数据库别名上查询(如跨库的MultiSource)，默认为数据源的db
+        :param chunksize: 分块读取的行数，默认为数据源的chunksize，0表示一次读取全部
+        :return: DataFrame 或 DataFrame迭代器
+        """
+        db_str = db_str or self.db_str
+        db = self.db if db_str == self.db_str else USABLE_DBS.get(db_str)
+        chunksize = self.chunksize if chunksize is None else chunksize
+        if chunksize:
+            return self.__stream_sql(db, sql, params, chunksize)
+        if SOURCE_CACHE is None:
+            return self.__fetch(db, sql, params)
+
+        # 多个方法读取相同的数据源时使用缓存，类型转换配置不同时结果不同
+        key = SourceCache.make_key(db_str, sql, dict(params or {}, __dtypes=(self.dtypes, self.downcast,
+                                                                              SYNC_CONFIG['fetch_backend'])))
+        data = SOURCE_CACHE.get(key)
+        if data is None:
+            data = self.__fetch(db, sql, params)
+            SOURCE_CACHE.put(key, data)
+        return data
+
+    def __fetch(self, db, sql, params):
+        from ts_soup.fetch import FETCH_BACKENDS, apply_dtypes
+        data = FETCH_BACKENDS[SYNC_CONFIG['fetch_backend']](db, sql, params)
+        return apply_dtypes(data, self.dtypes, self.downcast, self.__index_column())
+
+    def __index_column(self):
+        return self.index_field.split('.')[-1] if self.index_field else None
+
+    def __stream_sql(self, db, sql, params, chunksize):
+        # sqlalchemy引擎使用服务端游标(stream_results)，避免驱动把整个结果集读入内存
+        from ts_soup.fetch import apply_dtypes
+        if hasattr(db, 'connect') and hasattr(db, 'dialect'):
+            with db.connect() as conn:
+                conn = conn.execution_options(stream_results=True)
+                for chunk in pd.read_sql(sql, con=conn, params=params, chunksize=chunksize):
+                    yield apply_dtypes(chunk, self.dtypes, self.downcast, self.__index_column())
+        else:
+            for chunk in pd.read_sql(sql, con=db, params=params, chunksize=chunksize):
+                yield apply_dtypes(chunk, self.dtypes, self.downcast, self.__index_column())
+
+    def _read_sharded(self, to_update_date, build_query, shards):
+        """
+        把日期按顺序拆分为shards段，在连接池的多个连接上并发查询，并发数受SYNC_CONFIG的shard_concurrency限制
+        :param build_query: 根据日期列表生成 (语句, 绑定参数) 的方法
+        :return: 各段结果列表，按日期升序
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        dates = sorted(set(str(i) for i in to_update_date))
+        size = -(-len(dates) // shards)
+        semaphore = shard_semaphore(self.db_str)
+
+        def read(shard_dates):
+            sql, params = build_query(shard_dates)
+            if semaphore is None:
+                return self.read_sql(sql, params, chunksize=0)
+            with semaphore:
+                return self.read_sql(sql, params, chunksize=0)
+
+        with ThreadPoolExecutor(max_workers=shards) as pool:
+            return list(pool.map(read, [dates[i:i + size] for i in range(0, len(dates), size)]))
+
+    def fingerprint(self, to_update_date):
+        """
+        低成本探测每个日期的数据指纹(如 行数+max(updated_at))，用于变更检测，不支持时返回None
+        :param to_update_date:
+        :return: {yyyy-mm-dd: fingerprint} 或 None
+        """
+        return None
+
+    def watermark(self, to_update_date):
+        """
+        低成本的数据源水位(如 max(日期字段)、max(updated_at))，常驻同步时用于判断数据源是否有变化，不支持时返回None
+        :param to_update_date:
+        :return: 可比较的水位值 或 None
+        """
+        return None
+
+    def probe_dates(self, to_update_date):
+        """
+        低成本探测哪些日期有数据(如 select distinct 日期字段)，不支持时返回None
+        :param to_update_date:
+        :return: 有数据的yyyy-mm-dd日期集合 或 None
+        """
+        return None
+
+    def probe_cost(self):
+        """
+        探测的相对成本，探测时成本低的数据源先执行
+        """
+        return 1
+
+    def _distinct_dates(self, sql, params, db_str=None):
+        db = self.db if not db_str or db_str == self.db_str else USABLE_DBS.get(db_str)
+        data = pd.read_sql(text(sql), con=db, params=params)
+        return set(pd.to_datetime(data['update_date']).dt.strftime('%Y-%m-%d'))
+
+    def count_rows(self, to_update_date):
+        """
+        每个日期的行数，用于估算数据量，不支持时返回None
+        :param to_update_date:
+        :return: {yyyy-mm-dd: 行数} 或 None
+        """
+        return None
+
+    def explain_rows(self, to_update_date):
+        """
+        数据库执行计划(EXPLAIN)估算的查询行数，不需要扫描数据，用于同步计划；不支持时返回None
+        :param to_update_date:
+        :return: 行数 或 None
+        """
+        return None
+
+    def _explain_rows(self, sql, params, db_str=None):
+        """
+        mysql的EXPLAIN各表 rows * filtered 的乘积，其他数据库返回None
+        """
+        db = self.db if not db_str or db_str == self.db_str else USABLE_DBS.get(db_str)
+        if getattr(getattr(db, 'dialect', None), 'name', None) != 'mysql':
+            return None
+        data = pd.read_sql(text(f'explain {sql}'), con=db, params=params)
+        if data.empty or 'rows' not in data.columns:
+            return None
+        rows = data['rows'].fillna(1).astype(float)
+        if 'filtered' in data.columns:
+            rows = rows * data['filtered'].fillna(100).astype(float) / 100
+        return int(rows.clip(lower=1).prod())
+
+    def _count_by_date(self, from_where, params, db_str=None):
+        db = self.db if not db_str or db_str == self.db_str else USABLE_DBS.get(db_str)
+        data = pd.read_sql(text(f'select {self.index_field} as update_date, count(*) as cnt {from_where} '
+                                f'group by {self.index_field}'), con=db, params=params)
+        if data.empty:
+            return {}
+        data['update_date'] = pd.to_datetime(data['update_date']).dt.strftime('%Y-%m-%d')
+        return dict(zip(data['update_date'], data['cnt'].astype(int)))
+
+    def read_tables(self):
+        """
+        数据源读取的表名，调度时用于推断方法间的依赖，无法确定时返回空列表
+        :return: 表名列表
+        """
+        return []
+
 
 class BaseTarget(ABC):
     """
@@ -156,6 +836,8 @@ class BaseTarget(ABC):
     """
 
     def __init__(self, db: str = None):
+        self.streaming = False
+        self._stream_updated = None
         if db:
             self.db = USABLE_DBS.get(db)
             self.db_pym = USABLE_DBS.get(f'{db}_pym')
@@ -173,6 +855,29 @@ class BaseTarget(ABC):
         """
         pass
 
+    def begin_stream(self):
+        """
+        流式执行开始，之后每块结果调用 build_stream_output 写入
+        """
+        self.streaming = True
+        self._stream_updated = None
+
+    def build_stream_output(self, cur_result):
+        """
+        写入一块结果，并累计该块更新完成的日期
+        """
+        updated_date = self.build_output(cur_result)
+        if updated_date is not None:
+            self._stream_updated = set(self._stream_updated or ()) | set(updated_date)
+
+    def end_stream(self):
+        """
+        流式执行结束
+        :return: 所有块累计的更新完成日期，含义与build_output的返回值相同
+        """
+        self.streaming = False
+        return None if self._stream_updated is None else sorted(self._stream_updated)
+
 
 class Executor:
     """
@@ -183,20 +888,156 @@ class Executor:
                如果数据结果全都有值，但是存在个别天数的行中存在空数据，则会删除空数据对应的行，updated_state更新取每个数据结果的交集作为日期
     """
 
-    def __init__(self, sources, targets, executed_table, customized_updated_state=None):
+    def __init__(self, sources, targets, executed_table, customized_updated_state=None, chunk_safe=False,
+                 to_update_date=None):
         """
         数据库的操作器，负责从源表读取数据 _make_source_data，以及写入目标表 _handle_result
+        :param chunk_safe: 方法是否可以按块执行，为True时第一个设置了chunksize的数据源按块流式读取、执行、写入
+        :param to_update_date: 需要同步的日期，默认根据DATA_UPDATED_STATE确定，分批同步时传入每批的日期
         """
+        self.chunk_safe = chunk_safe
+        self.stream = None
+        self.stream_index = None
         self.any_source_empty = False
         self.value = []
         self.sources = sources
         self.targets = targets
         self.source_data = []
         self.executed_table = executed_table
-        self.to_update_date = self.__get_update_date()
+        if to_update_date is None:
+            self.to_update_date = self.__get_update_date()
+        else:
+            self.to_update_date = pd.Series(to_update_date, dtype=object, name='update_date')
+        self.source_fingerprints = {}
+        self.checkpoint_keys = []
 
     def __get_update_date(self):
-        return DATA_UPDATED_STATE.loc[~(DATA_UPDATED_STATE[self.executed_table] == 1), 'update_date']
+        return pd.Series(DATA_UPDATED_STATE.pending_dates(self.executed_table), dtype=object, name='update_date')
+
+    def trim_unchanged_date(self):
+        """
+        变更检测：各数据源的日期指纹与上次同步该日期时相同，则该日期不再读取和写入，直接记为已同步
+        任一数据源不支持指纹时不做处理
+        """
+        if not SYNC_CONFIG['change_detection'] or len(self.to_update_date) == 0 or len(self.sources) == 0:
+            return
+        from ts_soup.fingerprint import load_fingerprints, combine_fingerprints
+
+        fingerprints_list = []
+        for source in self.sources:
+            fingerprints = source.fingerprint(self.to_update_date)
+            if fingerprints is None:
+                return
+            fingerprints_list.append(fingerprints)
+        self.source_fingerprints = combine_fingerprints(fingerprints_list)
+
+        stored = load_fingerprints(USABLE_DBS['targets_default'], 'source', self.executed_table,
+                                   self.to_update_date.values.tolist())
+        unchanged_date = sorted(i for i, fingerprint in self.source_fingerprints.items() if stored.get(i) == fingerprint)
+        if unchanged_date:
+            print(f'{self.executed_table} 数据源未变化，跳过日期：\n{",".join(unchanged_date)}')
+            self.to_update_date = self.to_update_date[~self.to_update_date.isin(unchanged_date)]
+            self.__handle_insert_update_state(pd.DataFrame({'update_date': unchanged_date}))
+
+    def trim_empty_date(self):
+        """
+        SYNC_CONFIG的probe_dates开启时，按探测成本从低到高依次探测empty_check数据源哪些日期有数据，
+        每个数据源只探测之前的数据源都有数据的日期，最终只读取所有数据源都有数据的日期，其余日期保持未同步
+        不支持探测的数据源不参与
+        """
+        if not SYNC_CONFIG['probe_dates'] or len(self.to_update_date) == 0:
+            return
+        remaining = set(self.to_update_date.values.tolist())
+        with RECORDER.phase('probe', self.executed_table) as record:
+            for source in sorted((i for i in self.sources if i.empty_check), key=lambda i: i.probe_cost()):
+                dates = source.probe_dates(pd.Series(sorted(remaining), dtype=object))
+                if dates is None:
+                    continue
+                remaining &= dates
+                if not remaining:
+                    break
+            record['rows'] = len(remaining)
+        empty_date = sorted(i for i in self.to_update_date if i not in remaining)
+        if empty_date:
+            print(f'{self.executed_table} 数据源无数据，跳过日期：\n{",".join(empty_date)}')
+            self.to_update_date = self.to_update_date[self.to_update_date.isin(remaining)]
+
+    def estimate_rows(self):
+        """
+        根据empty_check数据源的count_rows估算每个日期的行数，没有数据源支持时返回None
+        :return: {yyyy-mm-dd: 行数} 或 None
+        """
+        estimated = None
+        for source in self.sources:
+            if not source.empty_check:
+                continue
+            counts = source.count_rows(self.to_update_date)
+            if counts is None:
+                continue
+            estimated = estimated or {}
+            for date, rows in counts.items():
+                estimated[date] = estimated.get(date, 0) + rows
+        return estimated
+
+    def split_batches(self):
+        """
+        按SYNC_CONFIG的batch_days、batch_rows把需要同步的日期拆分为多批，每批单独读取、写入并提交updated_state，
+        中断后重新执行时从未提交的批次继续
+        :return: 每批对应的Executor列表，不分批时为 [self]
+        """
+        batch_days = SYNC_CONFIG['batch_days']
+        batch_rows = SYNC_CONFIG['batch_rows']
+        dates = self.to_update_date.values.tolist()
+        estimated = self.estimate_rows() if batch_rows else None
+
+        batches, batch, rows = [], [], 0
+        for date in dates:
+            date_rows = estimated.get(date, 0) if estimated is not None else 0
+            if batch and ((batch_days and len(batch) >= batch_days) or
+                          (estimated is not None and rows + date_rows > batch_rows)):
+                batches.append(batch)
+                batch, rows = [], 0
+            batch.append(date)
+            rows += date_rows
+        if batch:
+            batches.append(batch)
+        if len(batches) <= 1:
+            return [self]
+
+        executors = []
+        for batch in batches:
+            executor = Executor(self.sources, self.targets, self.executed_table,
+                                chunk_safe=self.chunk_safe, to_update_date=batch)
+            executor.source_fingerprints = self.source_fingerprints
+            executors.append(executor)
+        return executors
+
+    def run(self, func):
+        """
+        读取数据源，执行方法，写入目标表并记录updated_state
+        """
+        if len(self.sources) != 0:
+            self.make_source_data()
+        self.execute(func)
+
+    def execute(self, func):
+        """
+        数据源读取完成后，执行方法，写入目标表并记录updated_state
+        """
+        if self.stream is not None and not self.any_source_empty:
+            self.handle_stream(func)
+        else:
+            # empty_check为True且有一天数据源为空则不执行数据处理函数
+            if not self.any_source_empty:
+                with RECORDER.phase('func', self.executed_table):
+                    func(self)
+
+            self.handle_result()
+
+        # 写入成功，不再需要数据源的检查点
+        if CHECKPOINT_STORE is not None:
+            for key in self.checkpoint_keys:
+                CHECKPOINT_STORE.remove(key)
 
     def make_source_data(self):
         """
@@ -204,8 +1045,45 @@ class Executor:
         判断传入的主要数据源（除了配置信息）是存在空，如果存在空则视所有数据源都为空，当天数据未更新
         :return:
         """
-        for source in self.sources:
-            data = source.build_source(self.to_update_date)
+        self.accept_source_data(self.read_source(source) for source in self.sources)
+
+    def read_source(self, source):
+        """
+        读取一个数据源，并记录耗时、行数
+        """
+        with RECORDER.phase('build_source', self.executed_table, getattr(source, 'tb', type(source).__name__)) as record:
+            data = self.__read_checkpoint(source)
+            if data is None:
+                data = source.build_source(self.to_update_date)
+                self.__write_checkpoint(source, data)
+            record.update(RECORDER.frame_stats(data))
+        return data
+
+    def __read_checkpoint(self, source):
+        if CHECKPOINT_STORE is None or source.chunksize:
+            return None
+        key = CheckpointStore.make_key(self.executed_table, source, self.to_update_date)
+        data = CHECKPOINT_STORE.load(key)
+        if data is not None:
+            print(f'{self.executed_table} 使用数据源检查点：{getattr(source, "tb", type(source).__name__)}')
+            self.checkpoint_keys.append(key)
+        return data
+
+    def __write_checkpoint(self, source, data):
+        if CHECKPOINT_STORE is None or source.chunksize or not isinstance(data, pd.DataFrame) or data.empty:
+            return
+        key = CheckpointStore.make_key(self.executed_table, source, self.to_update_date)
+        CHECKPOINT_STORE.save(key, data)
+        self.checkpoint_keys.append(key)
+
+    def accept_source_data(self, datas):
+        """
+        按数据源顺序接收读取结果并判空，datas为生成器时，遇到空的数据源后不再读取后面的数据源
+        :param datas: 与self.sources顺序对应的读取结果
+        """
+        for source, data in zip(self.sources, datas):
+            if not isinstance(data, pd.DataFrame):
+                data = self.__accept_stream(data)
             """
             判断数据源（empty_check设置为True的）是否存在空，如果存在空则视所有数据源都为空，当天数据未更新
             主要目的是为了避免需要频繁在funcs的处理逻辑中增加判空的判断，也可以手动给某数据源设置为False,如果某数据源
@@ -223,6 +1101,46 @@ class Executor:
 
             self.source_data.append(data)
 
+    def __accept_stream(self, chunks):
+        """
+        处理分块读取的数据源：chunk_safe的方法中第一个分块数据源作为流，返回第一块用于判空，
+        其余分块数据源(或方法不是chunk_safe)合并为一个DataFrame
+        """
+        if self.chunk_safe and self.stream is None:
+            first = next(chunks, None)
+            if first is None:
+                return pd.DataFrame()
+            self.stream = itertools.chain([first], chunks)
+            self.stream_index = len(self.source_data)
+            return first
+        chunks = list(chunks)
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def handle_stream(self, func):
+        """
+        流式执行：每读取一块数据，就执行一次方法并写入各target，全部完成后统一处理updated_state
+        """
+        func_update_flag = True
+        for target in self.targets:
+            target.begin_stream()
+        for chunk in self.stream:
+            self.source_data[self.stream_index] = chunk
+            self.value = []
+            with RECORDER.phase('func', self.executed_table):
+                func(self)
+            for index, target in enumerate(self.targets):
+                cur_result = self.value[index]
+                if cur_result is None:
+                    func_update_flag = False
+                    print(f'{target.tb} 无数据同步，返回结果为None')
+                    continue
+                with RECORDER.phase('build_output', self.executed_table, target.tb) as record:
+                    record.update(RECORDER.frame_stats(cur_result))
+                    target.build_stream_output(cur_result)
+        updated_dates = [target.end_stream() for target in self.targets]
+        if func_update_flag:
+            self.__handle_update_state(updated_dates)
+
     def handle_result(self):
         """
         调用各target处理对应返回结果的方法，并取得各target执行后需要更新的日期，updated_date
@@ -231,7 +1149,7 @@ class Executor:
             日期缺失，则updated_state依旧为0 。
         :return:
         """
-        update_state_date = None
+        updated_dates = []
         func_update_flag = True
         for index, target in enumerate(self.targets):
             cur_result = self.value[index]
@@ -246,43 +1164,52 @@ class Executor:
                 continue
 
             # 调用统一接口完成成果产出，返回每个target更新的日期，最后取交集作为该func的完成同步的日期
-            # 先统一转datetime，再转str
-            updated_date = target.build_output(cur_result)
+            with RECORDER.phase('build_output', self.executed_table, target.tb) as record:
+                record.update(RECORDER.frame_stats(cur_result))
+                updated_dates.append(target.build_output(cur_result))
+
+        # 将方法的操作记录写入数据库
+        if func_update_flag:
+            self.__handle_update_state(updated_dates)
+
+    def __handle_update_state(self, updated_dates):
+        """
+        取各target更新日期的交集写入updated_state
+        :param updated_dates: 各target build_output的返回值
+        """
+        update_state_date = None
+        for updated_date in updated_dates:
             if updated_date is None:
                 continue
-            date_df = pd.to_datetime(updated_date)
-            updated_date = pd.DataFrame(date_df, columns=['update_date']).drop_duplicates().applymap(
-                lambda x: x.strftime('%Y-%m-%d'))
-
-            # 如果未传入自定义更新日期，则取数据日期作为 处理操作表的更新日期，取各数据结果交集
+            # 先统一转datetime，再转str，取各数据结果交集
+            updated_date = pd.Index(pd.to_datetime(updated_date).strftime('%Y-%m-%d')).unique()
             if update_state_date is not None:
-                update_state_date = update_state_date.merge(
-                    pd.DataFrame(updated_date, columns=['update_date']).drop_duplicates(),
-                    on='update_date',
-                    how='inner'
-                )[['update_date']]
+                update_state_date = update_state_date.intersection(updated_date)
             else:
-                update_state_date = pd.DataFrame(updated_date, columns=['update_date']).drop_duplicates()
+                update_state_date = updated_date
 
-        # 将方法的操作记录写入数据库
-        if func_update_flag:
-            if update_state_date is not None and not update_state_date.empty:
-                self.__handle_insert_update_state(update_state_date)
+        if update_state_date is not None and len(update_state_date) != 0:
+            self.__handle_insert_update_state(pd.DataFrame({'update_date': update_state_date}))
 
     def __handle_insert_update_state(self, update_state):
-        update_state['table_name'] = self.executed_table
-        with USABLE_DBS['targets_default'].begin() as conn:
-            conn.execute(
-                f'delete from updated_state where table_name = "{self.executed_table}" and update_date in ({query_in_sql(update_state["update_date"].values.tolist())})')
-            update_state.to_sql('updated_state', con=conn, index=False, if_exists='append')
+        with RECORDER.phase('updated_state', self.executed_table) as record:
+            record['rows'] = update_state.shape[0]
+            self.__insert_update_state(update_state)
+
+    def __insert_update_state(self, update_state):
+        dates = update_state['update_date'].values.tolist()
+        fingerprints = {i: self.source_fingerprints[i] for i in dates if i in self.source_fingerprints}
+        STATE_WRITER.add(self.executed_table, dates, fingerprints)
+        DATA_UPDATED_STATE.mark_synced(self.executed_table, update_state['update_date'])
 
 
-def db_operator(sources: list, targets: list):
+def db_operator(sources: list, targets: list, depends_on: list = None, chunk_safe: bool = False):
     """
     数据库操作器，包括源表与目标表，在funcs中需按照target_info顺序将结果添加到 executor.value中
     使用三个类来完成工作  1. Executor   方法层面，对应funcs模块中每个方法
                        2. Source 数据源层面，对应装饰器中定义的数据源
                        3. Target 目标表层面，对应装饰器中配置的目标表
+    并发执行时(run_sync的max_workers>1)，会根据依赖关系调度，依赖的方法执行完成后才执行当前方法
     :param sources: 源表信息，list类型:
     [
         Source(db=源表所在库名(默认ALI_DATA),tb=源表名,...),
@@ -293,43 +1220,59 @@ def db_operator(sources: list, targets: list):
         Target(db=目标数据库，tb=目标表名,...),
         Target(db=目标数据库，tb=目标表名,....) ...
     ]
+    :param depends_on: 依赖的方法名列表，除此之外，某方法的目标表是当前方法的源表时，也会自动视为依赖
+    :param chunk_safe: 方法是否可以按块执行(每块数据单独处理结果不变)，为True时配合数据源的chunksize流式读取、执行、写入，
+            内存占用取决于chunksize而不是同步的日期范围
     :return:
     """
 
     def wrapper(func):
         @wraps(func)
-        def inner_wrapper():
+        def inner_wrapper(to_update_date=None):
+            # to_update_date：只同步指定的日期(如多实例同步时领取的日期窗口)，默认根据DATA_UPDATED_STATE确定
             executor = None
             try:
                 executor = Executor(targets=targets,
                                     sources=sources,
-                                    executed_table=func.__name__)
+                                    executed_table=func.__name__,
+                                    chunk_safe=chunk_safe,
+                                    to_update_date=to_update_date)
+                executor.trim_unchanged_date()
+                executor.trim_empty_date()
 
                 # 表示该方法已同步完所有数据，则不再执行后续操作
                 if len(executor.to_update_date) == 0:
                     print(f'{func.__name__} 方法已同步至最新\n\n')
-                    return
+                    return True
 
                 msg_len = len(f' {func.__name__} 开始 ')
                 before_white_len = int((110-msg_len)/2)
                 after_white_len = 110-msg_len-before_white_len
 
                 print('>'*before_white_len + f' {func.__name__} 开始 ' +'>'*after_white_len)
-                if len(sources) != 0:
-                    executor.make_source_data()
-
-                # empty_check为True且有一天数据源为空则不执行数据处理函数
-                if not executor.any_source_empty:
-                    func(executor)
-
-                executor.handle_result()
+                with RECORDER.profile(func.__name__):
+                    batches = executor.split_batches()
+                    for index, batch in enumerate(batches):
+                        if len(batches) > 1:
+                            print(f'{func.__name__} 第{index + 1}/{len(batches)}批：'
+                                  f'{batch.to_update_date.iloc[0]} ~ {batch.to_update_date.iloc[-1]}')
+                        batch.run(func)
                 print('<'*before_white_len+ f' {func.__name__} 结束 '+'<'*after_white_len+'\n'*2)
+                return True
             except Exception:
                 global EXECUTE_STATE
                 EXECUTE_STATE = False
-                print(executor.executed_table + '同步失败')
+                print(func.__name__ + '同步失败')
                 print(traceback.format_exc())
+                return False
 
+        # 供调度器读取方法的数据源、目标表及依赖
+        inner_wrapper.sources = sources
+        inner_wrapper.targets = targets
+        inner_wrapper.depends_on = depends_on or []
+        inner_wrapper.func = func
+        inner_wrapper.chunk_safe = chunk_safe
+        FUNC_REGISTRY[func.__name__] = inner_wrapper
         return inner_wrapper
 
     return wrapper
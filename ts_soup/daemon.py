@@ -0,0 +1,164 @@
+import datetime
+import signal
+import threading
+import time
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from ts_soup import common
+from ts_soup.common import UpdatedState, USABLE_DBS
+from ts_soup.fingerprint import combine_fingerprints
+from ts_soup.registry import load_funcs
+from ts_soup.scheduler import topological_order
+
+
+class SyncDaemon:
+    """
+    常驻同步：数据库连接、方法和DATA_UPDATED_STATE在进程内保持，按 poll_seconds 轮询数据源的水位，只同步有变化的表和日期
+        1、每次轮询对每个方法的数据源执行一次低成本的水位查询(见Source.watermark：max(日期字段)、max(watermark_field))
+        2、水位变化时，同步该方法未同步的日期；数据源都设置了watermark_field时，再按日期指纹找出已同步但数据有变化的日期一并同步
+        3、方法同步成功后，依赖该方法的方法同步相同的日期
+        4、不支持水位查询的数据源(MultiSource、RawSqlSource)所在的方法，每 full_sync_minutes 分钟按未同步的日期同步一次
+        5、日期变化时按新的同步期间重新读取to_update_tables、updated_state并加载新的方法
+        6、收到SIGTERM/SIGINT后，当前方法执行完成再退出
+    """
+
+    def __init__(self, funcs_dir, sync_start_from: dict, sync_delay: int = 1, customized_table: list = None,
+                 poll_seconds: float = 60, full_sync_minutes: float = 60):
+        """
+        :param funcs_dir: funcs模块所在文件夹
+        :param sync_start_from: 同步开始时间距离同步结束时间的间隔，relativedelta参数
+        :param sync_delay: 同步结束时间距离当前时间的天数
+        :param customized_table: 只同步指定的表，默认为to_update_tables中的表
+        :param poll_seconds: 轮询水位的间隔(秒)
+        :param full_sync_minutes: 不支持水位查询的方法的同步间隔(分钟)
+        """
+        self.funcs_dir = funcs_dir
+        self.sync_start_from = sync_start_from
+        self.sync_delay = sync_delay
+        self.customized_table = customized_table or []
+        self.poll_seconds = poll_seconds
+        self.full_sync_seconds = full_sync_minutes * 60
+        self.stopping = threading.Event()
+        self.window = None
+        self.funcs = []
+        self.dependencies = {}
+        # 方法名 -> 上次的水位、各日期的数据源指纹、上次全量同步的时间
+        self.watermarks = {}
+        self.fingerprints = {}
+        self.full_synced_at = {}
+        # 同步失败的方法及日期，下次轮询重新同步
+        self.retry = {}
+
+    def stop(self, *_):
+        if not self.stopping.is_set():
+            print('收到退出信号，当前方法执行完成后退出')
+        self.stopping.set()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        print(f'常驻同步已启动，轮询间隔 {self.poll_seconds}s')
+        while not self.stopping.is_set():
+            start = time.perf_counter()
+            try:
+                self.__refresh_window()
+                affected = self.__poll()
+                if affected:
+                    self.__sync(affected)
+            except Exception:
+                import traceback
+                print('常驻同步轮询异常')
+                print(traceback.format_exc())
+            finally:
+                if common.SOURCE_CACHE is not None:
+                    # 数据源在两次轮询之间可能变化，缓存只在一次轮询内有效
+                    common.SOURCE_CACHE.clear()
+            self.stopping.wait(max(0.0, self.poll_seconds - (time.perf_counter() - start)))
+        print('常驻同步已退出')
+
+    def __refresh_window(self):
+        """
+        同步期间随当前时间移动，日期变化时重新读取需要同步的表和updated_state
+        """
+        sync_end = datetime.datetime.now() + relativedelta(days=self.sync_delay)
+        window = ((sync_end - relativedelta(**self.sync_start_from)).strftime('%Y-%m-%d'), sync_end.strftime('%Y-%m-%d'))
+        if window == self.window:
+            return
+        engine = USABLE_DBS['targets_default']
+        tables = self.customized_table or \
+            pd.read_sql('select * from to_update_tables', con=engine)['table_name'].tolist()
+        common.DATA_UPDATED_STATE = UpdatedState.from_database(engine, list(tables), *window)
+        self.funcs, self.dependencies = topological_order(load_funcs(self.funcs_dir, list(tables)))
+        self.window = window
+        self.watermarks.clear()
+        self.retry = {}
+        print(f'同步期间：{window[0]} ~ {window[1]}，共 {len(self.funcs)} 个方法')
+
+    def __poll(self):
+        """
+        :return: {方法名: 需要同步的日期集合}，值为None表示按未同步的日期整体同步
+        """
+        affected = {}
+        dates = pd.Series(common.DATA_UPDATED_STATE.dates, dtype=object)
+        for func in self.funcs:
+            name = func.__name__
+            marks = [source.watermark(dates) for source in func.sources]
+            if not marks or any(mark is None for mark in marks):
+                if time.time() - self.full_synced_at.get(name, 0) >= self.full_sync_seconds:
+                    affected[name] = None
+                continue
+            if marks == self.watermarks.get(name):
+                continue
+            self.watermarks[name] = marks
+
+            changed = set(common.DATA_UPDATED_STATE.pending_dates(name))
+            fingerprints_list = [source.fingerprint(dates) for source in func.sources]
+            if all(i is not None for i in fingerprints_list):
+                fingerprints = combine_fingerprints(fingerprints_list)
+                previous = self.fingerprints.get(name)
+                if previous is not None:
+                    changed |= {i for i in set(fingerprints) | set(previous) if fingerprints.get(i) != previous.get(i)}
+                self.fingerprints[name] = fingerprints
+            if changed:
+                affected[name] = changed
+
+        for name, dates in self.retry.items():
+            if dates is None or affected.get(name, ()) is None:
+                affected[name] = None
+            else:
+                affected[name] = set(affected.get(name, ())) | dates
+        self.retry = {}
+        return affected
+
+    def __sync(self, affected):
+        """
+        按依赖顺序同步有变化的方法，依赖的方法同步的日期也传递给当前方法
+        """
+        common.EXECUTE_STATE = True
+        synced = {}
+        for func in self.funcs:
+            if self.stopping.is_set():
+                break
+            name = func.__name__
+            full_sync = name in affected and affected[name] is None
+            # 定时同步的方法只同步调用前未同步的日期，没有未同步的日期时不向依赖它的方法传递
+            dates = set(common.DATA_UPDATED_STATE.pending_dates(name)) if full_sync else set(affected.get(name, ()))
+            for dep in self.dependencies[name]:
+                dates |= synced.get(dep, set())
+            if not dates:
+                if full_sync:
+                    self.full_synced_at[name] = time.time()
+                continue
+
+            print(f'{name} {"定时同步" if full_sync else "数据源有变化，开始同步"}：{",".join(sorted(dates))}')
+            success = func(to_update_date=sorted(dates))
+            if success is False:
+                self.retry[name] = dates
+                continue
+            if full_sync:
+                self.full_synced_at[name] = time.time()
+            # 数据源为空等原因未同步的日期不传递
+            synced[name] = {i for i in dates if common.DATA_UPDATED_STATE.is_synced(name, i)}
+        # 每次轮询的同步结束后写入缓存的updated_state
+        common.STATE_WRITER.flush()
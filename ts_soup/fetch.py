@@ -0,0 +1,105 @@
+import datetime
+import pandas as pd
+
+# 不支持arrow读取的数据库或查询只提示一次
+_ARROW_FALLBACK = set()
+
+
+def fetch_pandas(db, sql, params):
+    """
+    默认的读取方式，驱动逐行返回元组后由pandas推断类型
+    """
+    return pd.read_sql(sql, con=db, params=params)
+
+
+def _connectorx_url(db):
+    url = db.url
+    url = url.set(drivername=url.get_backend_name())
+    return url.render_as_string(hide_password=False)
+
+
+def fetch_arrow(db, sql, params):
+    """
+    使用connectorx把查询结果直接读入arrow列式内存，再以尽量少的复制转换为DataFrame：
+        date类型转为datetime64，decimal类型转为float64，不再是object
+    未安装connectorx、connectorx不支持该数据库，或db不是sqlalchemy引擎时，使用fetch_pandas
+    """
+    try:
+        import connectorx as cx
+        import pyarrow as pa
+        url = _connectorx_url(db)
+        # connectorx不支持绑定参数，按数据库方言把参数渲染为字面量
+        bound = sql.bindparams(**params) if params else sql
+        query = str(bound.compile(dialect=db.dialect, compile_kwargs={'literal_binds': True}))
+        table = cx.read_sql(url, query, return_type='arrow')
+    except Exception as e:
+        key = getattr(db, 'url', id(db))
+        if key not in _ARROW_FALLBACK:
+            _ARROW_FALLBACK.add(key)
+            print(f'arrow读取不可用，使用pandas读取：{type(e).__name__}: {e}')
+        return fetch_pandas(db, sql, params)
+
+    columns = []
+    for field, column in zip(table.schema, table.columns):
+        if pa.types.is_decimal(field.type):
+            column = column.cast(pa.float64())
+        columns.append(column)
+    table = pa.Table.from_arrays(columns, names=table.schema.names)
+    return table.to_pandas(date_as_object=False, split_blocks=True, self_destruct=True)
+
+
+# 数据源读取方式，可以注册自定义的读取方法：FETCH_BACKENDS['name'] = func(db, sql, params) -> DataFrame
+FETCH_BACKENDS = {
+    'pandas': fetch_pandas,
+    'arrow': fetch_arrow,
+}
+
+# 降低内存的转换规则，数据源的downcast为True时全部使用
+#   category: 不同值个数不超过行数一半的字符串列转为category
+#   integer: 整数列转为能容纳其值的最小整数类型
+#   float: 浮点列转为float32
+#   date: 值为datetime.date的object列转为datetime64
+DOWNCAST_RULES = ['category', 'integer', 'float', 'date']
+
+
+def apply_dtypes(data, dtypes=None, downcast=None, index_field=None):
+    """
+    按数据源配置转换列类型
+    :param data: DataFrame
+    :param dtypes: {列名: 类型}，类型为pandas类型名，如 'int32'、'category'，'date' 表示转为datetime64
+    :param downcast: True 或 DOWNCAST_RULES中的规则列表，dtypes中指定的列不再按规则转换
+    :param index_field: 日期字段，不转为category，避免按日期分组时出现没有数据的日期
+    :return: 转换后的DataFrame
+    """
+    if data.empty or (not dtypes and not downcast):
+        return data
+    dtypes = dtypes or {}
+    for column, dtype in dtypes.items():
+        if column not in data.columns:
+            continue
+        if dtype == 'date':
+            data[column] = pd.to_datetime(data[column])
+        else:
+            data[column] = data[column].astype(dtype)
+
+    rules = DOWNCAST_RULES if downcast is True else (downcast or [])
+    for column in data.columns:
+        if column in dtypes:
+            continue
+        series = data[column]
+        kind = series.dtype.kind
+        if kind == 'O':
+            sample = series.dropna()
+            if sample.empty:
+                continue
+            first = sample.iloc[0]
+            if 'date' in rules and isinstance(first, datetime.date) and not isinstance(first, datetime.datetime):
+                data[column] = pd.to_datetime(series)
+            elif 'category' in rules and isinstance(first, str) and column != index_field \
+                    and series.nunique() <= len(series) // 2:
+                data[column] = series.astype('category')
+        elif kind in 'iu' and 'integer' in rules:
+            data[column] = pd.to_numeric(series, downcast='integer' if kind == 'i' else 'unsigned')
+        elif kind == 'f' and 'float' in rules:
+            data[column] = series.astype('float32')
+    return data
@@ -0,0 +1,90 @@
+import hashlib
+import pandas as pd
+from sqlalchemy import text
+from ts_soup.common import date_predicate
+
+# 与updated_state同库，记录每个(表, 日期)数据的指纹
+#   scope = 'source'：table_name为方法名，指纹由方法各数据源的 行数+水位(如max(updated_at)) 组成
+#   scope = 'target'：table_name为 库别名.表名，指纹为写入数据的 行数+内容哈希
+FINGERPRINT_TABLE = 'updated_fingerprint'
+
+
+def create_fingerprint_table(engine):
+    with engine.begin() as conn:
+        if engine.dialect.name == 'mysql':
+            conn.execute(text(f"""
+            CREATE TABLE if not exists `{FINGERPRINT_TABLE}`  (
+                          `scope` varchar(10) COLLATE utf8mb4_general_ci NOT NULL,
+                          `table_name` varchar(100) COLLATE utf8mb4_general_ci NOT NULL,
+                          `update_date` date NOT NULL,
+                          `fingerprint` varchar(64) COLLATE utf8mb4_general_ci NOT NULL,
+                          UNIQUE KEY `index` (`scope`,`table_name`,`update_date`) USING BTREE COMMENT '唯一索引'
+                        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+            """))
+        else:
+            conn.execute(text(f"""
+            CREATE TABLE if not exists {FINGERPRINT_TABLE}  (
+                          scope varchar(10) NOT NULL,
+                          table_name varchar(100) NOT NULL,
+                          update_date date NOT NULL,
+                          fingerprint varchar(64) NOT NULL,
+                          UNIQUE (scope, table_name, update_date)
+                        )
+            """))
+
+
+def load_fingerprints(engine, scope, table_name, dates):
+    """
+    :return: {yyyy-mm-dd: fingerprint}
+    """
+    predicate, params = date_predicate('update_date', dates)
+    params.update({'scope': scope, 'table_name': table_name})
+    data = pd.read_sql(text(f'select update_date, fingerprint from {FINGERPRINT_TABLE} '
+                            f'where scope = :scope and table_name = :table_name and {predicate}'),
+                       con=engine, params=params)
+    if data.empty:
+        return {}
+    data['update_date'] = pd.to_datetime(data['update_date']).dt.strftime('%Y-%m-%d')
+    return dict(zip(data['update_date'], data['fingerprint']))
+
+
+def save_fingerprints(engine, scope, table_name, fingerprints):
+    """
+    :param fingerprints: {yyyy-mm-dd: fingerprint}
+    """
+    if not fingerprints:
+        return
+    predicate, params = date_predicate('update_date', list(fingerprints))
+    params.update({'scope': scope, 'table_name': table_name})
+    data = pd.DataFrame({'scope': scope,
+                         'table_name': table_name,
+                         'update_date': list(fingerprints),
+                         'fingerprint': list(fingerprints.values())})
+    with engine.begin() as conn:
+        conn.execute(text(f'delete from {FINGERPRINT_TABLE} where scope = :scope and table_name = :table_name and {predicate}'),
+                     params)
+        data.to_sql(FINGERPRINT_TABLE, con=conn, index=False, if_exists='append')
+
+
+def frame_fingerprints(cur_result, index_field):
+    """
+    按日期计算数据的内容指纹：行数 + 各行哈希之和，与行的顺序无关
+    :return: {日期: fingerprint}
+    """
+    row_hash = pd.util.hash_pandas_object(cur_result, index=False)
+    agg = row_hash.groupby(cur_result[index_field].values).agg(['count', 'sum'])
+    return {date: f'{int(count)}:{int(total) & 0xFFFFFFFFFFFFFFFF:016x}'
+            for date, count, total in zip(agg.index, agg['count'], agg['sum'])}
+
+
+def combine_fingerprints(fingerprints_list):
+    """
+    合并多个数据源的指纹，任一数据源某日期没有指纹时，该日期也没有合并后的指纹
+    :param fingerprints_list: [{日期: fingerprint}, ...]
+    :return: {日期: fingerprint}
+    """
+    dates = set(fingerprints_list[0]) if fingerprints_list else set()
+    for fingerprints in fingerprints_list[1:]:
+        dates &= set(fingerprints)
+    return {date: hashlib.md5('|'.join(i[date] for i in fingerprints_list).encode('utf8')).hexdigest()
+            for date in dates}
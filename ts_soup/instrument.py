@@ -0,0 +1,148 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    """
+    记录同步各阶段的耗时、行数和DataFrame内存：
+        阶段包括 state_init、build_source(每个数据源)、func(方法本身)、build_output(每个目标表)、updated_state
+        每条记录实时追加到JSON lines文件，同步结束时按 方法×阶段 汇总写入Prometheus textfile
+    对指定的方法可以开启cProfile和tracemalloc，结果写入profile_dir
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.jsonl_path = None
+        self.prom_path = None
+        self.profile_tables = set()
+        self.profile_dir = None
+        self.summary = {}
+        self.lock = threading.Lock()
+
+    def configure(self, jsonl_path=None, prom_path=None, profile_tables=None, profile_dir=None):
+        """
+        :param jsonl_path: 每个阶段的记录追加写入的JSON lines文件
+        :param prom_path: 汇总写入的Prometheus textfile
+        :param profile_tables: 需要开启cProfile和tracemalloc的方法名
+        :param profile_dir: profile结果目录，默认当前目录
+        """
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.profile_tables = set(profile_tables or [])
+        self.profile_dir = profile_dir or os.getcwd()
+        self.enabled = bool(jsonl_path or prom_path)
+        self.summary = {}
+
+    @staticmethod
+    def frame_stats(data):
+        """
+        DataFrame的行数和近似内存(不计算object列的实际内容)
+        """
+        if data is None or not hasattr(data, 'memory_usage'):
+            return {}
+        return {'rows': int(data.shape[0]), 'bytes': int(data.memory_usage(index=True, deep=False).sum())}
+
+    @contextmanager
+    def phase(self, phase, table=None, name=None):
+        """
+        记录一个阶段，调用方可以向yield的字典中写入rows、bytes
+        """
+        record = {}
+        if not self.enabled:
+            yield record
+            return
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield record
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            record.update({'ts': time.time(),
+                           'table': table,
+                           'phase': phase,
+                           'name': name,
+                           'seconds': round(time.perf_counter() - start, 6),
+                           'status': status})
+            self.__emit(record)
+
+    def __emit(self, record):
+        with self.lock:
+            key = (record['table'] or '', record['phase'])
+            summary = self.summary.setdefault(key, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+            summary['calls'] += 1
+            summary['seconds'] += record['seconds']
+            summary['rows'] += record.get('rows', 0)
+            summary['bytes'] += record.get('bytes', 0)
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a', encoding='utf8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    @contextmanager
+    def profile(self, table):
+        """
+        对profile_tables中的方法开启cProfile和tracemalloc
+        """
+        if table not in self.profile_tables:
+            yield
+            return
+        profiler = cProfile.Profile()
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracemalloc:
+                tracemalloc.stop()
+            suffix = time.strftime('%Y%m%d%H%M%S')
+            profiler.dump_stats(os.path.join(self.profile_dir, f'{table}.{suffix}.prof'))
+            with open(os.path.join(self.profile_dir, f'{table}.{suffix}.tracemalloc.txt'), 'w', encoding='utf8') as f:
+                f.write(f'peak: {peak / 1024 / 1024:.1f}MB\n')
+                for stat in snapshot.statistics('lineno')[:30]:
+                    f.write(f'{stat}\n')
+            print(f'{table} profile已写入 {self.profile_dir}')
+
+    def close(self):
+        """
+        同步结束，写入Prometheus textfile并输出最耗时的阶段
+        """
+        if not self.enabled:
+            return
+        if self.prom_path:
+            self.__write_prometheus()
+        top = sorted(self.summary.items(), key=lambda i: i[1]['seconds'], reverse=True)[:10]
+        print('耗时最多的阶段：')
+        for (table, phase), summary in top:
+            print(f'  {table} {phase}: {summary["seconds"]:.2f}s，{summary["calls"]} 次，{summary["rows"]} 行')
+
+    def __write_prometheus(self):
+        lines = []
+        metrics = [('calls', 'ts_soup_phase_calls_total', '阶段执行次数'),
+                   ('seconds', 'ts_soup_phase_seconds_total', '阶段耗时(秒)'),
+                   ('rows', 'ts_soup_phase_rows_total', '阶段处理的行数'),
+                   ('bytes', 'ts_soup_phase_bytes_total', '阶段处理的DataFrame近似内存(字节)')]
+        for field, metric, help_text in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for (table, phase), summary in sorted(self.summary.items()):
+                lines.append(f'{metric}{{table="{table}",phase="{phase}"}} {summary[field]}')
+        # 先写临时文件再重命名，避免node_exporter读到不完整的文件
+        tmp_path = self.prom_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prom_path)
+
+
+# 全局的记录对象，run_sync时配置
+RECORDER = Instrumentation()
@@ -0,0 +1,273 @@
+import os
+import socket
+import threading
+import time
+import uuid
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from ts_soup import common
+from ts_soup.common import date_predicate, USABLE_DBS
+from ts_soup.scheduler import topological_order
+
+# 与updated_state同库，记录多实例同步时每个 (方法, 日期窗口) 的领取情况
+#   status: pending 未领取，running 已被owner领取(expires_at前有效)，done 已完成，failed 执行失败(可重试)
+LEASE_TABLE = 'sync_lease'
+
+
+def create_lease_table(engine):
+    with engine.begin() as conn:
+        if engine.dialect.name == 'mysql':
+            conn.execute(text(f"""
+            CREATE TABLE if not exists `{LEASE_TABLE}`  (
+                          `run_id` varchar(50) COLLATE utf8mb4_general_ci NOT NULL,
+                          `table_name` varchar(100) COLLATE utf8mb4_general_ci NOT NULL,
+                          `window_start` varchar(10) COLLATE utf8mb4_general_ci NOT NULL,
+                          `window_end` varchar(10) COLLATE utf8mb4_general_ci NOT NULL,
+                          `status` varchar(10) COLLATE utf8mb4_general_ci NOT NULL,
+                          `owner` varchar(100) COLLATE utf8mb4_general_ci DEFAULT NULL,
+                          `expires_at` double DEFAULT NULL,
+                          `attempts` int NOT NULL DEFAULT 0,
+                          UNIQUE KEY `index` (`run_id`,`table_name`,`window_start`) USING BTREE COMMENT '唯一索引'
+                        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+            """))
+        else:
+            conn.execute(text(f"""
+            CREATE TABLE if not exists {LEASE_TABLE}  (
+                          run_id varchar(50) NOT NULL,
+                          table_name varchar(100) NOT NULL,
+                          window_start varchar(10) NOT NULL,
+                          window_end varchar(10) NOT NULL,
+                          status varchar(10) NOT NULL,
+                          owner varchar(100) DEFAULT NULL,
+                          expires_at double DEFAULT NULL,
+                          attempts int NOT NULL DEFAULT 0,
+                          UNIQUE (run_id, table_name, window_start)
+                        )
+            """))
+
+
+class LeaseWorker:
+    """
+    多实例同步：多个run_sync进程(同一台或多台机器)通过目标库中的sync_lease表分担同步任务
+        1、同步期间按 lease_days 拆分为日期窗口，每个 (方法, 日期窗口) 为一个任务，所有实例登记相同的任务
+        2、实例通过带条件的update领取任务，领取后在 lease_seconds 内有效，并由心跳线程定时续期
+        3、实例崩溃后心跳停止，租约过期，其余实例可以重新领取该任务；失败或租约过期(如执行时实例被OOM、SIGKILL)的任务
+           最多执行 max_attempts 次
+        4、依赖的方法(见db_operator的depends_on)同一日期窗口完成后，才可以领取当前方法的任务
+        5、执行前从updated_state重新读取该窗口已同步的日期，只同步其余日期；写入目标表和updated_state的方式
+           与单实例相同(按日期删除后写入)，任务被重复执行时结果不变
+    各实例的时钟差需要远小于 lease_seconds
+    """
+
+    def __init__(self, funcs, run_id: str, lease_days: int = 7, lease_seconds: int = 600,
+                 poll_seconds: float = 5, max_attempts: int = 3, forced: bool = False, worker_id: str = None):
+        """
+        :param funcs: db_operator装饰后的方法列表
+        :param run_id: 同一次同步的标识，所有实例必须相同；重新执行已完成的同步时需要使用新的run_id
+        :param lease_days: 每个任务的日期窗口天数
+        :param lease_seconds: 租约有效时间，超过该时间未续期视为实例已崩溃
+        :param poll_seconds: 没有可领取的任务时，等待其他实例的间隔
+        :param max_attempts: 每个任务最多执行的次数
+        :param forced: 是否为--time指定日期的同步，为True时不读取updated_state，窗口内的日期全部同步
+        :param worker_id: 实例标识，默认为 主机名:进程号:随机数
+        """
+        self.funcs, self.dependencies = topological_order(funcs)
+        self.funcs_by_name = {func.__name__: func for func in self.funcs}
+        self.run_id = run_id
+        self.lease_days = lease_days
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.forced = forced
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.engine = USABLE_DBS['targets_default']
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.results = {}
+
+    def windows(self):
+        """
+        :return: [(窗口开始日期, 窗口结束日期, 窗口内日期列表)]
+        """
+        dates = common.DATA_UPDATED_STATE.dates
+        return [(dates[i], dates[min(i + self.lease_days, len(dates)) - 1], dates[i:i + self.lease_days])
+                for i in range(0, len(dates), self.lease_days)]
+
+    def run(self):
+        """
+        领取并执行任务，直到所有任务完成或无法执行
+        :return: {方法名: 本实例执行的任务是否全部成功}
+        """
+        create_lease_table(self.engine)
+        windows = {start: dates for start, _, dates in self.windows()}
+        self.__register()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.__heartbeat, args=(stop,), daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                units = self.__load_units()
+                dead = self.__dead_units(units)
+                claimed = False
+                for (table, window_start), unit in units.items():
+                    if (table, window_start) in dead or not self.__claimable(unit):
+                        continue
+                    if not all(units.get((dep, window_start), {}).get('status') == 'done'
+                               for dep in self.dependencies[table]):
+                        continue
+                    if self.__claim(unit):
+                        self.__process(table, unit, windows[window_start])
+                        claimed = True
+                        break
+                if claimed:
+                    continue
+                if all(unit['status'] == 'done' or key in dead for key, unit in units.items()):
+                    break
+                time.sleep(self.poll_seconds)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        for table, window_start in sorted(dead):
+            print(f'{table} {window_start} 开始的日期窗口同步失败或依赖的方法同步失败，未完成')
+            self.results[table] = False
+        if dead:
+            common.EXECUTE_STATE = False
+        return self.results
+
+    def __register(self):
+        """
+        登记所有任务，已登记的任务(其他实例登记过)忽略
+        """
+        rows = [{'run_id': self.run_id, 'table_name': func.__name__, 'window_start': start, 'window_end': end,
+                 'status': 'pending', 'attempts': 0}
+                for func in self.funcs for start, end, _ in self.windows()]
+        if not rows:
+            return
+        columns = 'run_id, table_name, window_start, window_end, status, attempts'
+        values = ':run_id, :table_name, :window_start, :window_end, :status, :attempts'
+        dialect = self.engine.dialect.name
+        if dialect in ('mysql', 'sqlite'):
+            ignore = 'insert ignore' if dialect == 'mysql' else 'insert or ignore'
+            with self.engine.begin() as conn:
+                conn.execute(text(f'{ignore} into {LEASE_TABLE} ({columns}) values ({values})'), rows)
+            return
+        for row in rows:
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f'insert into {LEASE_TABLE} ({columns}) values ({values})'), row)
+            except IntegrityError:
+                pass
+
+    def __load_units(self):
+        data = pd.read_sql(text(f'select table_name, window_start, window_end, status, owner, expires_at, attempts '
+                                f'from {LEASE_TABLE} where run_id = :run_id'),
+                           con=self.engine, params={'run_id': self.run_id})
+        units = {(i['table_name'], i['window_start']): i for i in data.to_dict('records')}
+        # 按方法的依赖顺序、日期窗口顺序领取
+        order = {func.__name__: index for index, func in enumerate(self.funcs)}
+        return dict(sorted(((key, unit) for key, unit in units.items() if key[0] in order),
+                           key=lambda i: (order[i[0][0]], i[0][1])))
+
+    def __dead_units(self, units):
+        """
+        不会再被执行的任务：失败或租约过期且执行次数达到上限，或依赖的方法同一窗口的任务不会再被执行
+        """
+        dead = set()
+        now = time.time()
+        for (table, window_start), unit in units.items():
+            stopped = unit['status'] == 'failed' or (unit['status'] == 'running' and (unit['expires_at'] or 0) < now)
+            exhausted = stopped and unit['attempts'] >= self.max_attempts
+            if exhausted or any((dep, window_start) in dead for dep in self.dependencies[table]):
+                dead.add((table, window_start))
+        return dead
+
+    def __claimable(self, unit):
+        if unit['attempts'] >= self.max_attempts:
+            return False
+        if unit['status'] in ('pending', 'failed'):
+            return True
+        return unit['status'] == 'running' and (unit['expires_at'] or 0) < time.time()
+
+    def __claim(self, unit):
+        """
+        带条件的update领取任务，条件与读取时的状态一致才能成功，多个实例同时领取时只有一个成功
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            result = conn.execute(text(f"""
+                update {LEASE_TABLE} set status = 'running', owner = :owner, expires_at = :expires_at, attempts = attempts + 1
+                where run_id = :run_id and table_name = :table_name and window_start = :window_start
+                and attempts = :attempts and attempts < :max_attempts
+                and (status in ('pending', 'failed') or (status = 'running' and expires_at < :now))"""),
+                {'owner': self.worker_id, 'expires_at': now + self.lease_seconds, 'run_id': self.run_id,
+                 'table_name': unit['table_name'], 'window_start': unit['window_start'],
+                 'attempts': int(unit['attempts']), 'max_attempts': self.max_attempts, 'now': now})
+        if result.rowcount != 1:
+            return False
+        if unit['status'] == 'running':
+            print(f'{unit["table_name"]} {unit["window_start"]} 的租约已过期(原实例：{unit["owner"]})，重新执行')
+        with self.held_lock:
+            self.held.add((unit['table_name'], unit['window_start']))
+        return True
+
+    def __finish(self, table, window_start, status):
+        with self.held_lock:
+            self.held.discard((table, window_start))
+        with self.engine.begin() as conn:
+            result = conn.execute(text(f"""
+                update {LEASE_TABLE} set status = :status, expires_at = null
+                where run_id = :run_id and table_name = :table_name and window_start = :window_start
+                and owner = :owner and status = 'running'"""),
+                {'status': status, 'run_id': self.run_id, 'table_name': table, 'window_start': window_start,
+                 'owner': self.worker_id})
+        if result.rowcount != 1:
+            print(f'{table} {window_start} 的租约已被其他实例领取，执行结果以其他实例为准')
+
+    def __heartbeat(self, stop):
+        """
+        定时为本实例持有的任务续期
+        """
+        while not stop.wait(self.lease_seconds / 3):
+            with self.held_lock:
+                held = list(self.held)
+            for table, window_start in held:
+                try:
+                    with self.engine.begin() as conn:
+                        result = conn.execute(text(f"""
+                            update {LEASE_TABLE} set expires_at = :expires_at
+                            where run_id = :run_id and table_name = :table_name and window_start = :window_start
+                            and owner = :owner and status = 'running'"""),
+                            {'expires_at': time.time() + self.lease_seconds, 'run_id': self.run_id,
+                             'table_name': table, 'window_start': window_start, 'owner': self.worker_id})
+                    if result.rowcount != 1:
+                        print(f'{table} {window_start} 的租约续期失败，可能已被其他实例领取')
+                except Exception as e:
+                    print(f'{table} {window_start} 的租约续期失败：{e}')
+
+    def __pending_dates(self, table, dates):
+        """
+        从updated_state重新读取窗口内已同步的日期(可能已由其他实例同步)，返回其余日期
+        """
+        if not self.forced:
+            predicate, params = date_predicate('update_date', dates)
+            params['table_name'] = table
+            synced = pd.read_sql(text(f'select update_date from updated_state where table_name = :table_name and {predicate}'),
+                                 con=self.engine, params=params)
+            common.DATA_UPDATED_STATE.mark_synced(table, pd.to_datetime(synced['update_date']).dt.strftime('%Y-%m-%d'))
+        return [date for date in dates if not common.DATA_UPDATED_STATE.is_synced(table, date)]
+
+    def __process(self, table, unit, dates):
+        window_start = unit['window_start']
+        print(f'{self.worker_id} 领取 {table}：{window_start} ~ {unit["window_end"]}')
+        try:
+            pending = self.__pending_dates(table, dates)
+            success = True if not pending else self.funcs_by_name[table](to_update_date=pending) is not False
+            # 其他实例从updated_state读取已同步的日期，完成任务前写入缓存的updated_state
+            common.STATE_WRITER.flush()
+        except Exception as e:
+            print(f'{table} {window_start} 执行失败：{e}')
+            success = False
+        self.__finish(table, window_start, 'done' if success else 'failed')
+        self.results[table] = self.results.get(table, True) and success
@@ -0,0 +1,178 @@
+import heapq
+import json
+import os
+import pandas as pd
+from ts_soup import common
+from ts_soup.scheduler import build_dependencies
+
+# 没有历史耗时记录时，每行数据源的预估耗时(秒)
+DEFAULT_SECONDS_PER_ROW = 1e-5
+
+
+def load_history(jsonl_path):
+    """
+    从metrics_jsonl(见Instrumentation)读取各方法历史的耗时与数据源行数
+    :return: {方法名: {'seconds': 各阶段总耗时, 'rows': 数据源总行数, 'runs': 方法执行次数}}
+    """
+    history = {}
+    if not jsonl_path or not os.path.exists(jsonl_path):
+        return history
+    with open(jsonl_path, encoding='utf8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            table = record.get('table')
+            if not table or record.get('status') != 'ok':
+                continue
+            stats = history.setdefault(table, {'seconds': 0.0, 'rows': 0, 'runs': 0})
+            stats['seconds'] += record.get('seconds', 0)
+            if record.get('phase') == 'build_source':
+                stats['rows'] += record.get('rows', 0)
+            elif record.get('phase') == 'func':
+                stats['runs'] += 1
+    return history
+
+
+class SyncPlanner:
+    """
+    同步计划：根据DATA_UPDATED_STATE和db_operator方法的数据源估算每个方法的工作量，不执行同步
+        1、未同步的日期：DATA_UPDATED_STATE中每个方法未同步的日期(--time时为指定的日期)
+        2、数据源行数：使用数据库执行计划(EXPLAIN，见BaseSource.explain_rows)估算，不扫描数据；
+           EXPLAIN不支持时(如非mysql数据库)，开启count_rows才使用count_rows按日期count，需要扫描数据源
+        3、预估耗时：有历史记录(metrics_jsonl)时按该方法历史的 每行耗时 × 数据源行数，没有数据源行数时取历史平均每次耗时；
+           没有该方法的历史记录时按所有方法的平均每行耗时(或DEFAULT_SECONDS_PER_ROW)估算
+        4、按最长处理时间优先(LPT)排序：方法的优先级为自身预估耗时加上依赖它的方法中最长的链路耗时，
+           在满足依赖关系的前提下优先级高的方法先执行，减少最耗时的方法最后才开始导致的同步时间延长
+    """
+
+    def __init__(self, funcs, history_jsonl=None, count_rows: bool = False):
+        """
+        :param funcs: db_operator装饰后的方法列表
+        :param history_jsonl: 历史耗时记录，run_sync的metrics_jsonl文件
+        :param count_rows: EXPLAIN不支持时是否使用count(*)统计数据源行数
+        """
+        self.funcs = list(funcs)
+        self.history = load_history(history_jsonl)
+        self.count_rows = count_rows
+        self.dependencies = build_dependencies(self.funcs)
+        self.items = None
+
+    def build(self):
+        """
+        :return: 按原有顺序的 [{'table', 'pending_days', 'rows', 'rows_from', 'seconds', 'seconds_from', 'priority'}]
+        """
+        total_seconds = sum(i['seconds'] for i in self.history.values() if i['rows'])
+        total_rows = sum(i['rows'] for i in self.history.values())
+        seconds_per_row = total_seconds / total_rows if total_rows else DEFAULT_SECONDS_PER_ROW
+
+        items = {}
+        for func in self.funcs:
+            name = func.__name__
+            pending = common.DATA_UPDATED_STATE.pending_dates(name)
+            rows, rows_from = self.__estimate_rows(func, pending) if pending else (0, None)
+            history = self.history.get(name)
+            if not pending:
+                seconds, seconds_from = 0.0, None
+            elif history and history['rows'] and rows is not None:
+                seconds, seconds_from = rows * history['seconds'] / history['rows'], 'history'
+            elif history and history['runs']:
+                seconds, seconds_from = history['seconds'] / history['runs'], 'history'
+            elif rows is not None:
+                seconds, seconds_from = rows * seconds_per_row, 'rows'
+            else:
+                seconds, seconds_from = None, None
+            items[name] = {'table': name, 'pending_days': len(pending), 'rows': rows, 'rows_from': rows_from,
+                           'seconds': seconds, 'seconds_from': seconds_from}
+        self.__prioritize(items)
+        self.items = [items[func.__name__] for func in self.funcs]
+        return self.items
+
+    def __estimate_rows(self, func, pending):
+        """
+        各数据源行数之和，有数据源无法估算时只统计可以估算的数据源，都无法估算时为None
+        """
+        dates = pd.Series(pending, dtype=object)
+        rows, rows_from = None, None
+        for source in func.sources:
+            estimated, method = None, None
+            try:
+                estimated, method = source.explain_rows(dates), 'explain'
+                if estimated is None and self.count_rows:
+                    counts = source.count_rows(dates)
+                    estimated, method = (sum(counts.values()), 'count') if counts is not None else (None, None)
+            except Exception as e:
+                print(f'{func.__name__} 数据源行数估算失败：{type(e).__name__}: {e}')
+            if estimated is None:
+                continue
+            rows = (rows or 0) + estimated
+            rows_from = method if rows_from in (None, method) else 'mixed'
+        return rows, rows_from
+
+    def __prioritize(self, items):
+        """
+        优先级 = 自身预估耗时 + 依赖当前方法的方法中最大的优先级
+        """
+        dependents = {name: [] for name in items}
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                dependents[dep].append(name)
+
+        def priority(name):
+            item = items[name]
+            if 'priority' not in item:
+                item['priority'] = (item['seconds'] or 0) + max([priority(i) for i in dependents[name]], default=0)
+            return item['priority']
+
+        for name in items:
+            priority(name)
+
+    def lpt_order(self):
+        """
+        满足依赖关系的前提下，按优先级从高到低排列方法，优先级相同时保持原有顺序
+        :return: 排序后的方法列表
+        """
+        if self.items is None:
+            self.build()
+        priorities = {item['table']: item['priority'] for item in self.items}
+        index = {func.__name__: i for i, func in enumerate(self.funcs)}
+        funcs_by_name = {func.__name__: func for func in self.funcs}
+        remaining = {name: set(deps) for name, deps in self.dependencies.items()}
+        ready = [(-priorities[name], index[name], name) for name, deps in remaining.items() if not deps]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            _, _, name = heapq.heappop(ready)
+            ordered.append(funcs_by_name[name])
+            for other, deps in remaining.items():
+                if name in deps:
+                    deps.discard(name)
+                    if not deps:
+                        heapq.heappush(ready, (-priorities[other], index[other], other))
+        if len(ordered) != len(self.funcs):
+            raise ValueError('方法之间存在循环依赖')
+        return ordered
+
+    def report(self):
+        """
+        :return: 同步计划的文本，按执行顺序列出每个方法未同步的天数、预估行数和耗时
+        """
+        if self.items is None:
+            self.build()
+        items = {item['table']: item for item in self.items}
+        lines = ['同步计划(按执行顺序)：',
+                 f'{"方法":<30}{"未同步天数":>10}{"预估行数":>14}{"预估耗时(s)":>14}{"优先级":>12}  估算方式']
+        for func in self.lpt_order():
+            item = items[func.__name__]
+            rows = '-' if item['rows'] is None else f'{item["rows"]:,}'
+            seconds = '-' if item['seconds'] is None else f'{item["seconds"]:.1f}'
+            source = '/'.join(i for i in (item['rows_from'], item['seconds_from']) if i) or '-'
+            lines.append(f'{item["table"]:<30}{item["pending_days"]:>10}{rows:>14}{seconds:>14}'
+                         f'{item["priority"]:>12.1f}  {source}')
+        pending_cells = sum(item['pending_days'] for item in self.items)
+        total_rows = sum(item['rows'] or 0 for item in self.items)
+        total_seconds = sum(item['seconds'] or 0 for item in self.items)
+        lines.append(f'共 {len(self.items)} 个方法，{pending_cells} 个未同步的 (方法, 日期)，'
+                     f'预估数据源 {total_rows:,} 行，预估耗时 {total_seconds:.1f}s(顺序执行)')
+        return '\n'.join(lines)
@@ -0,0 +1,121 @@
+import ast
+import importlib
+import json
+import os
+import sys
+from ts_soup.common import FUNC_REGISTRY
+
+# funcs文件夹下缓存的清单文件：{模块文件名: {'mtime':..., 'size':..., 'funcs': [db_operator方法名], 'dynamic': bool}}
+MANIFEST_FILE = '.ts_soup_manifest.json'
+
+
+def _operator_name(node):
+    target = node.func if isinstance(node, ast.Call) else node
+    return target.attr if isinstance(target, ast.Attribute) else getattr(target, 'id', None)
+
+
+def _decorated_funcs(path):
+    """
+    不导入模块，通过语法树找出模块中使用db_operator装饰的方法名
+    :return: {'funcs': 方法名列表, 'dynamic': 是否在装饰器以外调用db_operator(如动态生成的方法)}，
+             模块无法解析时funcs为None
+    """
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (OSError, SyntaxError, ValueError):
+        return {'funcs': None, 'dynamic': True}
+    funcs = []
+    decorators = set()
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for decorator in node.decorator_list:
+            if _operator_name(decorator) == 'db_operator':
+                funcs.append(node.name)
+                decorators.add(id(decorator))
+                break
+    dynamic = any(isinstance(node, ast.Call) and _operator_name(node) == 'db_operator' and id(node) not in decorators
+                  for node in ast.walk(tree))
+    return {'funcs': funcs, 'dynamic': dynamic}
+
+
+def build_manifest(funcs_dir):
+    """
+    读取并更新清单，只重新解析修改过的模块文件
+    :return: {模块文件名: {'mtime':..., 'size':..., 'funcs': [...], 'dynamic': bool}}
+    """
+    manifest_path = os.path.join(funcs_dir, MANIFEST_FILE)
+    try:
+        with open(manifest_path, 'r', encoding='utf8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
+    manifest = {}
+    for file in sorted(os.listdir(funcs_dir)):
+        if not file.endswith('.py'):
+            continue
+        stat = os.stat(os.path.join(funcs_dir, file))
+        entry = cached.get(file)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size and 'dynamic' in entry:
+            manifest[file] = entry
+            continue
+        manifest[file] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                          **_decorated_funcs(os.path.join(funcs_dir, file))}
+
+    if manifest != cached:
+        try:
+            with open(manifest_path, 'w', encoding='utf8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=1)
+        except OSError:
+            pass
+    return manifest
+
+
+def load_funcs(funcs_dir, tables):
+    """
+    根据清单只导入包含本次需要同步的表的模块，从FUNC_REGISTRY中取出方法
+    清单中找不到的表(如动态生成的方法)，只导入清单未覆盖的模块后再查找：
+        没有解析出db_operator方法、在装饰器以外调用db_operator、解析失败或非.py文件的模块；
+    与原有的导入方式一致，FUNC_REGISTRY中没有时取模块中同名的属性
+    :param funcs_dir: funcs模块所在文件夹
+    :param tables: 本次需要同步的表(方法名)
+    :return: 按tables顺序的方法列表
+    """
+    if funcs_dir not in sys.path:
+        sys.path.append(funcs_dir)
+    manifest = build_manifest(funcs_dir)
+    func_modules = {}
+    for file, entry in manifest.items():
+        for name in entry['funcs'] or []:
+            func_modules.setdefault(name, file[:-3])
+
+    modules = {}
+    for table in tables:
+        if table in func_modules and func_modules[table] not in modules:
+            modules[func_modules[table]] = importlib.import_module(func_modules[table])
+
+    missing = [table for table in tables if table not in FUNC_REGISTRY]
+    if missing:
+        print(f'清单中未找到 {missing}，导入清单未覆盖的模块后查找')
+        for file in sorted(os.listdir(funcs_dir)):
+            name = file.split('.')[0]
+            entry = manifest.get(file)
+            if file.startswith(('.', '__')) or name in modules or (entry and entry['funcs'] and not entry['dynamic']):
+                continue
+            if not file.endswith('.py') and not os.path.isdir(os.path.join(funcs_dir, file)):
+                continue
+            modules[name] = importlib.import_module(name)
+
+    funcs = []
+    for table in tables:
+        if table in FUNC_REGISTRY:
+            funcs.append(FUNC_REGISTRY[table])
+            continue
+        func = next((getattr(module, table) for module in modules.values() if table in dir(module)), None)
+        if func is not None:
+            funcs.append(func)
+        else:
+            print(f'{table} 未找到对应的方法')
+    return funcs
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ts_soup import common
+from ts_soup.common import USABLE_DBS, db_key
+
+
+def _func_dbs(func):
+    """
+    方法用到的所有数据库别名，用于数据库并发数限制
+    """
+    dbs = set()
+    for worker in list(func.sources) + list(func.targets):
+        db_str = getattr(worker, 'db_str', None)
+        if db_str:
+            dbs.add(db_str)
+    return dbs
+
+
+def build_dependencies(funcs):
+    """
+    根据db_operator的depends_on，以及 "方法A的目标表是方法B的源表" 推断方法之间的依赖关系
+    只考虑本次需要执行的方法，依赖的方法不在本次执行范围内时忽略
+    :param funcs: db_operator装饰后的方法列表
+    :return: {方法名: 依赖的方法名集合}
+    """
+    names = [func.__name__ for func in funcs]
+    writers = {}
+    for func in funcs:
+        for target in func.targets:
+            tb = getattr(target, 'tb', None)
+            if tb:
+                writers.setdefault((db_key(target.db), tb.lower()), set()).add(func.__name__)
+
+    dependencies = {}
+    for func in funcs:
+        deps = set(i for i in func.depends_on if i in names)
+        for source in func.sources:
+            # 跨库的MultiSource，各表按所在的库判断
+            table_dbs = source.table_dbs() if hasattr(source, 'table_dbs') else {}
+            for tb in source.read_tables():
+                db = USABLE_DBS.get(table_dbs[tb]) if tb in table_dbs else source.db
+                deps |= writers.get((db_key(db), tb.lower()), set())
+        deps.discard(func.__name__)
+        dependencies[func.__name__] = deps
+    return dependencies
+
+
+def topological_order(funcs):
+    """
+    在保持原有顺序的前提下，把方法排在其依赖的方法之后
+    :param funcs: db_operator装饰后的方法列表
+    :return: (排序后的方法列表, 依赖关系)
+    """
+    dependencies = build_dependencies(funcs)
+    ordered, visited, visiting = [], set(), set()
+    funcs_by_name = {func.__name__: func for func in funcs}
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'方法之间存在循环依赖：{name}')
+        visiting.add(name)
+        for dep in sorted(dependencies[name], key=list(funcs_by_name).index):
+            visit(dep)
+        visiting.remove(name)
+        visited.add(name)
+        ordered.append(funcs_by_name[name])
+
+    for func in funcs:
+        visit(func.__name__)
+    return ordered, dependencies
+
+
+class DagScheduler:
+    """
+    按依赖关系(DAG)并发执行db_operator方法：
+        1、依赖的方法全部执行完成后才执行当前方法，依赖的方法同步失败时当前方法不执行
+        2、max_workers 限制同时执行的方法数
+        3、db_concurrency 限制每个数据库别名上同时执行的方法数，如 {'targets_default': 4}
+    方法内部的异常仍由db_operator处理，即 EXECUTE_STATE 与 updated_state 的处理和顺序执行时一致
+    """
+
+    def __init__(self, funcs, max_workers: int = 4, db_concurrency: dict = None):
+        self.funcs = {func.__name__: func for func in funcs}
+        self.order = [func.__name__ for func in funcs]
+        self.max_workers = max_workers
+        self.db_concurrency = db_concurrency or {}
+        invalid = {db: limit for db, limit in self.db_concurrency.items() if limit is None or limit < 1}
+        if invalid:
+            raise ValueError(f'db_concurrency 需要大于等于1：{invalid}')
+        self.dependencies = build_dependencies(funcs)
+        self.func_dbs = {name: _func_dbs(func) for name, func in self.funcs.items()}
+        self.__check_cycle()
+
+    def __check_cycle(self):
+        visiting, visited = set(), set()
+
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f'方法之间存在循环依赖：{" -> ".join(path + [name])}')
+            visiting.add(name)
+            for dep in self.dependencies[name]:
+                visit(dep, path + [name])
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.order:
+            visit(name, [])
+
+    def __has_capacity(self, name, running_dbs):
+        for db in self.func_dbs[name]:
+            limit = self.db_concurrency.get(db)
+            if limit is not None and running_dbs.get(db, 0) >= limit:
+                return False
+        return True
+
+    def run(self):
+        """
+        执行所有方法
+        :return: {方法名: 是否同步成功}，未执行的方法(依赖的方法失败或无法调度)为False
+        """
+        results = {}
+        remaining = {name: set(deps) for name, deps in self.dependencies.items()}
+        ready = [name for name in self.order if not remaining[name]]
+        running = {}
+        running_dbs = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while ready or running:
+                # 按原有顺序提交可执行且数据库并发数未超限的方法
+                for name in list(ready):
+                    if len(running) >= self.max_workers:
+                        break
+                    if not self.__has_capacity(name, running_dbs):
+                        continue
+                    ready.remove(name)
+                    for db in self.func_dbs[name]:
+                        running_dbs[db] = running_dbs.get(db, 0) + 1
+                    running[pool.submit(self.funcs[name])] = name
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    for db in self.func_dbs[name]:
+                        running_dbs[db] -= 1
+                    results[name] = future.result() is not False
+                    if not results[name]:
+                        continue
+                    for other in self.order:
+                        if name in remaining[other]:
+                            remaining[other].discard(name)
+                            if not remaining[other]:
+                                ready.append(other)
+                    ready.sort(key=self.order.index)
+
+        # 未执行的方法：可执行但始终无法提交(数据库并发数限制)，或依赖的方法失败、未执行
+        executed = dict(results)
+        for name in self.order:
+            if name in executed:
+                continue
+            if name in ready:
+                print(f'{name} 无法调度(数据库并发数限制)，未执行')
+            elif any(executed.get(dep) is False for dep in remaining[name]):
+                print(f'{name} 依赖的方法同步失败，未执行')
+            else:
+                print(f'{name} 依赖的方法未执行，未执行')
+            results[name] = False
+            common.EXECUTE_STATE = False
+        return results
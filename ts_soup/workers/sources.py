@@ -1,5 +1,8 @@
+import re
+import string
 import pandas as pd
-from ts_soup.common import query_in_sql, BaseSource
+from sqlalchemy import text
+from ts_soup.common import date_predicate, db_key, BaseSource, USABLE_DBS
 
 
 class Source(BaseSource):
@@ -11,7 +14,12 @@ class Source(BaseSource):
                  index_field='date',
                  other_condition: str = None,
                  order_index: list = None,
-                 order_desc: bool = False
+                 order_desc: bool = False,
+                 chunksize: int = None,
+                 watermark_field: str = None,
+                 dtypes: dict = None,
+                 downcast=None,
+                 read_shards: int = None
                  ):
         """
         单表查询数据源信息
@@ -21,20 +29,36 @@ class Source(BaseSource):
         :param index_field: 日期字段，如果不提供则默认"date",如果需要查询全表，则index_field需要设置为 None。
         :param other_condition: 其他查询条件，直接拼接到 from table 后，覆盖date_field
         :param empty_check: 是否为当前方法主要数据源（除了配置信息的数据源），判空时使用，若不想使当前数据源参与判空，可设为 False
+        :param chunksize: 流式读取时每块的行数，默认一次读取全部
+        :param watermark_field: 数据更新时间字段(如updated_at)，开启变更检测时，每个日期的 行数+max(watermark_field)
+                作为数据指纹，与上次同步相同则跳过该日期；不设置则该数据源不支持变更检测
+        :param dtypes: 读取后各列的类型，见BaseSource
+        :param downcast: 读取后降低内存的转换规则，见BaseSource
+        :param read_shards: 分段并发读取，需要同步的日期按顺序拆分为read_shards段，在多个连接上并发查询后按日期顺序合并，
+                order_index不以index_field开头时，合并后按order_index重新排序；设置了chunksize时不分段
         """
-        super().__init__(db, index_field, empty_check)
+        super().__init__(db, index_field, empty_check, chunksize, dtypes, downcast)
+        self.read_shards = read_shards
         self.tb = tb
+        self.watermark_field = watermark_field
         self.query_field = query_field
         self.other_condition = other_condition
         self.order_index = order_index
         self.order_desc = order_desc
 
-    def build_source(self, to_update_date):
-        base_sql = f'select {self.query_field} from {self.tb} where 1=1 '
+    def _from_where(self, to_update_date):
+        from_where = f' from {self.tb} where 1=1 '
+        params = {}
         if self.other_condition:
-            base_sql += f' and {self.other_condition} '
+            from_where += f' and {self.other_condition} '
         if self.index_field:
-            base_sql += f' and {self.index_field} in ({query_in_sql(to_update_date.values.tolist())})'
+            predicate, params = date_predicate(self.index_field, to_update_date)
+            from_where += f' and {predicate}'
+        return from_where, params
+
+    def __build_sql(self, to_update_date):
+        from_where, params = self._from_where(to_update_date)
+        base_sql = f'select {self.query_field} {from_where}'
 
         # 处理排序
         if self.order_index is not None:
@@ -45,31 +69,106 @@ class Source(BaseSource):
             base_sql += f' order by {self.index_field}'
             if self.order_desc:
                 base_sql += ' desc'
+        return text(base_sql), params
+
+    def build_source(self, to_update_date):
+        if self.read_shards and self.read_shards > 1 and self.index_field and not self.chunksize \
+                and len(to_update_date) > 1:
+            return self.__build_sharded(to_update_date)
+        return self.read_sql(*self.__build_sql(to_update_date))
+
+    def __build_sharded(self, to_update_date):
+        frames = self._read_sharded(to_update_date, self.__build_sql, self.read_shards)
+        order_index = self.order_index or [self.index_field]
+        # 以日期开头排序时，各段已按日期先后排列，段内已排序；desc只作用于最后一个排序字段
+        if order_index[0] == self.index_field:
+            if self.order_desc and len(order_index) == 1:
+                frames = frames[::-1]
+            return pd.concat(frames, ignore_index=True)
+        data = pd.concat(frames, ignore_index=True)
+        if not all(i in data.columns for i in order_index):
+            return data
+        return data.sort_values(order_index, ascending=[True] * (len(order_index) - 1) + [not self.order_desc],
+                                kind='stable', ignore_index=True)
+
+    def fingerprint(self, to_update_date):
+        if not self.watermark_field or not self.index_field:
+            return None
+        from_where, params = self._from_where(to_update_date)
+        sql = f'select {self.index_field} as update_date, count(*) as cnt, max({self.watermark_field}) as watermark ' \
+              f'{from_where} group by {self.index_field}'
+        data = pd.read_sql(text(sql), con=self.db, params=params)
+        if data.empty:
+            return {}
+        data['update_date'] = pd.to_datetime(data['update_date']).dt.strftime('%Y-%m-%d')
+        return {date: f'{cnt}:{watermark}' for date, cnt, watermark in zip(data['update_date'], data['cnt'], data['watermark'])}
+
+    def count_rows(self, to_update_date):
+        if not self.index_field:
+            return None
+        return self._count_by_date(*self._from_where(to_update_date))
 
-        return pd.read_sql(base_sql, con=self.db)
+    def explain_rows(self, to_update_date):
+        from_where, params = self._from_where(to_update_date)
+        return self._explain_rows(f'select {self.query_field} {from_where}', params)
+
+    def watermark(self, to_update_date):
+        if not self.index_field:
+            return None
+        from_where, params = self._from_where(to_update_date)
+        fields = f'max({self.index_field}) as max_date'
+        if self.watermark_field:
+            fields += f', max({self.watermark_field}) as watermark'
+        data = pd.read_sql(text(f'select {fields} {from_where}'), con=self.db, params=params)
+        return tuple(str(i) for i in data.iloc[0].tolist())
+
+    def probe_dates(self, to_update_date):
+        if not self.index_field:
+            return None
+        from_where, params = self._from_where(to_update_date)
+        return self._distinct_dates(f'select distinct {self.index_field} as update_date {from_where}', params)
+
+    def read_tables(self):
+        return [self.tb]
 
 
 class MultiSource(BaseSource):
     """
     多数据源联合查询时使用
+    relations中的表在同一个库时，在数据库中join；relation设置了l_db/r_db且不在同一个库时，按跨库方式查询：
+        1、每个表单独查询，只查询需要的字段(query_field及连接字段)，并下推该表的条件(l_cons/r_cons)与日期条件；
+           left join右侧的表，其条件与同库时一样在连接之后筛选(同库时条件在where中，会去掉不满足条件的未匹配行)
+        2、日期字段(index_field)所在的表(第一个relation的left表)按块流式读取，其余表整体读取后建立哈希表，
+           每块依次与各表连接，内存占用取决于块大小与其余表的大小
+        跨库时仅支持 inner/left join
     """
 
+    # 跨库查询时未设置chunksize的流式读取块大小
+    CROSS_DB_CHUNKSIZE = 100000
+
     def __init__(self,
                  relations: list,
                  db: str = None,
                  empty_check=True,
-                 index_field='date'):
+                 index_field='date',
+                 chunksize: int = None,
+                 dtypes: dict = None,
+                 downcast=None):
         """
         :param relations:连接条件模板如下：
         {'left':'','right':'','l_on':'','r_on':'','how':'','lquery_field':'','rquery_field':' ','l_cons':'','r_cons':''},
+        可选 'l_db'、'r_db'：left、right表所在的数据库别名，默认为db
         :param db:
         :param empty_check:
-        :param index_field:
+        :param index_field: 跨库时需要属于第一个relation的left表，可写为 表名.字段 或 字段
+        :param chunksize: 流式读取时每块的行数，默认一次读取全部
+        :param dtypes: 读取后各列的类型，见BaseSource
+        :param downcast: 读取后降低内存的转换规则，见BaseSource
         """
-        super().__init__(db, index_field, empty_check)
+        super().__init__(db, index_field, empty_check, chunksize, dtypes, downcast)
         self.relations = relations
 
-    def build_source(self, to_update_date):
+    def _from_where(self, to_update_date):
         query_params = []
         join_stm = ''
         where_clause = ''
@@ -81,21 +180,240 @@ class MultiSource(BaseSource):
             join_stm += f"{rel['how']} join {rel['right']} on {rel['left']}.{rel['l_on']}={rel['right']}.{rel['r_on']} "
             where_clause += (f" and {rel['left'] + '.' + rel['l_cons']}" if rel['l_cons'] != '' else '') + (
                 f"and {rel['right'] + '.' + rel['r_cons']}" if rel['r_cons'] != '' else '')
-        base_sql = f'select {",".join(query_params)} from {self.relations[0]["left"]} {join_stm} where 1=1 {where_clause} and {self.index_field} in ({query_in_sql(to_update_date)})'
-        return pd.read_sql(base_sql, con=self.db)
+        predicate, params = date_predicate(self.index_field, to_update_date)
+        from_where = f' from {self.relations[0]["left"]} {join_stm} where 1=1 {where_clause} and {predicate}'
+        return ",".join(query_params), from_where, params
+
+    def table_dbs(self):
+        """
+        :return: {表名: 数据库别名}
+        """
+        dbs = {}
+        for rel in self.relations:
+            dbs.setdefault(rel['left'], rel.get('l_db') or self.db_str)
+            dbs.setdefault(rel['right'], rel.get('r_db') or self.db_str)
+        return dbs
+
+    def is_cross_db(self):
+        return len(set(db_key(USABLE_DBS.get(i)) for i in self.table_dbs().values())) > 1
+
+    def __left_joined(self, table):
+        return any(rel['right'] == table and rel['how'].strip().lower() == 'left' for rel in self.relations)
+
+    def __side_sql(self, table, to_update_date):
+        """
+        跨库查询时单个表的查询语句，只查询输出字段与连接字段，下推该表的条件，日期字段所在的表下推日期条件；
+        left join右侧的表不下推条件，改为查询条件是否满足的标记字段 _cons_表名，连接后再筛选
+        :return: (语句, 绑定参数, 输出字段, 连接用的辅助字段, 连接后筛选的条件)
+        """
+        fields, keys, conditions = [], [], []
+        for rel in self.relations:
+            for side, other in (('l', 'r'), ('r', 'l')):
+                if rel['left' if side == 'l' else 'right'] != table:
+                    continue
+                fields += [i.strip() for i in rel[f'{side}query_field'].split(',') if i.strip() != '']
+                keys.append(rel[f'{side}_on'])
+                if rel[f'{side}_cons'] != '':
+                    conditions.append(f'{table}.{rel[side + "_cons"]}')
+        fields = list(dict.fromkeys(fields))
+        helpers = [i for i in dict.fromkeys(keys) if i not in fields]
+
+        deferred = None
+        select = [f'{table}.{i}' for i in fields + helpers]
+        if conditions and self.__left_joined(table):
+            deferred = ' and '.join(conditions)
+            select.append(f'case when {deferred} then 1 else 0 end as _cons_{table}')
+            conditions = []
+
+        params = {}
+        if table == self.relations[0]['left']:
+            date_field = self.index_field.split('.')[-1]
+            if date_field not in fields and date_field not in helpers:
+                helpers.append(date_field)
+                select.append(f'{table}.{date_field}')
+            predicate, params = date_predicate(f'{table}.{date_field}', to_update_date)
+            conditions.append(predicate)
+        where = ' and '.join(conditions) if conditions else '1=1'
+        sql = f'select {",".join(select)} from {table} where {where}'
+        return sql, params, fields, helpers, deferred
+
+    def __unmatched_passes(self, table, condition, db_str):
+        """
+        left join未匹配的行(右表字段全为null)是否满足条件，如 is null 的条件，在右表所在的库中计算
+        """
+        data = self.read_sql(text(f'select case when {condition} then 1 else 0 end as ok '
+                                  f'from (select 1 as one) t left join {table} on 1=0'), db_str=db_str, chunksize=0)
+        return bool(data['ok'].iloc[0])
+
+    def __cross_db_source(self, to_update_date):
+        tables = self.table_dbs()
+        probe = self.relations[0]['left']
+        if '.' in self.index_field and self.index_field.split('.')[0] != probe:
+            raise ValueError(f'跨库查询时index_field需要属于第一个relation的left表：{probe}')
+        for rel in self.relations:
+            if rel['how'].strip().lower() not in ('', 'inner', 'left'):
+                raise ValueError(f'跨库查询仅支持inner/left join：{rel["left"]} {rel["how"]} join {rel["right"]}')
+
+        # 除日期字段所在的表外，其余表整体读取，作为哈希连接的构建端
+        output, builds, unmatched = [], {}, {}
+        for table in tables:
+            sql, params, fields, _, deferred = self.__side_sql(table, to_update_date)
+            output += [i for i in fields if i not in output]
+            if table != probe:
+                builds[table] = self.read_sql(text(sql), params, db_str=tables[table], chunksize=0)
+            if deferred:
+                unmatched[table] = self.__unmatched_passes(table, deferred, tables[table])
+
+        sql, params, _, _, _ = self.__side_sql(probe, to_update_date)
+        chunks = self.read_sql(text(sql), params, db_str=tables[probe],
+                               chunksize=self.chunksize or self.CROSS_DB_CHUNKSIZE)
+        joined = (self.__join_chunk(chunk, builds, output, unmatched) for chunk in chunks)
+        if self.chunksize:
+            return joined
+        joined = list(joined)
+        return pd.concat(joined, ignore_index=True) if joined else pd.DataFrame(columns=output)
+
+    def __join_chunk(self, chunk, builds, output, unmatched):
+        for rel in self.relations:
+            how = rel['how'].strip().lower() or 'inner'
+            chunk = chunk.merge(builds[rel['right']], how=how, left_on=rel['l_on'], right_on=rel['r_on'],
+                                suffixes=('', f'_{rel["right"]}'))
+            flag = f'_cons_{rel["right"]}'
+            if flag in chunk.columns:
+                # 与同库时where中的条件一致：匹配的行按标记筛选，未匹配的行按null是否满足条件筛选
+                keep = chunk[flag].eq(1)
+                if unmatched[rel['right']]:
+                    keep |= chunk[flag].isna()
+                chunk = chunk[keep].drop(columns=flag)
+        return chunk[[i for i in output if i in chunk.columns]]
+
+    def build_source(self, to_update_date):
+        if self.is_cross_db():
+            return self.__cross_db_source(to_update_date)
+        query_field, from_where, params = self._from_where(to_update_date)
+        return self.read_sql(text(f'select {query_field} {from_where}'), params)
+
+    def probe_dates(self, to_update_date):
+        if self.is_cross_db():
+            # 跨库时只能探测日期字段所在的表，inner join的结果可能更少，不影响正确性
+            probe = self.relations[0]['left']
+            predicate, params = date_predicate(self.index_field, to_update_date)
+            return self._distinct_dates(f'select distinct {self.index_field} as update_date from {probe} '
+                                        f'where {predicate}', params, db_str=self.table_dbs()[probe])
+        _, from_where, params = self._from_where(to_update_date)
+        return self._distinct_dates(f'select distinct {self.index_field} as update_date {from_where}', params)
+
+    def probe_cost(self):
+        # 需要join，排在单表数据源之后
+        return 1 + len(self.relations)
+
+    def count_rows(self, to_update_date):
+        if self.is_cross_db():
+            # 只统计日期字段所在的表，inner join的结果可能更少
+            probe = self.relations[0]['left']
+            predicate, params = date_predicate(self.index_field, to_update_date)
+            return self._count_by_date(f' from {probe} where {predicate}', params, db_str=self.table_dbs()[probe])
+        _, from_where, params = self._from_where(to_update_date)
+        return self._count_by_date(from_where, params)
+
+    def explain_rows(self, to_update_date):
+        if self.is_cross_db():
+            return None
+        _, from_where, params = self._from_where(to_update_date)
+        return self._explain_rows(f'select 1 {from_where}', params)
+
+    def read_tables(self):
+        tables = []
+        for rel in self.relations:
+            for tb in (rel['left'], rel['right']):
+                if tb not in tables:
+                    tables.append(tb)
+        return tables
+
+
+# sql末尾的 order by 字段列表，其后只允许 limit
+_ORDER_BY = re.compile(r'order\s+by\s+((?:[\w.`"]+(?:\s+(?:asc|desc))?\s*,\s*)*[\w.`"]+(?:\s+(?:asc|desc))?)'
+                       r'\s*(?:limit\s+\d+(?:\s*,\s*\d+)?(?:\s+offset\s+\d+)?)?\s*;?\s*$', re.I)
 
 
 class RawSqlSource(BaseSource):
-    def __init__(self, index_field, sql, db: str = None, empty_check=True):
+    def __init__(self, index_field, sql, db: str = None, empty_check=True, chunksize: int = None,
+                 dtypes: dict = None, downcast=None, read_shards: int = None):
         """
         直接使用sql的源
         :param db:
         :param index_field:
         :param empty_check:
-        :param sql:
+        :param sql: 查询语句，日期条件有两种写法：
+                1、where {index_field} in ({}) ，{} 处填入绑定参数形式的日期列表
+                2、where {date_filter} ，填入index_field的日期条件，连续日期使用between，推荐使用
+                sql按str.format填入日期条件，sql中字面的大括号(如正则、json路径)需要写为 {{ }}
+        :param chunksize: 流式读取时每块的行数，默认一次读取全部
+        :param dtypes: 读取后各列的类型，见BaseSource
+        :param downcast: 读取后降低内存的转换规则，见BaseSource
+        :param read_shards: 分段并发读取，需要同步的日期按顺序拆分为read_shards段，在多个连接上并发查询后合并，
+                sql末尾的order by以index_field开头时按其升降序合并各段，否则order by的字段都在结果中时合并后重新排序；
+                设置了chunksize时不分段
         """
-        super().__init__(db, index_field, empty_check)
+        super().__init__(db, index_field, empty_check, chunksize, dtypes, downcast)
+        self.read_shards = read_shards
         self.sql = sql
 
+    def __build_sql(self, to_update_date):
+        # 与str.format的语义一致，{{ }} 为字面的大括号
+        if 'date_filter' in {name for _, name, _, _ in string.Formatter().parse(self.sql)}:
+            predicate, params = date_predicate(self.index_field, to_update_date)
+            return text(self.sql.format(date_filter=predicate)), params
+
+        # 兼容 in ({}) 的写法，日期以绑定参数传入
+        dates = sorted(set(str(i) for i in to_update_date))
+        params = {f'd_{index}': value for index, value in enumerate(dates)}
+        in_list = ','.join(f':{i}' for i in params) if params else 'null'
+        return text(self.sql.format(in_list)), params
+
+    def probe_dates(self, to_update_date):
+        # 把sql作为子查询，只取日期字段
+        sql, params = self.__build_sql(to_update_date)
+        return self._distinct_dates(f'select distinct t.{self.index_field.split(".")[-1]} as update_date '
+                                    f'from ({sql.text}) t', params)
+
+    def probe_cost(self):
+        # sql内容未知，最后探测
+        return 10
+
+    def explain_rows(self, to_update_date):
+        sql, params = self.__build_sql(to_update_date)
+        return self._explain_rows(sql.text, params)
+
     def build_source(self, to_update_date):
-        return pd.read_sql(self.sql.format(query_in_sql(to_update_date)), con=self.db)
+        if self.read_shards and self.read_shards > 1 and not self.chunksize and len(to_update_date) > 1:
+            return self.__build_sharded(to_update_date)
+        return self.read_sql(*self.__build_sql(to_update_date))
+
+    def __order_by(self):
+        """
+        sql末尾(最外层)的order by，无法解析时返回空列表
+        :return: [(字段名, 是否降序)]
+        """
+        match = _ORDER_BY.search(self.sql)
+        if not match:
+            return []
+        order_by = []
+        for item in match.group(1).split(','):
+            parts = item.split()
+            order_by.append((parts[0].split('.')[-1].strip('`"'), len(parts) > 1 and parts[1].lower() == 'desc'))
+        return order_by
+
+    def __build_sharded(self, to_update_date):
+        frames = self._read_sharded(to_update_date, self.__build_sql, self.read_shards)
+        order_by = self.__order_by()
+        # 以日期开头排序时，各段的日期区间不重叠且段内已排序，按日期的升降序合并即可
+        if order_by and order_by[0][0] == self.index_field.split('.')[-1]:
+            if order_by[0][1]:
+                frames = frames[::-1]
+            return pd.concat(frames, ignore_index=True)
+        data = pd.concat(frames, ignore_index=True)
+        if not order_by or not all(i in data.columns for i, _ in order_by):
+            return data
+        return data.sort_values([i for i, _ in order_by], ascending=[not desc for _, desc in order_by],
+                                kind='stable', ignore_index=True)
@@ -1,9 +1,19 @@
-from ts_soup.common import BaseTarget, query_in_sql
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from ts_soup.common import BaseTarget, date_predicate, pym_connection, SYNC_CONFIG, USABLE_DBS
+from ts_soup.workers.writers import WRITERS, WRITE_MODES, staging_swap, create_shard_table, create_union_view
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 import datetime
 
 
+# 本进程内已确认存在的分表：(数据库别名, 分表名)
+_CREATED_SHARDS = set()
+_SHARDS_LOCK = threading.Lock()
+
+
 class TargetTable(BaseTarget):
     def __init__(self, tb,
                  db: str = None,
@@ -12,10 +22,15 @@ class TargetTable(BaseTarget):
                  drop_na_subset=None,
                  drop_na_thresh=None,
                  has_unique_idx=False,
-                 is_empty_effect=True
+                 is_empty_effect=True,
+                 write_mode: str = None,
+                 batch_size: int = 1000,
+                 shard_by: str = None,
+                 shard_workers: int = 4,
+                 union_view=None
                  ):
         """
-        目标表信息，如果该表需要分表，则tb传入没有分表年份的表名，年份在写入时会自动加入，同时is_seperated设置为True
+        目标表信息，如果该表需要分表，则tb传入没有分表年份的表名，年份在写入时会自动加入，同时设置shard_by
         :param tb:表名，
         :param db:数据库
         :param index_field:作为索引的字段，一般为日期
@@ -26,6 +41,18 @@ class TargetTable(BaseTarget):
                 否则会出现数据重复
         :param is_empty_effect:表示该target  数据为空 是否影响update_state设置为 1 ,True表示数据为空，不能设置为 1
         否则会出现数据重复
+        :param write_mode:写入方式，默认按has_unique_idx使用replace into或者 delete + to_sql，可选：
+                multi_insert: delete + 多行insert，每条语句batch_size行
+                load_data: delete + LOAD DATA LOCAL INFILE，仅支持mysql，连接需要开启local_infile
+                upsert: insert ... on duplicate key update，需要has_unique_idx
+                staging: 先写入临时staging表，再在短事务中 delete + insert ... select 移入线上表，减少线上表锁的时间
+                每次写入会输出写入速度(行/秒)，可以据此为每个表选择写入方式
+        :param batch_size:multi_insert、upsert、staging 每条语句写入的行数
+        :param shard_by:按日期分表，year：数据按index_field的年份写入 tb_yyyy，month：写入 tb_yyyymm；
+                tb作为分表的模板表(字段、索引)，分表不存在时按模板创建，每个分表的删除、写入耗时与历史数据总量无关
+        :param shard_workers:分表时同时写入的分表数
+        :param union_view:分表时创建合并所有分表的视图(union all)，为True时视图名为 tb_all，也可以传入视图名；
+                创建新的分表时重建视图
         """
         super().__init__(
             db,
@@ -37,6 +64,34 @@ class TargetTable(BaseTarget):
         self.drop_na_thresh = drop_na_thresh
         self.has_unique_idx = has_unique_idx
         self.is_empty_effect = is_empty_effect
+        if write_mode is not None and write_mode not in WRITE_MODES:
+            raise ValueError(f'write_mode 可选值为 {",".join(WRITE_MODES)}')
+        if write_mode == 'upsert' and not has_unique_idx:
+            raise ValueError('write_mode 为 upsert 时需要表存在唯一索引或主键，并设置has_unique_idx=True')
+        self.write_mode = write_mode
+        self.batch_size = batch_size
+        if shard_by not in (None, 'year', 'month'):
+            raise ValueError('shard_by 可选值为 year,month')
+        self.shard_by = shard_by
+        self.shard_workers = shard_workers
+        self.union_view = f'{tb}_all' if union_view is True else union_view
+        # 最近一次写入的行数、耗时
+        self.last_write_stats = None
+        # 流式写入时已经删除过旧数据的日期，以及存在空数据的日期
+        self._stream_written = set()
+        self._stream_incomplete = set()
+
+    def begin_stream(self):
+        super().begin_stream()
+        self._stream_written = set()
+        self._stream_incomplete = set()
+
+    def end_stream(self):
+        # 某日期在任何一块中存在空数据，则该日期未更新完成
+        updated_date = super().end_stream()
+        if updated_date is None:
+            return None
+        return [i for i in updated_date if i not in self._stream_incomplete]
 
     def build_output(self, cur_result):
         # 写库
@@ -48,13 +103,16 @@ class TargetTable(BaseTarget):
             return [] if self.is_empty_effect else None
 
         # 统一把index_field字段转为str类型，防止后面在insert_update_state 和各表插入数据时 使用datetime64 或 int等类型
-        # datetime.date 在dataframe中有可能是Object类型
-        if str(cur_result[self.index_field].dtypes) == 'datetime64' or str(
-                cur_result[self.index_field].dtypes).lower() == 'object':
-            cur_result[self.index_field] = pd.to_datetime(cur_result[self.index_field]).apply(
-                lambda x: x.strftime('%Y-%m-%d'))
+        # datetime.date 在dataframe中有可能是Object类型，只解析不同的日期值后映射回各行
+        index_dtype = str(cur_result[self.index_field].dtypes)
+        if index_dtype.startswith('datetime64'):
+            cur_result[self.index_field] = cur_result[self.index_field].dt.strftime('%Y-%m-%d')
+        elif index_dtype.lower() == 'object':
+            uniques = cur_result[self.index_field].drop_duplicates()
+            formatted = pd.Series(pd.to_datetime(uniques).dt.strftime('%Y-%m-%d').values, index=uniques.values)
+            cur_result[self.index_field] = cur_result[self.index_field].map(formatted)
 
-        self.__execute_sql(cur_result)
+        self.__write_changed(cur_result)
 
         """如果是多个数据源合并到一个表，多个字段有若干个为空，或者一个日期内多行内有字段为空，
         则需要在插入前删除为空的字段的日期，保证下次执行还能同步该日期
@@ -67,52 +125,157 @@ class TargetTable(BaseTarget):
         2023-02     1       3       4
         2023-01日期有Na，则不作为更新完成的日期
         """
-        params = {'axis': self.drop_axis}
-        if self.drop_na_subset:
-            params['subset'] = self.drop_na_subset
-        if self.drop_na_thresh:
-            params['thresh'] = self.drop_na_thresh
-
-        updated_date = []
-        not_updated_date = []
-        groups = cur_result.groupby(by=self.index_field, dropna=False)
-        for index, group in groups:
-            rows = group.shape[0]
-            new_df = group.dropna(**params)
-            new_rows = new_df.shape[0]
-            if rows == new_rows:
-                updated_date.append(index)
-            else:
-                not_updated_date.append(index)
+        updated_date, not_updated_date = self.split_complete_date(cur_result)
+        if self.streaming:
+            self._stream_incomplete.update(not_updated_date)
         if len(not_updated_date) != 0:
             print(f'{self.tb} 因数据不全(多个字段有至少一个字段为Null)导致update_state当天日期未更新：\n{",".join(sorted(not_updated_date, reverse=True))}')
         return updated_date if self.is_empty_effect else None
 
+    def __write_changed(self, cur_result):
+        """
+        开启变更检测时，只写入内容指纹与上次写入不同的日期，流式写入时各日期的数据不完整，不做检测
+        """
+        if not SYNC_CONFIG['change_detection'] or self.streaming:
+            self.__execute_sql(cur_result)
+            return
+        from ts_soup.fingerprint import frame_fingerprints, load_fingerprints, save_fingerprints
+
+        table_name = f'{self.db_str}.{self.tb}'
+        fingerprints = frame_fingerprints(cur_result, self.index_field)
+        stored = load_fingerprints(USABLE_DBS['targets_default'], 'target', table_name, list(fingerprints))
+        unchanged_date = [i for i, fingerprint in fingerprints.items() if stored.get(i) == fingerprint]
+        if unchanged_date:
+            print(f'{self.tb} 数据未变化，跳过写入日期：\n{",".join(sorted(unchanged_date, reverse=True))}')
+            cur_result = cur_result[~cur_result[self.index_field].isin(unchanged_date)]
+        if cur_result.empty:
+            return
+        self.__execute_sql(cur_result)
+        save_fingerprints(USABLE_DBS['targets_default'], 'target', table_name,
+                          {i: fingerprint for i, fingerprint in fingerprints.items() if i not in unchanged_date})
+
+    def split_complete_date(self, cur_result):
+        """
+        按 drop_axis,drop_na_subset,drop_na_thresh 判断每个日期的数据是否完整，结果与对每个日期分组dropna后比较行数相同
+        :param cur_result:
+        :return: (数据完整的日期列表, 存在空数据的日期列表)，均按日期排序
+        """
+        # 按列dropna不会减少行数，所有日期都视为完整
+        if self.drop_axis in (0, 'index'):
+            subset = self.drop_na_subset if self.drop_na_subset else cur_result.columns
+            if isinstance(subset, str):
+                subset = [subset]
+            notna_count = cur_result[list(subset)].notna().sum(axis=1)
+            thresh = self.drop_na_thresh if self.drop_na_thresh else len(subset)
+            incomplete = notna_count < thresh
+        else:
+            incomplete = pd.Series(False, index=cur_result.index)
+
+        date_incomplete = incomplete.groupby(cur_result[self.index_field], dropna=False).any()
+        return date_incomplete.index[~date_incomplete.values].tolist(), date_incomplete.index[date_incomplete.values].tolist()
+
     def __execute_sql(self, cur_result):
         """
         需要写库的操作
         :param cur_result:
         :return:
         """
+        start = time.perf_counter()
+        if self.shard_by:
+            self.__write_shards(cur_result)
+        else:
+            self.__write_table(cur_result, self.tb, self.__delete_date(cur_result))
+        self.__report_write(cur_result.shape[0], time.perf_counter() - start)
+        print(
+            f'{self.tb} 更新成功，更新日期为：\n{",".join(cur_result[self.index_field].drop_duplicates().sort_values(ascending=False).values.tolist())}')
+
+    def __delete_date(self, cur_result):
+        """
+        写入前需要删除旧数据的日期，upsert与replace into不需要删除
+        """
+        if self.write_mode == 'upsert' or (self.has_unique_idx and self.write_mode is None):
+            return []
+        delete_date = cur_result[self.index_field].drop_duplicates().values.tolist()
+        # 流式写入时同一日期可能分布在多块中，只在第一次写入该日期时删除旧数据
+        if self.streaming:
+            delete_date = [i for i in delete_date if i not in self._stream_written]
+            self._stream_written.update(delete_date)
+        return delete_date
+
+    def __write_table(self, cur_result, tb, delete_date):
+        if self.write_mode == 'upsert':
+            with self.db.begin() as conn:
+                WRITERS['upsert'](conn, cur_result, tb, self.batch_size)
         # 设置了使用replace_into语句(多重索引的情况下无法使用sqlalchemy)，此时需要表设置唯一索引或者主键
-        if self.has_unique_idx:
+        elif self.has_unique_idx and self.write_mode is None:
             # 使用Pymysql的连接
             insert_field = cur_result.columns.values.tolist()
-            cursor = self.db_pym.cursor()
-            try:
-                cursor.executemany(
-                    f'replace into {self.tb} ({",".join(insert_field)}) values ({",".join(["%s" for _ in range(len(insert_field))])})',
-                    cur_result.values.tolist())
-                self.db_pym.commit()
-            except Exception:
-                import traceback
-                print(traceback.format_exc())
-                self.db_pym.rollback()
-                raise Exception('数据库操作错误!')
+            with pym_connection(self.db_pym) as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.executemany(
+                        f'replace into {tb} ({",".join(insert_field)}) values ({",".join(["%s" for _ in range(len(insert_field))])})',
+                        cur_result.values.tolist())
+                    conn.commit()
+                except Exception:
+                    import traceback
+                    print(traceback.format_exc())
+                    conn.rollback()
+                    raise Exception('数据库操作错误!')
+        elif self.write_mode == 'staging':
+            staging_swap(self.db, cur_result, tb, self.index_field, delete_date, self.batch_size)
         else:
-            with self.db.begin() as conn:
-                conn.execute(
-                    f'delete from {self.tb} where {self.index_field} in ({query_in_sql(cur_result[self.index_field].drop_duplicates().values.tolist())})')
-                cur_result.to_sql(self.tb, con=conn, if_exists='append', index=False)
-        print(
-            f'{self.tb} 更新成功，更新日期为：\n{",".join(cur_result[self.index_field].drop_duplicates().sort_values(ascending=False).values.tolist())}')
+            self.__delete_insert(cur_result, tb, delete_date)
+
+    def shard_name(self, dates):
+        """
+        :param dates: 日期Series
+        :return: 每个日期对应的分表名
+        """
+        digits = dates.astype(str).str.replace('-', '', regex=False)
+        return self.tb + '_' + digits.str.slice(0, 4 if self.shard_by == 'year' else 6)
+
+    def __write_shards(self, cur_result):
+        """
+        按日期把数据路由到各分表，不同分表并发写入
+        """
+        groups = dict(tuple(cur_result.groupby(self.shard_name(cur_result[self.index_field]).values, sort=True)))
+        self.__ensure_shards(list(groups))
+        tasks = [(frame, tb, self.__delete_date(frame)) for tb, frame in groups.items()]
+        if len(tasks) == 1:
+            self.__write_table(*tasks[0])
+            return
+        with ThreadPoolExecutor(max_workers=min(self.shard_workers, len(tasks))) as pool:
+            for future in [pool.submit(self.__write_table, *task) for task in tasks]:
+                future.result()
+
+    def __ensure_shards(self, shards):
+        """
+        创建本进程内未确认过的分表，有新建的分表时重建合并视图
+        """
+        with _SHARDS_LOCK:
+            new_shards = [i for i in shards if (self.db_str, i) not in _CREATED_SHARDS]
+            for shard in new_shards:
+                create_shard_table(self.db, self.tb, shard)
+                _CREATED_SHARDS.add((self.db_str, shard))
+            if new_shards:
+                print(f'{self.tb} 分表：{",".join(new_shards)}')
+                if self.union_view:
+                    create_union_view(self.db, self.tb, self.union_view)
+
+    def __delete_insert(self, cur_result, tb, delete_date):
+        # 在同一个事务中删除旧数据并写入
+        with self.db.begin() as conn:
+            if delete_date:
+                predicate, params = date_predicate(self.index_field, delete_date)
+                conn.execute(text(f'delete from {tb} where {predicate}'), params)
+            if self.write_mode is None:
+                cur_result.to_sql(tb, con=conn, if_exists='append', index=False)
+            else:
+                WRITERS[self.write_mode](conn, cur_result, tb, self.batch_size)
+
+    def __report_write(self, rows, seconds):
+        mode = self.write_mode or ('replace_into' if self.has_unique_idx else 'to_sql')
+        speed = rows / seconds if seconds > 0 else float('inf')
+        self.last_write_stats = {'write_mode': mode, 'rows': rows, 'seconds': seconds, 'rows_per_sec': speed}
+        print(f'{self.tb} 写入 {rows} 行，耗时 {seconds:.2f}s，{speed:.0f} 行/秒 ({mode})')
@@ -0,0 +1,171 @@
+import os
+import re
+import tempfile
+import uuid
+from sqlalchemy import inspect, text
+from ts_soup.common import date_predicate
+
+
+def _dialect(conn):
+    return conn.engine.dialect.name
+
+
+def insert_multi(conn, cur_result, tb, batch_size):
+    """
+    多行insert，每条insert语句写入batch_size行
+    """
+    cur_result.to_sql(tb, con=conn, if_exists='append', index=False, method='multi', chunksize=batch_size)
+
+
+def _upsert_method(pd_table, conn, keys, data_iter):
+    """
+    DataFrame.to_sql 的method，mysql使用 insert ... on duplicate key update，sqlite使用 insert or replace
+    """
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    if not rows:
+        return
+    dialect = _dialect(conn)
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(pd_table.table).values(rows)
+        stmt = stmt.on_duplicate_key_update({key: stmt.inserted[key] for key in keys})
+    elif dialect == 'sqlite':
+        stmt = pd_table.table.insert().prefix_with('OR REPLACE').values(rows)
+    else:
+        raise ValueError(f'upsert 不支持 {dialect} 数据库')
+    conn.execute(stmt)
+
+
+def upsert(conn, cur_result, tb, batch_size):
+    """
+    按唯一索引或主键插入或更新，每条语句写入batch_size行，需要表存在唯一索引或主键
+    """
+    cur_result.to_sql(tb, con=conn, if_exists='append', index=False, method=_upsert_method, chunksize=batch_size)
+
+
+def _to_tsv_lines(cur_result):
+    """
+    转换为 LOAD DATA 默认格式(制表符分隔，反斜杠转义，\\N 表示NULL)的文本行
+    """
+    columns = []
+    for col in cur_result.columns:
+        series = cur_result[col]
+        if series.dtype == bool:
+            series = series.astype(int)
+        na = series.isna()
+        series = series.astype(str) \
+            .str.replace('\\', '\\\\', regex=False) \
+            .str.replace('\t', '\\t', regex=False) \
+            .str.replace('\n', '\\n', regex=False) \
+            .str.replace('\r', '\\r', regex=False)
+        columns.append(series.mask(na, '\\N'))
+    if len(columns) == 1:
+        return columns[0]
+    return columns[0].str.cat(columns[1:], sep='\t')
+
+
+def load_data(conn, cur_result, tb, batch_size):
+    """
+    先写入临时文件，再使用 LOAD DATA LOCAL INFILE 导入，仅支持mysql，连接需要开启local_infile，
+    如 create_engine(url, connect_args={'local_infile': True})
+    """
+    if _dialect(conn) != 'mysql':
+        raise ValueError('load_data 仅支持mysql数据库')
+    fd, path = tempfile.mkstemp(suffix='.tsv')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8', newline='\n') as f:
+            lines = _to_tsv_lines(cur_result)
+            if len(lines):
+                f.write('\n'.join(lines.tolist()) + '\n')
+        fields = ','.join(f'`{i}`' for i in cur_result.columns)
+        conn.execute(text(f"load data local infile '{path.replace(os.sep, '/')}' into table {tb} character set utf8mb4 ({fields})"))
+    finally:
+        os.remove(path)
+
+
+# TargetTable write_mode 对应的写入方法
+WRITERS = {
+    'multi_insert': insert_multi,
+    'load_data': load_data,
+    'upsert': upsert,
+}
+
+
+def staging_swap(engine, cur_result, tb, index_field, delete_date, batch_size):
+    """
+    先把数据写入临时的staging表(不锁线上表)，再在一个短事务中删除线上表对应日期的数据，
+    并通过 insert ... select 从staging表移入，线上表的锁持续时间与客户端写入的数据量无关
+    """
+    staging = f'{tb}__stg_{uuid.uuid4().hex[:8]}'
+    with engine.begin() as conn:
+        if _dialect(conn) == 'mysql':
+            conn.execute(text(f'create table {staging} like {tb}'))
+        else:
+            conn.execute(text(f'create table {staging} as select * from {tb} where 1=0'))
+    try:
+        with engine.begin() as conn:
+            insert_multi(conn, cur_result, staging, batch_size)
+
+        fields = ','.join(cur_result.columns)
+        with engine.begin() as conn:
+            if delete_date:
+                predicate, params = date_predicate(index_field, delete_date)
+                conn.execute(text(f'delete from {tb} where {predicate}'), params)
+            conn.execute(text(f'insert into {tb} ({fields}) select {fields} from {staging}'))
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text(f'drop table if exists {staging}'))
+
+
+def create_shard_table(engine, tb, shard):
+    """
+    以tb为模板创建分表shard(已存在时不处理)，包含模板表的索引：
+        mysql使用 create table ... like，sqlite复制模板表及其索引的建表语句，其他数据库只复制字段
+    """
+    with engine.begin() as conn:
+        dialect = _dialect(conn)
+        if dialect == 'mysql':
+            conn.execute(text(f'create table if not exists {shard} like {tb}'))
+            return
+        if dialect != 'sqlite':
+            conn.execute(text(f'create table if not exists {shard} as select * from {tb} where 1=0'))
+            return
+        ddls = conn.execute(text("select type, name, sql from sqlite_master where tbl_name = :tb and sql is not null "
+                                 "order by type desc"), {'tb': tb}).fetchall()
+        for type_, name, sql in ddls:
+            if type_ == 'table':
+                sql = re.sub(rf'^\s*create\s+table\s+["`\[]?{re.escape(tb)}["`\]]?', f'CREATE TABLE IF NOT EXISTS {shard}',
+                             sql, count=1, flags=re.I)
+            else:
+                sql = re.sub(rf'^\s*create\s+(unique\s+)?index\s+["`\[]?{re.escape(name)}["`\]]?\s+on\s+["`\[]?{re.escape(tb)}["`\]]?',
+                             lambda m: f'CREATE {m.group(1) or ""}INDEX IF NOT EXISTS {name}__{shard} ON {shard}',
+                             sql, count=1, flags=re.I)
+            conn.execute(text(sql))
+
+
+def shard_tables(engine, tb):
+    """
+    :return: 数据库中tb的分表(tb_yyyy 或 tb_yyyymm)，按名称排序
+    """
+    pattern = re.compile(rf'^{re.escape(tb)}_\d{{4}}(\d{{2}})?$', re.I)
+    return sorted(i for i in inspect(engine).get_table_names() if pattern.match(i))
+
+
+def create_union_view(engine, tb, view):
+    """
+    创建(或重建)合并所有分表的视图，供读取方查询完整数据
+    """
+    shards = shard_tables(engine, tb)
+    if not shards:
+        return
+    select = ' union all '.join(f'select * from {i}' for i in shards)
+    with engine.begin() as conn:
+        if _dialect(conn) == 'mysql':
+            conn.execute(text(f'create or replace view {view} as {select}'))
+        else:
+            conn.execute(text(f'drop view if exists {view}'))
+            conn.execute(text(f'create view {view} as {select}'))
+
+
+# TargetTable 支持的write_mode，staging 需要自行管理事务，不在WRITERS中
+WRITE_MODES = list(WRITERS) + ['staging']